@@ -0,0 +1,137 @@
+"""
+Benchmark the single-pass `MarkdownChunker` against the previous two-stage LangChain splitting.
+
+Usage:
+    python -m benchmarks.bench_markdown_chunker [--data data/anyio] [--repeat 3]
+
+Without `--data`, a synthetic Markdown corpus is generated.
+"""
+
+import argparse
+import random
+import time
+import tracemalloc
+import typing as t
+
+from langchain_core.documents import Document
+from langchain_text_splitters import (
+    MarkdownHeaderTextSplitter,
+    RecursiveCharacterTextSplitter,
+)
+
+from core.data_processor.constants import (
+    DEFAULT_CHUNK_OVERLAP,
+    DEFAULT_CHUNK_SIZE,
+    HEADERS_TO_SPLIT_ON,
+    TEXT_SPLITTERS,
+)
+from core.data_processor.markdown_splitter import MarkdownChunker
+
+WORDS = "task group cancel scope stream memory object socket thread worker event loop".split()
+
+
+def synthetic_corpus(documents: int = 200, seed: int = 0) -> t.List[str]:
+    rng = random.Random(seed)
+    corpus = []
+    for _ in range(documents):
+        parts = []
+        for section in range(rng.randint(3, 8)):
+            parts.append(f"{'#' * rng.randint(1, 3)} Section {section}\n")
+            for _ in range(rng.randint(2, 10)):
+                sentence_count = rng.randint(3, 20)
+                parts.append(
+                    " ".join(
+                        " ".join(rng.choices(WORDS, k=rng.randint(5, 15))) + "."
+                        for _ in range(sentence_count)
+                    )
+                    + "\n\n"
+                )
+            if rng.random() < 0.3:
+                parts.append("```python\n# not a header\nawait anyio.sleep(1)\n```\n\n")
+        corpus.append("".join(parts))
+    return corpus
+
+
+def load_corpus(path: str) -> t.List[str]:
+    from utils.tools import list_files
+
+    corpus = []
+    for file_path in list_files(path):
+        with open(file_path, "r", errors="ignore") as f:
+            corpus.append(f.read())
+    return corpus
+
+
+def langchain_split(corpus: t.List[str]) -> t.List[Document]:
+    md_splitter = MarkdownHeaderTextSplitter(HEADERS_TO_SPLIT_ON, strip_headers=False)
+    text_splitter = RecursiveCharacterTextSplitter(
+        separators=TEXT_SPLITTERS,
+        keep_separator="end",
+        chunk_size=DEFAULT_CHUNK_SIZE,
+        chunk_overlap=DEFAULT_CHUNK_OVERLAP,
+        is_separator_regex=True,
+    )
+    md_header_splits = []
+    for text in corpus:
+        md_header_splits += md_splitter.split_text(text=text)
+    return text_splitter.split_documents(md_header_splits)
+
+
+def chunker_split(corpus: t.List[str]) -> t.List[Document]:
+    chunker = MarkdownChunker()
+    chunks = []
+    for text in corpus:
+        chunks += chunker.split_text(text)
+    return chunks
+
+
+def measure(
+    name: str, split: t.Callable, corpus: t.List[str], repeat: int
+) -> t.Dict[str, t.Any]:
+    best = float("inf")
+    for _ in range(repeat):
+        start = time.perf_counter()
+        chunks = split(corpus)
+        best = min(best, time.perf_counter() - start)
+
+    tracemalloc.start()
+    split(corpus)
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+
+    return {
+        "name": name,
+        "chunks": len(chunks),
+        "max_chars": max(len(chunk.page_content) for chunk in chunks),
+        "seconds": best,
+        "chunks_per_second": len(chunks) / best,
+        "peak_mb": peak / 1024 / 1024,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--data", help="directory of Markdown files to split")
+    parser.add_argument("--documents", type=int, default=200)
+    parser.add_argument("--repeat", type=int, default=3)
+    args = parser.parse_args()
+
+    corpus = load_corpus(args.data) if args.data else synthetic_corpus(args.documents)
+    print(
+        f"corpus: {len(corpus)} documents, {sum(map(len, corpus)) / 1024 / 1024:.2f} MB"
+    )
+    print(
+        f"{'splitter':<12}{'chunks':>10}{'max chars':>11}{'seconds':>10}"
+        f"{'chunks/s':>12}{'peak MB':>10}"
+    )
+    for name, split in (("langchain", langchain_split), ("chunker", chunker_split)):
+        result = measure(name, split, corpus, args.repeat)
+        print(
+            f"{result['name']:<12}{result['chunks']:>10}{result['max_chars']:>11}"
+            f"{result['seconds']:>10.3f}"
+            f"{result['chunks_per_second']:>12.0f}{result['peak_mb']:>10.2f}"
+        )
+
+
+if __name__ == "__main__":
+    main()
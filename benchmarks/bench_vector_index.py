@@ -0,0 +1,603 @@
+"""
+Benchmark vector index configurations: recall@k against latency.
+
+Vectors are loaded into an embedded Milvus Lite file and a local LanceDB directory, exact ground truth is
+computed with NumPy, and every index configuration is swept over its search parameters. For each setting
+the benchmark reports recall@k, QPS, p50/p99 latency, build time, on-disk size and the resident memory
+added by the build. Everything runs offline.
+
+Vectors are also benchmarked at reduced precision (float16, bfloat16 and binary codes rescored at full
+precision). The "numpy" backend searches them exactly, so its recall loss is due to quantization alone, and
+"vec MB" is the memory of the vectors as they are searched.
+
+Usage:
+    python -m benchmarks.bench_vector_index [--vectors vectors.npy] [--queries queries.npy]
+        [--count 20000] [--dim 256] [--k 10] [--backends milvus lancedb numpy] [--json results.json]
+
+Without `--vectors`, a synthetic clustered corpus is generated. Without `--queries`, queries are perturbed
+copies of corpus vectors, so they follow the corpus distribution.
+"""
+
+import argparse
+import itertools
+import json
+import os
+import shutil
+import tempfile
+import time
+import typing as t
+from pathlib import Path
+
+os.environ.setdefault("LANCE_LOG", "error")
+os.environ.setdefault("RUST_LOG", "error")
+
+import numpy as np  # noqa: E402
+
+# A search setting: the search params of one query batch.
+Sweep = t.List[t.Dict[str, t.Any]]
+# (index type, vector precision, build params, search settings)
+IndexConfig = t.Tuple[str, str, t.Dict[str, t.Any], Sweep]
+
+
+# Index types Milvus Lite can build, it silently falls back to brute force for the others. It only stores
+# float32 vectors.
+MILVUS_LITE_INDEXES = {"FLAT", "HNSW", "HNSW_SQ", "IVF_FLAT", "IVF_SQ8"}
+
+RESCORE_FACTORS = (1, 2, 4, 10)
+
+
+def milvus_configs(dim: int) -> t.List[IndexConfig]:
+    ef_sweep = [{"ef": ef} for ef in (16, 32, 64, 128, 250)]
+    nprobe_sweep = [{"nprobe": nprobe} for nprobe in (4, 8, 16, 32, 64)]
+    hnsw = {"M": 16, "efConstruction": 200}
+    return [
+        ("FLAT", "float32", {}, [{}]),
+        # The configuration of `MilvusStorage._default_collection_index`.
+        ("HNSW", "float32", {"M": 16, "efConstruction": 500}, ef_sweep),
+        ("HNSW", "float32", hnsw, ef_sweep),
+        ("HNSW", "float32", {"M": 32, "efConstruction": 200}, ef_sweep),
+        ("HNSW_SQ", "float32", {**hnsw, "sq_type": "SQ8"}, ef_sweep),
+        ("IVF_FLAT", "float32", {"nlist": 128}, nprobe_sweep),
+        ("IVF_SQ8", "float32", {"nlist": 128}, nprobe_sweep),
+        # Milvus server only.
+        (
+            "IVF_PQ",
+            "float32",
+            {"nlist": 128, "m": _sub_vectors(dim), "nbits": 8},
+            nprobe_sweep,
+        ),
+        ("SCANN", "float32", {"nlist": 128, "with_raw_data": True}, nprobe_sweep),
+        ("HNSW", "float16", hnsw, ef_sweep),
+        ("HNSW", "bfloat16", hnsw, ef_sweep),
+        # The binary configuration of `MilvusStorage._default_collection_index`.
+        (
+            "BIN_IVF_FLAT",
+            "binary",
+            {"nlist": 128},
+            [
+                {"nprobe": nprobe, "rescore_factor": factor}
+                for nprobe in (16, 64)
+                for factor in RESCORE_FACTORS
+            ],
+        ),
+    ]
+
+
+def numpy_configs(dim: int) -> t.List[IndexConfig]:
+    return [
+        ("EXACT", "float32", {}, [{}]),
+        ("EXACT", "float16", {}, [{}]),
+        ("EXACT", "bfloat16", {}, [{}]),
+        (
+            "EXACT",
+            "binary",
+            {},
+            [{"rescore_factor": factor} for factor in RESCORE_FACTORS],
+        ),
+    ]
+
+
+def lancedb_configs(dim: int, count: int) -> t.List[IndexConfig]:
+    from core.storage.lancedb import ivf_pq_params
+
+    probe_sweep = [
+        {"nprobes": nprobes, "refine_factor": refine_factor}
+        for nprobes in (2, 8, 32)
+        for refine_factor in (None, 5)
+    ]
+    return [
+        ("FLAT", "float32", {}, [{}]),
+        # The former fixed configuration, and the one `LanceDBStorage.create_index` derives from the table.
+        ("IVF_PQ", "float32", {"num_partitions": 2, "num_sub_vectors": 4}, probe_sweep),
+        ("IVF_PQ", "float32", ivf_pq_params(count, dim), probe_sweep),
+        (
+            "IVF_PQ",
+            "float32",
+            {"num_partitions": 64, "num_sub_vectors": _sub_vectors(dim)},
+            probe_sweep,
+        ),
+        ("IVF_FLAT", "float32", {"num_partitions": 64}, probe_sweep),
+    ]
+
+
+def _sub_vectors(dim: int) -> int:
+    """
+    The largest divisor of `dim` giving sub-vectors of at least 8 dimensions.
+    """
+    return max(m for m in range(1, dim // 8 + 1) if dim % m == 0)
+
+
+def synthetic_vectors(
+    count: int, dim: int, clusters: int = 64, seed: int = 0
+) -> np.ndarray:
+    """
+    Gaussian clusters, closer to real embeddings than uniform noise.
+    """
+    rng = np.random.default_rng(seed)
+    centers = rng.standard_normal((clusters, dim)).astype(np.float32)
+    labels = rng.integers(0, clusters, size=count)
+    vectors = centers[labels] + 0.5 * rng.standard_normal((count, dim)).astype(
+        np.float32
+    )
+    return normalize(vectors)
+
+
+def perturbed_queries(
+    vectors: np.ndarray, count: int, noise: float = 0.1, seed: int = 1
+) -> np.ndarray:
+    rng = np.random.default_rng(seed)
+    picked = vectors[rng.choice(len(vectors), size=count, replace=False)]
+    return normalize(
+        picked + noise * rng.standard_normal(picked.shape).astype(np.float32)
+    )
+
+
+def normalize(vectors: np.ndarray) -> np.ndarray:
+    vectors = np.asarray(vectors, dtype=np.float32)
+    return vectors / np.maximum(np.linalg.norm(vectors, axis=1, keepdims=True), 1e-12)
+
+
+def vector_mb(count: int, dim: int, precision: str) -> float:
+    """
+    Memory of the vectors as searched, the full-precision vectors of binary codes stay on disk.
+    """
+    bits = {"float32": 32, "float16": 16, "bfloat16": 16, "binary": 1}[precision]
+    return count * -(-dim * bits // 8) / 1024 / 1024
+
+
+def dequantize(vectors: np.ndarray, precision: str) -> np.ndarray:
+    """
+    The vectors as a quantized collection compares them, encoded with `quantize_vector`.
+
+    Binary codes become ±1 vectors: their dot product ranks like the hamming distance.
+    """
+    from core.storage.milvus import quantize_vector
+
+    if precision == "float32":
+        return vectors
+    if precision == "float16":
+        return vectors.astype(np.float16).astype(np.float32)
+    if precision == "bfloat16":
+        return np.stack(
+            [quantize_vector(vector, precision) for vector in vectors]
+        ).astype(np.float32)
+    codes = np.stack(
+        [
+            np.frombuffer(quantize_vector(vector, precision), np.uint8)
+            for vector in vectors
+        ]
+    )
+    return (
+        np.unpackbits(codes, axis=1)[:, : vectors.shape[1]].astype(np.float32) * 2 - 1
+    )
+
+
+def ground_truth(
+    vectors: np.ndarray, queries: np.ndarray, k: int, batch_size: int = 256
+) -> np.ndarray:
+    """
+    Exact top-k ids by cosine similarity, computed in query batches to bound memory.
+    """
+    truth = np.empty((len(queries), k), dtype=np.int64)
+    for start in range(0, len(queries), batch_size):
+        scores = queries[start : start + batch_size] @ vectors.T
+        top = np.argpartition(-scores, k - 1, axis=1)[:, :k]
+        order = np.argsort(-np.take_along_axis(scores, top, axis=1), axis=1)
+        truth[start : start + batch_size] = np.take_along_axis(top, order, axis=1)
+    return truth
+
+
+def recall_at_k(results: t.List[t.List[int]], truth: np.ndarray) -> float:
+    k = truth.shape[1]
+    hits = sum(
+        len(set(result[:k]) & set(expected.tolist()))
+        for result, expected in zip(results, truth)
+    )
+    return hits / truth.size
+
+
+def rss_mb() -> float:
+    """
+    Resident memory of this process and its children (Milvus Lite runs as a child process), Linux only.
+    """
+    pids = [os.getpid()]
+    for pid in pids:
+        children = Path(f"/proc/{pid}/task/{pid}/children")
+        if children.exists():
+            pids += [int(child) for child in children.read_text().split()]
+    total = 0
+    for pid in pids:
+        try:
+            for line in Path(f"/proc/{pid}/status").read_text().splitlines():
+                if line.startswith("VmRSS:"):
+                    total += int(line.split()[1])
+        except FileNotFoundError:
+            continue
+    return total / 1024
+
+
+def disk_mb(path: t.Union[str, os.PathLike]) -> float:
+    path = Path(path)
+    files = [path] if path.is_file() else path.rglob("*")
+    return sum(f.stat().st_size for f in files if f.is_file()) / 1024 / 1024
+
+
+def time_queries(
+    search: t.Callable[[np.ndarray], t.List[int]], queries: np.ndarray
+) -> t.Tuple[t.List[t.List[int]], np.ndarray]:
+    """
+    Run the queries one at a time, as the service does, and record every latency.
+    """
+    search(queries[0])  # warm up
+    results, latencies = [], []
+    for query in queries:
+        start = time.perf_counter()
+        results.append(search(query))
+        latencies.append(time.perf_counter() - start)
+    return results, np.asarray(latencies)
+
+
+def report(
+    backend: str,
+    index_type: str,
+    precision: str,
+    build_params: t.Dict[str, t.Any],
+    search_params: t.Dict[str, t.Any],
+    results: t.List[t.List[int]],
+    latencies: np.ndarray,
+    truth: np.ndarray,
+    build: t.Dict[str, float],
+) -> t.Dict[str, t.Any]:
+    return {
+        "backend": backend,
+        "index": index_type,
+        "precision": precision,
+        "build_params": build_params,
+        "search_params": search_params,
+        f"recall@{truth.shape[1]}": recall_at_k(results, truth),
+        "qps": len(latencies) / latencies.sum(),
+        "p50_ms": float(np.percentile(latencies, 50) * 1000),
+        "p99_ms": float(np.percentile(latencies, 99) * 1000),
+        **build,
+    }
+
+
+def bench_milvus(
+    vectors: np.ndarray,
+    queries: np.ndarray,
+    truth: np.ndarray,
+    configs: t.List[IndexConfig],
+    workdir: Path,
+    uri: t.Optional[str] = None,
+) -> t.Iterator[t.Dict[str, t.Any]]:
+    """
+    :param uri: a Milvus server, a Milvus Lite file in `workdir` by default.
+    """
+    from pymilvus import DataType
+
+    from core.storage.milvus import (
+        VECTOR_PRECISIONS,
+        MilvusStorage,
+        quantize_rows,
+        quantize_vector,
+        rescore_hits,
+    )
+
+    db_path = workdir / "milvus.db"
+    storage = MilvusStorage(uri=uri or str(db_path))
+    rows = [
+        {"id": index, "vector": vector.tolist()} for index, vector in enumerate(vectors)
+    ]
+    k = truth.shape[1]
+    try:
+        for number, (index_type, precision, build_params, sweep) in enumerate(configs):
+            collection_name = f"bench_{number}"
+            metric_type = "HAMMING" if precision == "binary" else "COSINE"
+            # Only the vector fields, so the numbers are those of the vector index alone.
+            schema = storage.client.create_schema(auto_id=False)
+            schema.add_field("id", DataType.INT64, is_primary=True)
+            schema.add_field(
+                "vector", VECTOR_PRECISIONS[precision], dim=vectors.shape[1]
+            )
+            index_params = storage.client.prepare_index_params()
+            index_params.add_index(
+                field_name="vector",
+                metric_type=metric_type,
+                index_type=index_type,
+                index_name="vector_index",
+                params=build_params,
+            )
+            if precision == "binary":
+                schema.add_field(
+                    "full_vector",
+                    DataType.FLOAT_VECTOR,
+                    dim=vectors.shape[1],
+                    mmap_enabled=True,
+                )
+                index_params.add_index(
+                    field_name="full_vector",
+                    metric_type="COSINE",
+                    index_type="FLAT",
+                    index_name="full_vector_index",
+                )
+            memory_before = rss_mb()
+            start = time.perf_counter()
+            storage.create_collection(
+                collection_name=collection_name,
+                dimension=vectors.shape[1],
+                schema=schema,
+                index_params=index_params,
+            )
+            storage.store(
+                collection_name=collection_name, data=quantize_rows(rows, precision)
+            )
+            storage.client.flush(collection_name=collection_name)
+            storage.client.load_collection(collection_name=collection_name)
+            build = {
+                "build_s": time.perf_counter() - start,
+                "disk_mb": float("nan") if uri else disk_mb(db_path),
+                "rss_mb": rss_mb() - memory_before,
+            }
+
+            for search_params in sweep:
+                params = dict(search_params)
+                rescore_factor = params.pop("rescore_factor", None)
+
+                def search(query: np.ndarray) -> t.List[int]:
+                    hits = storage.client.search(
+                        collection_name=collection_name,
+                        data=[quantize_vector(query.tolist(), precision)],
+                        limit=k * (rescore_factor or 1),
+                        output_fields=["full_vector"] if rescore_factor else [],
+                        search_params={"metric_type": metric_type, "params": params},
+                    )[0]
+                    if rescore_factor:
+                        hits = rescore_hits(hits, query.tolist(), k)
+                    return [hit["id"] for hit in hits]
+
+                results, latencies = time_queries(search, queries)
+                yield report(
+                    "milvus",
+                    index_type,
+                    precision,
+                    build_params,
+                    search_params,
+                    results,
+                    latencies,
+                    truth,
+                    build,
+                )
+            storage.drop_collection(collection_name=collection_name)
+    finally:
+        storage.client.close()
+
+
+def bench_lancedb(
+    vectors: np.ndarray,
+    queries: np.ndarray,
+    truth: np.ndarray,
+    configs: t.List[IndexConfig],
+    workdir: Path,
+) -> t.Iterator[t.Dict[str, t.Any]]:
+    import lancedb
+    import pyarrow as pa
+    from lancedb.index import IvfFlat, IvfPq
+
+    db_path = workdir / "lancedb"
+    db = lancedb.connect(str(db_path))
+    data = pa.table(
+        {
+            "id": pa.array(np.arange(len(vectors))),
+            "vector": pa.FixedSizeListArray.from_arrays(
+                pa.array(vectors.ravel()), vectors.shape[1]
+            ),
+        }
+    )
+    k = truth.shape[1]
+    for number, (index_type, precision, build_params, sweep) in enumerate(configs):
+        collection_name = f"bench_{number}"
+        memory_before = rss_mb()
+        start = time.perf_counter()
+        table = db.create_table(collection_name, data=data, mode="overwrite")
+        if index_type != "FLAT":
+            config = IvfPq if index_type == "IVF_PQ" else IvfFlat
+            table.create_index(
+                "vector",
+                config=config(distance_type="cosine", **build_params),
+            )
+        build = {
+            "build_s": time.perf_counter() - start,
+            "disk_mb": disk_mb(db_path / f"{collection_name}.lance"),
+            "rss_mb": rss_mb() - memory_before,
+        }
+
+        for search_params in [{}] if index_type == "FLAT" else sweep:
+
+            def search(query: np.ndarray) -> t.List[int]:
+                request = table.search(query).distance_type("cosine").limit(k)
+                if "nprobes" in search_params:
+                    request = request.nprobes(search_params["nprobes"])
+                if search_params.get("refine_factor"):
+                    request = request.refine_factor(search_params["refine_factor"])
+                return request.select(["id", "_distance"]).to_arrow()["id"].to_pylist()
+
+            results, latencies = time_queries(search, queries)
+            yield report(
+                "lancedb",
+                index_type,
+                precision,
+                build_params,
+                search_params,
+                results,
+                latencies,
+                truth,
+                build,
+            )
+        db.drop_table(collection_name)
+
+
+def bench_numpy(
+    vectors: np.ndarray,
+    queries: np.ndarray,
+    truth: np.ndarray,
+    configs: t.List[IndexConfig],
+    workdir: Path,
+) -> t.Iterator[t.Dict[str, t.Any]]:
+    """
+    Exact search over quantized vectors, binary candidates are rescored against the full-precision vectors.
+    """
+    k = truth.shape[1]
+    for index_type, precision, build_params, sweep in configs:
+        start = time.perf_counter()
+        quantized = dequantize(vectors, precision)
+        build = {
+            "build_s": time.perf_counter() - start,
+            "disk_mb": float("nan"),
+            "rss_mb": float("nan"),
+        }
+
+        for search_params in sweep:
+            rescore_factor = search_params.get("rescore_factor")
+
+            def search(query: np.ndarray) -> t.List[int]:
+                scores = quantized @ dequantize(query[None], precision)[0]
+                limit = k * (rescore_factor or 1)
+                candidates = np.argpartition(-scores, limit - 1)[:limit]
+                if rescore_factor:
+                    scores = vectors[candidates] @ query
+                else:
+                    scores = scores[candidates]
+                return candidates[np.argsort(-scores)[:k]].tolist()
+
+            results, latencies = time_queries(search, queries)
+            yield report(
+                "numpy",
+                index_type,
+                precision,
+                build_params,
+                search_params,
+                results,
+                latencies,
+                truth,
+                build,
+            )
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--vectors", help=".npy file of corpus vectors")
+    parser.add_argument("--queries", help=".npy file of query vectors")
+    parser.add_argument("--count", type=int, default=20000)
+    parser.add_argument("--dim", type=int, default=256)
+    parser.add_argument("--num-queries", type=int, default=200)
+    parser.add_argument("--k", type=int, default=10)
+    parser.add_argument(
+        "--backends",
+        nargs="+",
+        default=["milvus", "lancedb", "numpy"],
+        choices=["milvus", "lancedb", "numpy"],
+    )
+    parser.add_argument(
+        "--milvus-uri",
+        help="benchmark a Milvus server instead of Milvus Lite, needed for IVF_PQ and SCANN",
+    )
+    parser.add_argument(
+        "--workdir", help="where indexes are built, a temporary directory by default"
+    )
+    parser.add_argument("--json", help="also write the results to this file")
+    args = parser.parse_args()
+
+    if args.vectors:
+        vectors = normalize(np.load(args.vectors, mmap_mode="r")[: args.count])
+    else:
+        vectors = synthetic_vectors(args.count, args.dim)
+    queries = (
+        normalize(np.load(args.queries)[: args.num_queries])
+        if args.queries
+        else perturbed_queries(vectors, args.num_queries)
+    )
+    start = time.perf_counter()
+    truth = ground_truth(vectors, queries, args.k)
+    print(
+        f"corpus: {vectors.shape[0]} x {vectors.shape[1]}, {len(queries)} queries, "
+        f"ground truth in {time.perf_counter() - start:.2f}s"
+    )
+
+    workdir = Path(args.workdir or tempfile.mkdtemp(prefix="bench_vector_index_"))
+    workdir.mkdir(parents=True, exist_ok=True)
+    dim = vectors.shape[1]
+    runs = []
+    if "milvus" in args.backends:
+        configs = milvus_configs(dim)
+        if not args.milvus_uri:
+            skipped = [
+                f"{index_type} ({precision})"
+                for index_type, precision, _, _ in configs
+                if index_type not in MILVUS_LITE_INDEXES or precision != "float32"
+            ]
+            print(f"Milvus Lite can't build {', '.join(skipped)}, use --milvus-uri.")
+            configs = [
+                config
+                for config in configs
+                if config[0] in MILVUS_LITE_INDEXES and config[1] == "float32"
+            ]
+        runs.append(
+            bench_milvus(vectors, queries, truth, configs, workdir, args.milvus_uri)
+        )
+    if "lancedb" in args.backends:
+        runs.append(
+            bench_lancedb(
+                vectors, queries, truth, lancedb_configs(dim, len(vectors)), workdir
+            )
+        )
+    if "numpy" in args.backends:
+        runs.append(bench_numpy(vectors, queries, truth, numpy_configs(dim), workdir))
+    recall = f"recall@{args.k}"
+    print(
+        f"{'backend':<9}{'index':<14}{'precision':<10}{'build params':<40}{'search params':<36}"
+        f"{recall:>10}{'qps':>9}{'p50 ms':>9}{'p99 ms':>9}{'build s':>9}{'disk MB':>9}{'rss MB':>9}"
+        f"{'vec MB':>9}"
+    )
+    results = []
+    try:
+        for result in itertools.chain(*runs):
+            result["vector_mb"] = vector_mb(len(vectors), dim, result["precision"])
+            results.append(result)
+            print(
+                f"{result['backend']:<9}{result['index']:<14}{result['precision']:<10}"
+                f"{json.dumps(result['build_params']):<40}{json.dumps(result['search_params']):<36}"
+                f"{result[recall]:>10.3f}{result['qps']:>9.0f}{result['p50_ms']:>9.2f}"
+                f"{result['p99_ms']:>9.2f}{result['build_s']:>9.2f}{result['disk_mb']:>9.1f}"
+                f"{result['rss_mb']:>9.1f}{result['vector_mb']:>9.1f}"
+            )
+    finally:
+        if not args.workdir:
+            shutil.rmtree(workdir, ignore_errors=True)
+
+    if args.json:
+        with open(args.json, "w") as f:
+            json.dump(results, f, indent=2)
+
+
+if __name__ == "__main__":
+    main()
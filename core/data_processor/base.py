@@ -1,13 +1,19 @@
+import asyncio
+import logging
+import multiprocessing
 from abc import ABC, abstractmethod
+from concurrent.futures import ProcessPoolExecutor
 import typing as t
 from functools import cached_property
 from pathlib import Path
 from os import PathLike
 
+from langchain_core.documents import Document
 from langchain_text_splitters import (
     RecursiveCharacterTextSplitter,
 )
 
+from utils.run_config import RunConfig
 from utils.tools import list_files
 from core.data_processor.constants import (
     TEXT_SPLITTERS,
@@ -16,12 +22,36 @@ from core.data_processor.constants import (
 )
 
 
+logger = logging.getLogger(__name__)
+
+# The processor installed in each worker process of the parsing pool.
+_worker_processor: t.Optional["BaseDataProcessor"] = None
+
+
+def _init_worker(processor: "BaseDataProcessor"):
+    global _worker_processor
+    _worker_processor = processor
+
+
+def _load_and_split(file_path: str) -> t.Tuple[str, t.List[Document]]:
+    return file_path, _worker_processor.load_and_split(file_path)
+
+
 class BaseDataProcessor(ABC):
     """
     interface for Data Processor.
     """
 
-    def __init__(self, file_path: t.Union[str, PathLike], **kwargs):
+    def __init__(
+        self,
+        file_path: t.Union[str, PathLike],
+        run_config: RunConfig = None,
+        **kwargs,
+    ):
+        """
+        :param file_path: a file or a directory of files to process.
+        :param run_config: `max_workers` bounds the processes used to parse files.
+        """
         file_path = file_path if isinstance(file_path, PathLike) else Path(file_path)
         if not file_path.exists():
             raise ValueError("Target: %s is not a valid path." % file_path)
@@ -30,8 +60,16 @@ class BaseDataProcessor(ABC):
             list_files(dir_path=file_path) if file_path.is_dir() else [file_path]
         )
 
+        self.run_config = run_config or RunConfig()
         self._kwargs = kwargs
 
+    def __getstate__(self):
+        # Workers only need the splitting configuration, not the file list nor the cached splitters.
+        state = self.__dict__.copy()
+        state["files"] = []
+        state.pop("text_splitter", None)
+        return state
+
     @cached_property
     def text_splitter(self) -> RecursiveCharacterTextSplitter:
         return RecursiveCharacterTextSplitter(
@@ -51,5 +89,87 @@ class BaseDataProcessor(ABC):
             delattr(self, "text_splitter")
 
     @abstractmethod
-    def process(self, **kwargs):
+    def load(self, file_path: t.Union[str, PathLike]) -> t.List[Document]:
+        """
+        Load documents from a single file.
+        """
         raise NotImplementedError("Subclass should implement this method.")
+
+    @abstractmethod
+    def split(self, documents: t.List[Document]) -> t.List[Document]:
+        """
+        Split documents of a single file into chunks.
+        """
+        raise NotImplementedError("Subclass should implement this method.")
+
+    def load_and_split(self, file_path: t.Union[str, PathLike]) -> t.List[Document]:
+        return self.split(self.load(file_path))
+
+    def iter_chunks(
+        self, files: t.Iterable[t.Union[str, PathLike]] = None
+    ) -> t.Iterator[t.Tuple[str, t.List[Document]]]:
+        """
+        Lazily load and split files one at a time, so only one file is held in memory.
+
+        :param files: the files to process, defaults to all files of the processor.
+        :return: iterator of (file path, chunks of that file).
+        """
+        for file_path in self.files if files is None else files:
+            yield str(file_path), self.load_and_split(file_path)
+
+    async def astream(
+        self, files: t.Iterable[t.Union[str, PathLike]] = None
+    ) -> t.AsyncIterator[t.Tuple[str, t.List[Document]]]:
+        """
+        Async version of `iter_chunks`, files are loaded and split in a process pool.
+
+        Results are yielded as soon as each file finishes, so the order may differ from the input order.
+        At most two files per worker are in flight, which keeps memory bounded on large corpora.
+
+        :param files: the files to process, defaults to all files of the processor.
+        :return: async iterator of (file path, chunks of that file).
+        """
+        files = iter(self.files if files is None else files)
+        max_workers = self.run_config.max_workers
+        loop = asyncio.get_running_loop()
+        executor = ProcessPoolExecutor(
+            max_workers=max_workers,
+            # Forking a process with running threads is unsafe, so workers are spawned.
+            mp_context=multiprocessing.get_context("spawn"),
+            initializer=_init_worker,
+            initargs=(self,),
+        )
+        pending = set()
+        try:
+            while True:
+                for file_path in files:
+                    pending.add(
+                        loop.run_in_executor(executor, _load_and_split, str(file_path))
+                    )
+                    if len(pending) >= max_workers * 2:
+                        break
+                if not pending:
+                    break
+                done, pending = await asyncio.wait(
+                    pending, return_when=asyncio.FIRST_COMPLETED
+                )
+                for future in done:
+                    try:
+                        result = future.result()
+                    except Exception as e:
+                        logger.exception(f"Failed to process file due to: {e}")
+                        continue
+                    yield result
+        finally:
+            for future in pending:
+                future.cancel()
+            executor.shutdown(wait=False, cancel_futures=True)
+
+    async def process(self) -> t.List[Document]:
+        """
+        Process all files, and return chunks.
+        """
+        chunks = []
+        async for _, file_chunks in self.astream():
+            chunks += file_chunks
+        return chunks
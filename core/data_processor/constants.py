@@ -11,3 +11,7 @@ TEXT_SPLITTERS = ["。", "！", "？", "\n\n", "\n"]
 
 DEFAULT_CHUNK_SIZE = 512
 DEFAULT_CHUNK_OVERLAP = 128
+
+DEFAULT_DEDUP_THRESHOLD = 0.9
+DEFAULT_MINHASH_PERMUTATIONS = 128
+DEFAULT_SHINGLE_SIZE = 5
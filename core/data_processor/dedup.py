@@ -0,0 +1,143 @@
+import hashlib
+import logging
+import re
+import typing as t
+import zlib
+
+import numpy as np
+
+from core.data_processor.constants import (
+    DEFAULT_DEDUP_THRESHOLD,
+    DEFAULT_MINHASH_PERMUTATIONS,
+    DEFAULT_SHINGLE_SIZE,
+)
+
+logger = logging.getLogger(__name__)
+
+_MERSENNE_PRIME = np.uint64((1 << 61) - 1)
+_MAX_HASH = np.uint64((1 << 32) - 1)
+_WHITESPACE = re.compile(r"\s+")
+
+
+def _lsh_params(threshold: float, num_perm: int) -> t.Tuple[int, int]:
+    """
+    Pick (bands, rows) with bands * rows <= num_perm whose S-curve threshold (1/b)^(1/r) is the closest.
+    """
+    best = (num_perm, 1)
+    for rows in range(1, num_perm + 1):
+        bands = num_perm // rows
+        if abs((1 / bands) ** (1 / rows) - threshold) < abs(
+            (1 / best[0]) ** (1 / best[1]) - threshold
+        ):
+            best = (bands, rows)
+    return best
+
+
+class ChunkDeduplicator:
+    """
+    Exact and near-duplicate chunk detection.
+
+    Exact duplicates are found by hashing the normalized text. Near duplicates are found with MinHash signatures
+    over character shingles, bucketed with LSH; a candidate is only accepted when its estimated Jaccard similarity
+    reaches `threshold`. Character shingles keep the detection working for Chinese text.
+    """
+
+    def __init__(
+        self,
+        threshold: float = DEFAULT_DEDUP_THRESHOLD,
+        num_perm: int = DEFAULT_MINHASH_PERMUTATIONS,
+        shingle_size: int = DEFAULT_SHINGLE_SIZE,
+        seed: int = 1,
+    ):
+        """
+        :param threshold: the Jaccard similarity above which two chunks are duplicates, 1.0 keeps exact dedup only.
+        :param num_perm: the number of MinHash permutations.
+        :param shingle_size: the number of characters per shingle.
+        :param seed: the seed of the MinHash permutations.
+        """
+        self.threshold = threshold
+        self.shingle_size = shingle_size
+        rng = np.random.RandomState(seed)
+        self._a = rng.randint(1, _MERSENNE_PRIME, size=num_perm, dtype=np.uint64)
+        self._b = rng.randint(0, _MERSENNE_PRIME, size=num_perm, dtype=np.uint64)
+        self.bands, self.rows = _lsh_params(threshold, num_perm)
+
+        self._exact: t.Dict[bytes, t.Hashable] = {}
+        self._buckets: t.List[t.Dict[bytes, t.List[t.Hashable]]] = [
+            {} for _ in range(self.bands)
+        ]
+        self._signatures: t.Dict[t.Hashable, np.ndarray] = {}
+        # Surviving chunk key -> every source it was seen in.
+        self.sources: t.Dict[t.Hashable, t.List[str]] = {}
+        self.duplicates = 0
+
+    @staticmethod
+    def normalize(content: str) -> str:
+        return _WHITESPACE.sub(" ", content).strip().lower()
+
+    def signature(self, content: str) -> np.ndarray:
+        """
+        MinHash signature of the character shingles of normalized content.
+        """
+        text = self.normalize(content)
+        size = self.shingle_size
+        shingles = {text[i : i + size] for i in range(max(1, len(text) - size + 1))}
+        hashes = np.fromiter(
+            (zlib.crc32(shingle.encode("utf-8")) for shingle in shingles),
+            dtype=np.uint64,
+            count=len(shingles),
+        )
+        # Universal hashing (a * x + b) mod p, one row per permutation, truncated to 32 bits.
+        permuted = (np.outer(self._a, hashes) + self._b[:, None]) % _MERSENNE_PRIME
+        return (permuted & _MAX_HASH).min(axis=1).astype(np.uint32)
+
+    def add(
+        self, key: t.Hashable, content: str, source: str
+    ) -> t.Tuple[t.Hashable, bool]:
+        """
+        Register a chunk.
+
+        :param key: the key of the chunk, e.g. its id.
+        :param content: the content of the chunk.
+        :param source: where the chunk comes from, e.g. its file path.
+        :return: the key of the surviving chunk and whether this chunk is a duplicate of it.
+        """
+        digest = hashlib.sha256(self.normalize(content).encode("utf-8")).digest()
+        survivor = self._exact.get(digest)
+
+        if survivor is None and self.threshold < 1.0:
+            signature = self.signature(content)
+            band_keys = [
+                signature[band * self.rows : (band + 1) * self.rows].tobytes()
+                for band in range(self.bands)
+            ]
+            survivor = self._near_duplicate(signature, band_keys)
+            if survivor is None:
+                self._signatures[key] = signature
+                for bucket, band_key in zip(self._buckets, band_keys):
+                    bucket.setdefault(band_key, []).append(key)
+
+        if survivor is None:
+            self._exact[digest] = key
+            self.sources[key] = [source]
+            return key, False
+
+        self.duplicates += 1
+        if source not in self.sources[survivor]:
+            self.sources[survivor].append(source)
+        return survivor, True
+
+    def _near_duplicate(
+        self, signature: np.ndarray, band_keys: t.List[bytes]
+    ) -> t.Optional[t.Hashable]:
+        candidates = {
+            candidate
+            for bucket, band_key in zip(self._buckets, band_keys)
+            for candidate in bucket.get(band_key, ())
+        }
+        best, best_similarity = None, self.threshold
+        for candidate in candidates:
+            similarity = float(np.mean(self._signatures[candidate] == signature))
+            if similarity >= best_similarity:
+                best, best_similarity = candidate, similarity
+        return best
@@ -15,15 +15,12 @@ class DocxProcessor(BaseDataProcessor, ABC):
         """
         super().__init__(file_path=file_path, **kwargs)
 
-        self.documents = []
-        for file_path in self.files:
-            self.documents = Docx2txtLoader(file_path=file_path).load()
+    def load(self, file_path: Union[str, Path]) -> List[Document]:
+        return Docx2txtLoader(file_path=file_path).load()
 
-    async def process(self) -> List[Document]:
+    def split(self, documents: List[Document]) -> List[Document]:
         """
-        Process docx file, and return chunks.
-
-        # TODO: Now only return chunks from single Document.
+        Split docx documents by characters.
         """
-        chunks = self.text_splitter.split_documents(documents=self.documents)
+        chunks = self.text_splitter.split_documents(documents=documents)
         return chunks
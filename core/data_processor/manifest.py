@@ -0,0 +1,125 @@
+import hashlib
+import json
+import logging
+import os
+import typing as t
+from pathlib import Path
+
+logger = logging.getLogger(__name__)
+
+# Milvus primary keys are signed 64-bit integers, so ids are kept in the positive half.
+_CHUNK_ID_MASK = (1 << 63) - 1
+
+
+def file_digest(file_path: t.Union[str, os.PathLike]) -> str:
+    """
+    Hash the raw content of a file.
+
+    :param file_path: the file to hash.
+    :return: the hex sha256 digest.
+    """
+    digest = hashlib.sha256()
+    with open(file_path, "rb") as f:
+        for block in iter(lambda: f.read(1 << 20), b""):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+def chunk_id(content: str) -> int:
+    """
+    Deterministic primary key of a chunk, derived from its content.
+
+    Identical chunks map to the same id, so writing them again is an idempotent upsert.
+    """
+    digest = hashlib.sha256(content.encode("utf-8")).digest()
+    return int.from_bytes(digest[:8], "big") & _CHUNK_ID_MASK
+
+
+class Manifest:
+    """
+    Per-collection record of the indexed files: file path -> content hash -> chunk ids.
+
+    A chunk id may be referenced by several files, it is only stale once no file references it anymore.
+    `metadata` records how the vectors of the collection were embedded and stored, so that searches embed
+    queries the same way.
+    """
+
+    def __init__(self, path: t.Union[str, os.PathLike]):
+        self.path = Path(path)
+        self.version = 0
+        self.files: t.Dict[str, t.Dict[str, t.Any]] = {}
+        self.metadata: t.Dict[str, t.Any] = {}
+
+    @classmethod
+    def load(cls, path: t.Union[str, os.PathLike]) -> "Manifest":
+        manifest = cls(path)
+        if manifest.path.exists():
+            with open(manifest.path, "r") as f:
+                data = json.load(f)
+            manifest.version = data.get("version", 0)
+            manifest.files = data.get("files", {})
+            manifest.metadata = data.get("metadata", {})
+        return manifest
+
+    def save(self):
+        """
+        Atomically write the manifest.
+        """
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        tmp_path = self.path.with_suffix(self.path.suffix + ".tmp")
+        with open(tmp_path, "w") as f:
+            json.dump(
+                {
+                    "version": self.version,
+                    "metadata": self.metadata,
+                    "files": self.files,
+                },
+                f,
+            )
+        os.replace(tmp_path, self.path)
+        logger.debug(f"Manifest saved to {self.path}")
+
+    def reset(self):
+        self.files = {}
+
+    def diff(
+        self, current: t.Mapping[str, str]
+    ) -> t.Tuple[t.List[str], t.List[str], t.List[str]]:
+        """
+        Compare the indexed files with the files on disk.
+
+        :param current: mapping from file path to content hash of the files on disk.
+        :return: added, modified and deleted file paths.
+        """
+        added = [path for path in current if path not in self.files]
+        modified = [
+            path
+            for path, digest in current.items()
+            if path in self.files and self.files[path]["hash"] != digest
+        ]
+        deleted = [path for path in self.files if path not in current]
+        return added, modified, deleted
+
+    def set_file(self, path: str, digest: str, chunk_ids: t.Iterable[int]):
+        self.files[path] = {"hash": digest, "chunk_ids": sorted(set(chunk_ids))}
+
+    def remove_file(self, path: str):
+        self.files.pop(path, None)
+
+    def sources(self) -> t.Dict[int, t.List[str]]:
+        """
+        Every file that references each chunk id, deduplicated chunks are referenced by all of their sources.
+        """
+        sources: t.Dict[int, t.List[str]] = {}
+        for path, entry in self.files.items():
+            for chunk_id in entry["chunk_ids"]:
+                sources.setdefault(chunk_id, []).append(path)
+        return sources
+
+    def chunk_ids(self) -> t.Set[int]:
+        """
+        All chunk ids referenced by at least one file.
+        """
+        return {
+            chunk_id for entry in self.files.values() for chunk_id in entry["chunk_ids"]
+        }
@@ -1,15 +1,14 @@
 from abc import ABC
 import typing as t
+from functools import cached_property
 from pathlib import Path
 
 from langchain_community.document_loaders import UnstructuredMarkdownLoader
 from langchain_core.documents import Document
-from langchain_text_splitters import (
-    MarkdownHeaderTextSplitter,
-)
 
 from core.data_processor.base import BaseDataProcessor
-from core.data_processor.constants import HEADERS_TO_SPLIT_ON
+from core.data_processor.constants import DEFAULT_CHUNK_OVERLAP, DEFAULT_CHUNK_SIZE
+from core.data_processor.markdown_splitter import MarkdownChunker
 
 
 class MarkdownProcessor(BaseDataProcessor, ABC):
@@ -19,23 +18,25 @@ class MarkdownProcessor(BaseDataProcessor, ABC):
         """
         super().__init__(file_path=file_path, **kwargs)
 
-        self.documents = []
-        for file_path in self.files:
-            self.documents += UnstructuredMarkdownLoader(file_path=file_path).load()
-
-        self.md_splitter = MarkdownHeaderTextSplitter(
-            HEADERS_TO_SPLIT_ON, strip_headers=False
-        )
-
-    async def process(self) -> t.List[Document]:
+    @cached_property
+    def chunker(self) -> MarkdownChunker:
         """
-        Process markdown file, and return chunks.
+        The chunker of this processor, see `MarkdownChunker.config` for what it records.
         """
-        md_header_splits = []
+        return MarkdownChunker(
+            chunk_size=self._kwargs.get("chunk_size", DEFAULT_CHUNK_SIZE),
+            chunk_overlap=self._kwargs.get("chunk_overlap", DEFAULT_CHUNK_OVERLAP),
+        )
 
-        for document in self.documents:
-            md_header_splits += self.md_splitter.split_text(text=document.page_content)
+    def set_text_splitter(self, chunk_size: int = None, chunk_overlap: int = None):
+        super().set_text_splitter(chunk_size=chunk_size, chunk_overlap=chunk_overlap)
+        self.__dict__.pop("chunker", None)
 
-        # char-level split to solve the problem of long paragraphs.
-        chunks = self.text_splitter.split_documents(md_header_splits)
-        return chunks
+    def load(self, file_path: t.Union[str, Path]) -> t.List[Document]:
+        return UnstructuredMarkdownLoader(file_path=file_path).load()
+
+    def split(self, documents: t.List[Document]) -> t.List[Document]:
+        """
+        Split markdown documents by headers and characters in a single pass.
+        """
+        return self.chunker.split_documents(documents)
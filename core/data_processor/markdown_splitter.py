@@ -0,0 +1,162 @@
+import re
+import typing as t
+from bisect import bisect_left, bisect_right
+
+from langchain_core.documents import Document
+
+from core.data_processor.constants import (
+    DEFAULT_CHUNK_OVERLAP,
+    DEFAULT_CHUNK_SIZE,
+    HEADERS_TO_SPLIT_ON,
+    TEXT_SPLITTERS,
+)
+
+_HEADER_LINE = re.compile(r"^(#{1,6})[ \t]+(.+?)[ \t#]*$", re.MULTILINE)
+_FENCE_LINE = re.compile(r"^[ \t]*(```|~~~)", re.MULTILINE)
+
+
+class MarkdownChunker:
+    """
+    Single-pass Markdown chunker working on offsets into the original text.
+
+    The text is scanned once for headers, code fences and separators. Each header section is then cut into
+    chunks of at most `chunk_size` characters, ending at the last occurrence of the highest-priority separator
+    that fits, and the next chunk starts at the first separator boundary inside the overlap. Strings are only
+    sliced when chunks are emitted.
+    """
+
+    # Bump whenever a change makes the same text split differently, collections are re-chunked on a change.
+    VERSION = 1
+
+    def __init__(
+        self,
+        chunk_size: int = DEFAULT_CHUNK_SIZE,
+        chunk_overlap: int = DEFAULT_CHUNK_OVERLAP,
+        separators: t.Sequence[str] = TEXT_SPLITTERS,
+        headers_to_split_on: t.Sequence[t.Tuple[str, str]] = HEADERS_TO_SPLIT_ON,
+    ):
+        if chunk_overlap >= chunk_size:
+            raise ValueError(
+                f"Chunk overlap ({chunk_overlap}) should be smaller than chunk size ({chunk_size})."
+            )
+        self.chunk_size = chunk_size
+        self.chunk_overlap = chunk_overlap
+        self.separators = list(separators)
+        self.header_names = {len(marker): name for marker, name in headers_to_split_on}
+        self._separator_pattern = re.compile(
+            "|".join(re.escape(separator) for separator in self.separators)
+        )
+
+    def config(self) -> t.Dict[str, t.Any]:
+        """
+        Everything that decides the chunks of a text, recorded with the collections built from them. Only JSON
+        types, so the recorded copy compares equal once loaded.
+        """
+        return {
+            "name": type(self).__name__,
+            "version": self.VERSION,
+            "chunk_size": self.chunk_size,
+            "chunk_overlap": self.chunk_overlap,
+            "separators": self.separators,
+            "headers": [
+                ["#" * level, name] for level, name in sorted(self.header_names.items())
+            ],
+        }
+
+    def _sections(self, text: str) -> t.Iterator[t.Tuple[int, int, t.Dict[str, str]]]:
+        """
+        Yield (start, end, header metadata) of every header section, ignoring headers inside code fences.
+        """
+        fences = [match.start() for match in _FENCE_LINE.finditer(text)]
+        headers: t.Dict[int, str] = {}
+        start = 0
+        for match in _HEADER_LINE.finditer(text):
+            # An odd number of fences before the header means it is inside a code block.
+            if bisect_left(fences, match.start()) % 2:
+                continue
+            level = len(match.group(1))
+            if level not in self.header_names:
+                continue
+            if match.start() > start:
+                yield start, match.start(), self._metadata(headers)
+            headers = {depth: name for depth, name in headers.items() if depth < level}
+            headers[level] = match.group(2)
+            start = match.start()
+        if start < len(text):
+            yield start, len(text), self._metadata(headers)
+
+    def _metadata(self, headers: t.Dict[int, str]) -> t.Dict[str, str]:
+        return {self.header_names[level]: header for level, header in headers.items()}
+
+    def spans(self, text: str) -> t.Iterator[t.Tuple[int, int, t.Dict[str, str]]]:
+        """
+        Yield (start, end, header metadata) of every chunk of `text`, without copying any string.
+        """
+        # Boundaries are the offsets right after each separator, one sorted list per separator priority.
+        boundaries: t.List[t.List[int]] = [[] for _ in self.separators]
+        priority = {separator: index for index, separator in enumerate(self.separators)}
+        for match in self._separator_pattern.finditer(text):
+            boundaries[priority[match.group()]].append(match.end())
+        every_boundary = sorted(offset for offsets in boundaries for offset in offsets)
+
+        for section_start, section_end, metadata in self._sections(text):
+            start = section_start
+            while start < section_end:
+                end = min(start + self.chunk_size, section_end)
+                if end < section_end:
+                    # Prefer chunks longer than the overlap, so every step makes real progress.
+                    end = (
+                        self._best_boundary(boundaries, start + self.chunk_overlap, end)
+                        or self._best_boundary(boundaries, start, end)
+                        or end
+                    )
+
+                chunk_start, chunk_end = start, end
+                while chunk_start < chunk_end and text[chunk_start].isspace():
+                    chunk_start += 1
+                while chunk_end > chunk_start and text[chunk_end - 1].isspace():
+                    chunk_end -= 1
+                if chunk_start < chunk_end:
+                    yield chunk_start, chunk_end, metadata
+
+                if end >= section_end:
+                    break
+                # Restart at the first boundary inside the overlap, or right at the end without one.
+                index = bisect_left(every_boundary, end - self.chunk_overlap)
+                next_start = (
+                    every_boundary[index] if index < len(every_boundary) else end
+                )
+                start = next_start if start < next_start < end else end
+
+    @staticmethod
+    def _best_boundary(
+        boundaries: t.List[t.List[int]], start: int, limit: int
+    ) -> t.Optional[int]:
+        """
+        The last boundary in (start, limit] of the highest-priority separator that has one.
+        """
+        for offsets in boundaries:
+            index = bisect_right(offsets, limit) - 1
+            if index >= 0 and offsets[index] > start:
+                return offsets[index]
+        return None
+
+    def split_text(
+        self, text: str, metadata: t.Dict[str, t.Any] = None
+    ) -> t.List[Document]:
+        """
+        Split text into chunk documents, with the header context and the start offset in metadata.
+        """
+        return [
+            Document(
+                page_content=text[start:end],
+                metadata={**(metadata or {}), **headers, "start_index": start},
+            )
+            for start, end, headers in self.spans(text)
+        ]
+
+    def split_documents(self, documents: t.Iterable[Document]) -> t.List[Document]:
+        chunks = []
+        for document in documents:
+            chunks += self.split_text(document.page_content, metadata=document.metadata)
+        return chunks
@@ -0,0 +1,525 @@
+import copy
+import json
+import logging
+import os
+import re
+import shutil
+import typing as t
+from abc import ABC, abstractmethod
+from collections import Counter
+from pathlib import Path
+
+import numpy as np
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_K1 = 1.2
+DEFAULT_B = 0.75
+# Pending postings are merged into the sorted arrays once they reach this fraction of them.
+DEFAULT_MERGE_RATIO = 0.25
+# Deltas saved on top of a base before they are combined into one.
+DEFAULT_MAX_DELTAS = 8
+
+# Latin words, or runs of CJK characters.
+_TOKEN = re.compile(r"[a-z0-9_]+|[㐀-鿿豈-﫿]+")
+_CJK = re.compile(r"[㐀-鿿豈-﫿]")
+
+_BASE_ARRAYS = (
+    "offsets",
+    "posting_rows",
+    "posting_tfs",
+    "doc_ids",
+    "doc_lengths",
+    "df",
+)
+_DELTA_ARRAYS = (
+    "doc_ids",
+    "doc_lengths",
+    "alive",
+    "dead_rows",
+    "terms",
+    "rows",
+    "tfs",
+    "df_terms",
+    "df_values",
+)
+
+
+class _Snapshot(t.NamedTuple):
+    """
+    The state of an index when it was last saved, what the next delta is relative to.
+    """
+
+    docs: int
+    pending: int
+    alive: np.ndarray
+    df: np.ndarray
+
+
+class BaseTokenizer(ABC):
+    """
+    interface for the tokenizers of the lexical index.
+    """
+
+    @abstractmethod
+    def tokenize(self, text: str) -> t.List[str]:
+        """
+        Split a text into terms, documents and queries go through the same tokenizer.
+        """
+        raise NotImplementedError("Subclass should implement this method.")
+
+    @property
+    def name(self) -> str:
+        return type(self).__name__
+
+
+class BigramTokenizer(BaseTokenizer):
+    """
+    Lowercased latin words, and overlapping bigrams of CJK runs, as Lucene `CJKAnalyzer` does: Chinese has no
+    word boundaries, and bigrams match words without a dictionary. A single CJK character stays a unigram.
+    """
+
+    def tokenize(self, text: str) -> t.List[str]:
+        terms = []
+        for token in _TOKEN.findall(text.lower()):
+            if len(token) > 1 and _CJK.match(token):
+                terms.extend(token[i : i + 2] for i in range(len(token) - 1))
+            else:
+                terms.append(token)
+        return terms
+
+
+class JiebaTokenizer(BaseTokenizer):
+    """
+    Chinese words segmented by jieba in search mode, which also emits the shorter words of long ones. Needs
+    `jieba`, which is not a dependency of the project.
+    """
+
+    def __init__(self):
+        import jieba
+
+        self._jieba = jieba
+
+    def tokenize(self, text: str) -> t.List[str]:
+        return [
+            word
+            for word in self._jieba.cut_for_search(text.lower())
+            if _TOKEN.fullmatch(word)
+        ]
+
+
+class BM25Index:
+    """
+    In-process inverted index scored by BM25, for lexical retrieval without Milvus' server-side BM25.
+
+    Postings are stored as CSR arrays: the postings of term i are `posting_rows[offsets[i]:offsets[i + 1]]`,
+    document rows sorted, with their term frequencies in `posting_tfs`. Documents are rows of `doc_ids`,
+    `doc_lengths` and `alive`. Added documents go to pending postings, merged into the sorted arrays once they
+    grow large, deleted documents are only marked dead until the next merge. Document frequencies are kept
+    up to date on every change, so IDF is exact.
+
+    Saved indexes are log-structured: a base holds the merged arrays, and every later save only writes a delta
+    of the documents, deletions and pending postings since the previous one. A base is only written after a
+    merge, so saving costs the size of the changes, plus an amortized share of the merges. Every save writes a
+    header listing its base and deltas, which are never modified: readers of the previous header keep working
+    until the next save removes its files. Every array is a `.npy` file, and `load` maps the base copy-on-write:
+    processes loading the same index share its pages.
+    """
+
+    def __init__(
+        self,
+        tokenizer: BaseTokenizer = None,
+        k1: float = DEFAULT_K1,
+        b: float = DEFAULT_B,
+        merge_ratio: float = DEFAULT_MERGE_RATIO,
+        max_deltas: int = DEFAULT_MAX_DELTAS,
+    ):
+        """
+        :param tokenizer: the tokenizer of documents and queries, `BigramTokenizer` by default.
+        :param k1: the term frequency saturation of BM25.
+        :param b: the document length normalization of BM25.
+        :param merge_ratio: the size of pending postings, relative to the sorted ones, that triggers a merge.
+        :param max_deltas: the number of deltas saved on top of a base that triggers their combination.
+        """
+        self.tokenizer = tokenizer or BigramTokenizer()
+        self.k1 = k1
+        self.b = b
+        self.merge_ratio = merge_ratio
+        self.max_deltas = max_deltas
+        self.vocabulary: t.Dict[str, int] = {}
+        self.offsets = np.zeros(1, dtype=np.int64)
+        self.posting_rows = np.empty(0, dtype=np.int32)
+        self.posting_tfs = np.empty(0, dtype=np.float32)
+        self.doc_ids = np.empty(0, dtype=np.int64)
+        self.doc_lengths = np.empty(0, dtype=np.float32)
+        self.alive = np.empty(0, dtype=bool)
+        self.df = np.empty(0, dtype=np.int64)
+        # Postings of the documents added since the last merge, in insertion order.
+        self._pending: t.List[t.Tuple[np.ndarray, np.ndarray, np.ndarray]] = []
+        self._pending_size = 0
+        self._rows: t.Dict[int, int] = {}
+        # The saved files: the last header, its base (None once merged since) and deltas, and the snapshots the
+        # next delta is relative to.
+        self._generation = 0
+        self._header: t.Optional[str] = None
+        self._base: t.Optional[str] = None
+        self._deltas: t.List[str] = []
+        self._base_snapshot: t.Optional[_Snapshot] = None
+        self._saved_snapshot: t.Optional[_Snapshot] = None
+
+    def __len__(self) -> int:
+        return len(self._rows)
+
+    def copy(self) -> "BM25Index":
+        """
+        A copy to change while searches keep reading this index. The posting arrays are shared, they are only
+        ever replaced, the arrays and mappings changed in place are copied.
+        """
+        index = copy.copy(self)
+        index.vocabulary = dict(self.vocabulary)
+        index.df = np.array(self.df)
+        index.alive = np.array(self.alive)
+        index._rows = dict(self._rows)
+        index._pending = list(self._pending)
+        index._deltas = list(self._deltas)
+        return index
+
+    @property
+    def header(self) -> t.Optional[str]:
+        """
+        The header of the last save or load, None for an index never saved.
+        """
+        return self._header
+
+    def _term_ids(self, terms: t.Iterable[str]) -> np.ndarray:
+        ids = [self.vocabulary.setdefault(term, len(self.vocabulary)) for term in terms]
+        if len(self.vocabulary) > len(self.df):
+            self.df = np.concatenate(
+                [self.df, np.zeros(len(self.vocabulary) - len(self.df), dtype=np.int64)]
+            )
+        return np.asarray(ids, dtype=np.int64)
+
+    def add(self, documents: t.Iterable[t.Tuple[int, str]]):
+        """
+        Index (chunk id, text) pairs, replacing the documents already indexed under the same ids.
+        """
+        # The last text of an id wins.
+        documents = list(dict(documents).items())
+        self.delete([chunk_id for chunk_id, _ in documents])
+        first_row = len(self.doc_ids)
+        lengths = []
+        for row, (chunk_id, text) in enumerate(documents, start=first_row):
+            counts = Counter(self.tokenizer.tokenize(text))
+            terms = self._term_ids(counts)
+            self.df[terms] += 1
+            self._pending.append(
+                (
+                    terms,
+                    np.full(len(terms), row, dtype=np.int32),
+                    np.fromiter(counts.values(), dtype=np.float32, count=len(counts)),
+                )
+            )
+            self._pending_size += len(terms)
+            self._rows[chunk_id] = row
+            lengths.append(sum(counts.values()))
+
+        self.doc_ids = np.concatenate(
+            [self.doc_ids, [chunk_id for chunk_id, _ in documents]]
+        ).astype(np.int64)
+        self.doc_lengths = np.concatenate([self.doc_lengths, lengths]).astype(
+            np.float32
+        )
+        self.alive = np.concatenate([self.alive, np.ones(len(documents), dtype=bool)])
+        if self._pending_size > self.merge_ratio * max(len(self.posting_rows), 1):
+            self.merge()
+
+    def delete(self, ids: t.Iterable[int]):
+        """
+        Remove documents by chunk id, unknown ids are ignored.
+        """
+        rows = [self._rows.pop(chunk_id) for chunk_id in ids if chunk_id in self._rows]
+        if not rows:
+            return
+        rows = np.asarray(rows, dtype=np.int32)
+        self.alive[rows] = False
+        terms, posting_rows, _ = self._postings()
+        np.subtract.at(self.df, terms[np.isin(posting_rows, rows)], 1)
+
+    def _postings(self) -> t.Tuple[np.ndarray, np.ndarray, np.ndarray]:
+        """
+        Every posting as (term, row, tf) arrays, sorted ones first.
+        """
+        sorted_terms = np.repeat(
+            np.arange(len(self.offsets) - 1, dtype=np.int64), np.diff(self.offsets)
+        )
+        return (
+            np.concatenate([sorted_terms, *(terms for terms, _, _ in self._pending)]),
+            np.concatenate(
+                [self.posting_rows, *(rows for _, rows, _ in self._pending)]
+            ),
+            np.concatenate([self.posting_tfs, *(tfs for _, _, tfs in self._pending)]),
+        )
+
+    def merge(self):
+        """
+        Sort the pending postings in, and drop the dead documents, renumbering rows.
+        """
+        terms, rows, tfs = self._postings()
+        keep = self.alive[rows]
+        # New row numbers of the live documents.
+        renumber = np.cumsum(self.alive, dtype=np.int64) - 1
+        terms, rows, tfs = terms[keep], renumber[rows[keep]], tfs[keep]
+        order = np.lexsort((rows, terms))
+
+        self.offsets = np.zeros(len(self.vocabulary) + 1, dtype=np.int64)
+        np.cumsum(
+            np.bincount(terms, minlength=len(self.vocabulary)), out=self.offsets[1:]
+        )
+        self.posting_rows = rows[order].astype(np.int32)
+        self.posting_tfs = tfs[order]
+        self.doc_ids = self.doc_ids[self.alive]
+        self.doc_lengths = self.doc_lengths[self.alive]
+        self.alive = np.ones(len(self.doc_ids), dtype=bool)
+        self._rows = {int(chunk_id): row for row, chunk_id in enumerate(self.doc_ids)}
+        self._pending = []
+        self._pending_size = 0
+        # Rows are renumbered, the next save writes a new base.
+        self._base = None
+
+    def idf(self, terms: np.ndarray) -> np.ndarray:
+        df = self.df[terms]
+        return np.log1p((len(self) - df + 0.5) / (df + 0.5))
+
+    def search(self, query: str, limit: int = 5) -> t.List[t.Tuple[int, float]]:
+        """
+        :return: the (chunk id, BM25 score) of the best documents containing a term of the query, best first.
+        """
+        terms = {self.vocabulary.get(term) for term in self.tokenizer.tokenize(query)}
+        terms = np.asarray(
+            sorted(term for term in terms if term is not None), dtype=np.int64
+        )
+        if not len(terms) or not len(self):
+            return []
+
+        # Terms added since the last merge only have pending postings.
+        sorted_terms = terms[terms < len(self.offsets) - 1]
+        starts, ends = self.offsets[sorted_terms], self.offsets[sorted_terms + 1]
+        rows = [self.posting_rows[start:end] for start, end in zip(starts, ends)]
+        tfs = [self.posting_tfs[start:end] for start, end in zip(starts, ends)]
+        weights = [
+            np.full(end - start, idf, dtype=np.float32)
+            for start, end, idf in zip(starts, ends, self.idf(sorted_terms))
+        ]
+        for pending_terms, pending_rows, pending_tfs in self._pending:
+            matched = np.isin(pending_terms, terms)
+            rows.append(pending_rows[matched])
+            tfs.append(pending_tfs[matched])
+            weights.append(self.idf(pending_terms[matched]).astype(np.float32))
+        rows, tfs, weights = (
+            np.concatenate(rows),
+            np.concatenate(tfs),
+            np.concatenate(weights),
+        )
+
+        average_length = self.doc_lengths[self.alive].mean() or 1.0
+        norm = self.k1 * (1 - self.b + self.b * self.doc_lengths[rows] / average_length)
+        scores = np.bincount(
+            rows,
+            weights=weights * tfs * (self.k1 + 1) / (tfs + norm),
+            minlength=len(self.doc_ids),
+        )
+        scores[~self.alive] = 0
+        matched = np.flatnonzero(scores)
+        if len(matched) > limit:
+            matched = matched[np.argpartition(-scores[matched], limit - 1)[:limit]]
+        matched = matched[np.argsort(-scores[matched], kind="stable")]
+        return [(int(self.doc_ids[row]), float(scores[row])) for row in matched]
+
+    def _snapshot(self) -> _Snapshot:
+        return _Snapshot(
+            docs=len(self.doc_ids),
+            pending=len(self._pending),
+            alive=np.array(self.alive, dtype=bool),
+            df=np.array(self.df),
+        )
+
+    def save(self, directory: t.Union[str, os.PathLike]) -> str:
+        """
+        Write the changes since the last save, or load, to a directory.
+
+        The index is merged and written as a new base when it was merged since, or was never saved; otherwise
+        only a delta is written. Files that neither this header nor the previous one need are removed.
+
+        :return: the name of the header of this save, see `load`.
+        """
+        directory = Path(directory)
+        directory.mkdir(parents=True, exist_ok=True)
+        self._generation += 1
+        if self._base is None:
+            self.merge()
+            self._base = f"base.{self._generation:06d}"
+            self._deltas = []
+            self._write_base(directory / self._base)
+            self._base_snapshot = self._snapshot()
+        elif len(self._deltas) >= self.max_deltas:
+            # Pending postings all date from the base: one delta replaces the others.
+            self._deltas = [f"delta.{self._generation:06d}"]
+            self._write_delta(directory / self._deltas[0], self._base_snapshot)
+        else:
+            self._deltas.append(f"delta.{self._generation:06d}")
+            self._write_delta(directory / self._deltas[-1], self._saved_snapshot)
+        self._saved_snapshot = self._snapshot()
+
+        header = f"index.{self._generation:06d}.json"
+        with open(directory / f"{header}.tmp", "w") as f:
+            json.dump(
+                {
+                    "tokenizer": self.tokenizer.name,
+                    "k1": self.k1,
+                    "b": self.b,
+                    "generation": self._generation,
+                    "base": self._base,
+                    "deltas": self._deltas,
+                },
+                f,
+            )
+        os.replace(directory / f"{header}.tmp", directory / header)
+        previous, self._header = self._header, header
+        self._remove_unused(directory, keep=[header, previous])
+        return header
+
+    def _write_base(self, directory: Path):
+        directory.mkdir()
+        for name in _BASE_ARRAYS:
+            np.save(directory / f"{name}.npy", getattr(self, name))
+        with open(directory / "vocabulary.json", "w") as f:
+            json.dump(list(self.vocabulary), f, ensure_ascii=False)
+
+    def _write_delta(self, directory: Path, since: _Snapshot):
+        """
+        Write what changed since `since`: the added documents and their postings, the deleted rows, and the
+        document frequencies that changed.
+        """
+        directory.mkdir()
+        pending = self._pending[since.pending :]
+        changed = np.flatnonzero(self.df[: len(since.df)] != since.df)
+        df_terms = np.concatenate([changed, np.arange(len(since.df), len(self.df))])
+        arrays = {
+            "doc_ids": self.doc_ids[since.docs :],
+            "doc_lengths": self.doc_lengths[since.docs :],
+            "alive": self.alive[since.docs :],
+            "dead_rows": np.flatnonzero(since.alive & ~self.alive[: since.docs]),
+            "terms": np.concatenate(
+                [np.empty(0, dtype=np.int64), *(terms for terms, _, _ in pending)]
+            ),
+            "rows": np.concatenate(
+                [np.empty(0, dtype=np.int32), *(rows for _, rows, _ in pending)]
+            ),
+            "tfs": np.concatenate(
+                [np.empty(0, dtype=np.float32), *(tfs for _, _, tfs in pending)]
+            ),
+            "df_terms": df_terms.astype(np.int64),
+            "df_values": self.df[df_terms],
+        }
+        for name in _DELTA_ARRAYS:
+            np.save(directory / f"{name}.npy", arrays[name])
+        with open(directory / "vocabulary.json", "w") as f:
+            json.dump(list(self.vocabulary)[len(since.df) :], f, ensure_ascii=False)
+
+    def _apply_delta(self, directory: Path):
+        arrays = {name: np.load(directory / f"{name}.npy") for name in _DELTA_ARRAYS}
+        with open(directory / "vocabulary.json", "r") as f:
+            terms = json.load(f)
+        self.vocabulary.update(
+            (term, i) for i, term in enumerate(terms, start=len(self.vocabulary))
+        )
+        self.df = np.concatenate([self.df, np.zeros(len(terms), dtype=np.int64)])
+        self.df[arrays["df_terms"]] = arrays["df_values"]
+        self.alive = np.concatenate([self.alive, arrays["alive"]])
+        self.alive[arrays["dead_rows"]] = False
+        self.doc_ids = np.concatenate([self.doc_ids, arrays["doc_ids"]])
+        self.doc_lengths = np.concatenate([self.doc_lengths, arrays["doc_lengths"]])
+        if len(arrays["terms"]):
+            self._pending.append((arrays["terms"], arrays["rows"], arrays["tfs"]))
+            self._pending_size += len(arrays["terms"])
+
+    @staticmethod
+    def _remove_unused(directory: Path, keep: t.List[t.Optional[str]]):
+        """
+        Remove the headers, bases and deltas that none of the headers in `keep` needs.
+        """
+        used = set()
+        for header in filter(None, keep):
+            with open(directory / header, "r") as f:
+                files = json.load(f)
+            used.update([header, files["base"], *files["deltas"]])
+        for path in directory.iterdir():
+            if path.name in used:
+                continue
+            if path.is_dir():
+                shutil.rmtree(path)
+            else:
+                path.unlink()
+
+    @classmethod
+    def load(
+        cls,
+        directory: t.Union[str, os.PathLike],
+        header: t.Optional[str] = None,
+        tokenizer: BaseTokenizer = None,
+        merge_ratio: float = DEFAULT_MERGE_RATIO,
+        max_deltas: int = DEFAULT_MAX_DELTAS,
+    ) -> "BM25Index":
+        """
+        Map a saved index copy-on-write, and apply its deltas.
+
+        :param directory: the directory given to `save`.
+        :param header: the header returned by `save`, the latest one by default.
+        :param tokenizer: the tokenizer the index was built with, `BigramTokenizer` by default.
+        :param merge_ratio: see `BM25Index`.
+        :param max_deltas: see `BM25Index`.
+        :raise FileNotFoundError: if the files of the header were removed by later saves.
+        """
+        directory = Path(directory)
+        if header is None:
+            headers = sorted(directory.glob("index.*.json"))
+            if not headers:
+                raise FileNotFoundError(f"No BM25 index saved in {directory}.")
+            header = headers[-1].name
+        with open(directory / header, "r") as f:
+            files = json.load(f)
+        index = cls(
+            tokenizer,
+            k1=files["k1"],
+            b=files["b"],
+            merge_ratio=merge_ratio,
+            max_deltas=max_deltas,
+        )
+        if index.tokenizer.name != files["tokenizer"]:
+            raise ValueError(
+                f"The index was built with {files['tokenizer']}, not {index.tokenizer.name}."
+            )
+        base = directory / files["base"]
+        with open(base / "vocabulary.json", "r") as f:
+            index.vocabulary = {term: i for i, term in enumerate(json.load(f))}
+        for name in _BASE_ARRAYS:
+            setattr(index, name, np.load(base / f"{name}.npy", mmap_mode="c"))
+        # A base is written right after a merge, all of its documents are alive.
+        index.alive = np.ones(len(index.doc_ids), dtype=bool)
+        index._base_snapshot = _Snapshot(
+            docs=len(index.doc_ids),
+            pending=0,
+            alive=index.alive.copy(),
+            df=np.load(base / "df.npy", mmap_mode="r"),
+        )
+        for delta in files["deltas"]:
+            index._apply_delta(directory / delta)
+        index._rows = {
+            int(index.doc_ids[row]): int(row) for row in np.flatnonzero(index.alive)
+        }
+        index._generation = files["generation"]
+        index._header = header
+        index._base = files["base"]
+        index._deltas = list(files["deltas"])
+        index._saved_snapshot = index._snapshot()
+        return index
@@ -0,0 +1,37 @@
+import heapq
+import typing as t
+
+# The k of reciprocal rank fusion, also the default of Milvus `RRFRanker`.
+DEFAULT_RRF_K = 60
+
+
+def reciprocal_rank_fusion(
+    result_lists: t.Iterable[t.Sequence[t.Any]],
+    key: t.Callable[[t.Any], t.Hashable],
+    k: int = DEFAULT_RRF_K,
+    top_k: int | None = None,
+) -> t.List[t.Tuple[t.Any, float]]:
+    """
+    Fuse ranked result lists by reciprocal rank: score(d) = sum(1 / (k + rank(d))) over the lists containing d.
+
+    Scores of separate searches aren't comparable, ranks are. Results are identified by `key`, so the same
+    document found by several lists is merged, and kept once.
+
+    :param result_lists: ranked results, best first.
+    :param key: the identity of a result, e.g. its primary key.
+    :param k: the rank constant, larger values flatten the contribution of the top ranks.
+    :param top_k: the number of results to return, all of them by default.
+    :return: (first occurrence of each result, fused score), best first.
+    """
+    scores: t.Dict[t.Hashable, float] = {}
+    first: t.Dict[t.Hashable, t.Any] = {}
+    for results in result_lists:
+        for rank, result in enumerate(results, start=1):
+            identity = key(result)
+            scores[identity] = scores.get(identity, 0.0) + 1.0 / (k + rank)
+            first.setdefault(identity, result)
+
+    if top_k is None:
+        top_k = len(scores)
+    best = heapq.nlargest(top_k, scores.items(), key=lambda item: item[1])
+    return [(first[identity], score) for identity, score in best]
@@ -1,24 +1,156 @@
 import asyncio
+import logging
+import math
+import time
+import typing as t
 from typing import List
 
 import lancedb
+import numpy as np
+import pyarrow as pa
 from lancedb import AsyncConnection, AsyncTable
-from lancedb.index import IvfPq
+from lancedb.index import FTS, IvfPq
 from lancedb.pydantic import Vector, LanceModel
-from lancedb.common import DATA
 import logfire
+
 from core.storage.base import StorageBase
+from core.storage.fusion import reciprocal_rank_fusion
+from core.storage.milvus import (
+    SearchParams,
+    rescore_hits,
+    split_batches,
+    write_report,
+)
+from core.storage.side_store import VectorSideStore
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_DIMENSION = 1536
+# Rows and bytes per Arrow RecordBatch, the batches of one write are appended in a single commit.
+DEFAULT_WRITE_BATCH_ROWS = 8192
+DEFAULT_WRITE_BATCH_BYTES = 64 * 1024 * 1024
+# PQ trains 256 centroids per sub-vector, and IVF partitions need as many rows to be meaningful.
+MIN_INDEX_ROWS = 256
+# `IN` lists of deletes are split to keep the filter expressions small.
+DELETE_BATCH_SIZE = 1000
 
 
 class Content(LanceModel):
     id: int
-    vector: Vector(1536)
+    vector: Vector(DEFAULT_DIMENSION)
     content: str
 
 
+def content_schema(dimension: int = DEFAULT_DIMENSION) -> pa.Schema:
+    """
+    Arrow schema of a collection, the same fields as `Content` with any vector dimension.
+    """
+    return pa.schema(
+        [
+            pa.field("id", pa.int64(), nullable=False),
+            pa.field("vector", pa.list_(pa.float32(), dimension)),
+            pa.field("content", pa.string()),
+        ]
+    )
+
+
+def ivf_pq_params(num_rows: int, dimension: int) -> t.Dict[str, int]:
+    """
+    IVF-PQ parameters sized to the table.
+
+    About sqrt(rows) partitions, with at least `MIN_INDEX_ROWS` rows each, and sub-vectors of 16 dimensions
+    (8 when the dimension isn't a multiple of 16), as recommended by LanceDB.
+
+    Args:
+        num_rows: The number of rows of the table.
+        dimension: The vector dimension.
+
+    Returns:
+        The `num_partitions` and `num_sub_vectors` of `IvfPq`.
+    """
+    num_partitions = max(1, min(int(math.sqrt(num_rows)), num_rows // MIN_INDEX_ROWS))
+    num_sub_vectors = next(
+        (dimension // size for size in (16, 8) if dimension % size == 0), 1
+    )
+    return {"num_partitions": num_partitions, "num_sub_vectors": num_sub_vectors}
+
+
+def to_record_batch(
+    rows: t.List[t.Dict[str, t.Any]], schema: pa.Schema
+) -> pa.RecordBatch:
+    """
+    Columnar conversion of rows, the vectors are packed into one contiguous float32 buffer.
+    """
+    columns = []
+    for field in schema:
+        if pa.types.is_fixed_size_list(field.type):
+            vectors = np.asarray([row[field.name] for row in rows], dtype=np.float32)
+            columns.append(
+                pa.FixedSizeListArray.from_arrays(
+                    pa.array(vectors.ravel()), field.type.list_size
+                )
+            )
+        else:
+            columns.append(
+                pa.array([row.get(field.name) for row in rows], type=field.type)
+            )
+    return pa.RecordBatch.from_arrays(columns, schema=schema)
+
+
+def to_hit(row: t.Dict[str, t.Any], score_field: str) -> t.Dict[str, t.Any]:
+    """
+    A result row in the shape of Milvus hits: {"id", "distance", "entity"}, higher distances are better.
+
+    LanceDB `_distance` is a cosine distance (0 for an exact match), it is turned into the cosine similarity
+    Milvus reports for its COSINE metric.
+    """
+    distance = row.pop(score_field)
+    if score_field == "_distance":
+        distance = 1.0 - distance
+    return {"id": row["id"], "distance": distance, "entity": row}
+
+
+def dense_search_args(query: t.Dict[str, t.Dict]) -> t.Dict[str, t.Any]:
+    """
+    The arguments of `LanceDBStorage.search` for the dense leg of a hybrid query.
+
+    Queries of `MilvusStorage.build_hybrid_search_query` carry Milvus search params: `nprobe` is the `nprobes`
+    of the IVF index, HNSW `ef` has no equivalent. Tables keep float32 vectors, so a quantized query is searched
+    with its full-precision "rescore" vector, and the extra candidates fetched for rescoring become the
+    `refine_factor`. Shortened vectors are searched as they are, and rescored by `hybrid_search`.
+
+    Args:
+        query: The hybrid query.
+
+    Returns:
+        The `data`, `limit`, `nprobes` and `refine_factor` of the search.
+    """
+    dense, rescore = query["dense"], query.get("rescore")
+    if "metric_type" not in dense["param"]:
+        return {"data": dense["data"], "limit": dense["limit"], **dense["param"]}
+    nprobes = dense["param"]["params"].get("nprobe")
+    if rescore is not None and rescore["anns_field"]:
+        return {
+            "data": [rescore["data"]],
+            "limit": rescore["limit"],
+            "nprobes": nprobes,
+            "refine_factor": max(dense["limit"] // rescore["limit"], 1),
+        }
+    return {
+        "data": [np.asarray(vector, dtype=np.float32) for vector in dense["data"]],
+        "limit": dense["limit"],
+        "nprobes": nprobes,
+    }
+
+
 class LanceDBStorage(StorageBase):
     """
     Storage for LanceDB. We use collection instead of table in LanceDB to make it more consistent with Milvus.
+
+    An embedded backend: tables are local directories, so a single node needs no Milvus server and searches
+    pay no network hop. Search results have the shape of Milvus hits, and `hybrid_search` takes the query of
+    `build_hybrid_search_query`, of this class or of `MilvusStorage`, so it can stand in for
+    `AsyncMilvusStorage`.
     """
 
     def __init__(self, client, **kwargs):
@@ -33,6 +165,10 @@ class LanceDBStorage(StorageBase):
     async def create_collection(
         self,
         collection_name: str,
+        dimension: int = DEFAULT_DIMENSION,
+        enable_fts: bool = True,
+        base_tokenizer: str = "simple",
+        **kwargs,
     ) -> AsyncTable:
         """
         Create a table in LanceDB. If you want to create a table with a specific index, you can use `create_index` method.
@@ -40,14 +176,30 @@ class LanceDBStorage(StorageBase):
 
         Args:
             collection_name: The name of the collection to create.
+            dimension: The vector dimension.
+            enable_fts: Whether to create the full-text index of the contents, needed by `hybrid_search`.
+                Rows added later are searched too, see `create_fts_index`.
+            base_tokenizer: The tokenizer of the full-text index, use "ngram" for CJK contents.
 
         Returns:
             The created table.
         """
-        table = await self._client.create_table(name=collection_name, schema=Content)
+        table = await self._client.create_table(
+            name=collection_name, schema=content_schema(dimension)
+        )
+        if enable_fts:
+            await self.create_fts_index(
+                collection_name=collection_name, base_tokenizer=base_tokenizer
+            )
         return table
 
-    async def create_index(self, collection_name: str, column: str):
+    async def create_index(
+        self,
+        collection_name: str,
+        column: str = "vector",
+        num_partitions: int | None = None,
+        num_sub_vectors: int | None = None,
+    ):
         """
         Create an index for the table.
         Please note that index should be created after have data in the table.
@@ -55,21 +207,47 @@ class LanceDBStorage(StorageBase):
         Args:
             collection_name: The name of the collection to create the index for.
             column: The column to create the index for.
+            num_partitions: The number of IVF partitions, derived from the table size by default.
+            num_sub_vectors: The number of PQ sub-vectors, derived from the dimension by default.
         """
-        if (await self.get_collection_size(collection_name=collection_name)) < 256:
+        num_rows = await self.get_collection_size(collection_name=collection_name)
+        if num_rows < MIN_INDEX_ROWS:
             logfire.error(
-                f"Collection {collection_name} has less than 256 data, no enough data to create index."
+                f"Collection {collection_name} has less than {MIN_INDEX_ROWS} data, no enough data to create index."
             )
             return
 
         table = await self._client.open_table(name=collection_name)
+        dimension = (await table.schema()).field(column).type.list_size
+        params = ivf_pq_params(num_rows=num_rows, dimension=dimension)
+        params["num_partitions"] = num_partitions or params["num_partitions"]
+        params["num_sub_vectors"] = num_sub_vectors or params["num_sub_vectors"]
+        logger.info(f"Creating IVF-PQ index of {collection_name} with {params}.")
 
         await table.create_index(
             column=column,
-            config=IvfPq(
-                num_partitions=2,
-                num_sub_vectors=4,
-            ),
+            config=IvfPq(distance_type="cosine", **params),
+        )
+
+    async def create_fts_index(
+        self,
+        collection_name: str,
+        column: str = "content",
+        base_tokenizer: str = "simple",
+    ):
+        """
+        Create the full-text index of a column. Rows added after the index is built are searched exhaustively
+        until the index is rebuilt or the table is optimized.
+
+        Args:
+            collection_name: The name of the collection to create the index for.
+            column: The text column to index.
+            base_tokenizer: "simple" splits on whitespace and punctuation, "ngram" suits CJK contents.
+        """
+        table = await self._client.open_table(name=collection_name)
+        await table.create_index(
+            column=column,
+            config=FTS(with_position=False, base_tokenizer=base_tokenizer),
         )
 
     async def list_collections(self):
@@ -92,55 +270,245 @@ class LanceDBStorage(StorageBase):
         We support this method to help user can customize the search logic, like `hierarchical search`.
         """
         table = await self._client.open_table(name=collection_name)
-        table.query()
         return await table.count_rows()
 
-    async def store(self, collection_name: str, data: DATA):
+    async def _write(
+        self,
+        collection_name: str,
+        data: t.List[t.Dict[str, t.Any]],
+        write: t.Callable[[AsyncTable, pa.RecordBatchReader], t.Awaitable],
+        batch_rows: int = DEFAULT_WRITE_BATCH_ROWS,
+        batch_bytes: int = DEFAULT_WRITE_BATCH_BYTES,
+    ) -> t.Dict[str, t.Any]:
         """
-        Store data.
+        Convert rows to size-bounded Arrow RecordBatches, written as one stream so the write is a single commit.
+
+        Returns:
+            Throughput statistics of the write.
+        """
+        table = await self._client.open_table(name=collection_name)
+        schema = await table.schema()
+        batches = split_batches(data, max_rows=batch_rows, max_bytes=batch_bytes)
+        reader = pa.RecordBatchReader.from_batches(
+            schema, (to_record_batch(rows, schema) for rows, _ in batches)
+        )
+
+        start = time.perf_counter()
+        failed_rows, errors = 0, []
+        try:
+            await write(table, reader)
+        except Exception as e:
+            failed_rows, errors = len(data), [e]
+        return write_report(
+            collection_name, batches, failed_rows, errors, time.perf_counter() - start
+        )
+
+    async def store(
+        self, collection_name: str, data: t.List[t.Dict[str, t.Any]], **kwargs
+    ) -> t.Dict[str, t.Any]:
+        """
+        Append rows, see `_write` for the batching options.
 
         Args:
             collection_name: The name of the collection to store the data.
-            data: The data to store.
+            data: The rows to store, with "id", "vector" and "content".
+
+        Returns:
+            Throughput statistics of the write.
         """
-        if not isinstance(data, list):
-            print(data)
-            try:
-                data = [data]
-            except Exception as e:
-                raise ValueError(f"Invalid data type: {type(data)}") from e
+        return await self._write(
+            collection_name, data, lambda table, reader: table.add(reader), **kwargs
+        )
 
-        table = await self._client.open_table(name=collection_name)
+    async def upsert(
+        self, collection_name: str, data: t.List[t.Dict[str, t.Any]], **kwargs
+    ) -> t.Dict[str, t.Any]:
+        """
+        Insert or replace rows by id.
 
-        # Due to add method design of lancedb, if we set data as list, it will be added as one item.
-        # So we need to add data one by one.
-        async with asyncio.TaskGroup() as tg:
-            for item in data:
-                tg.create_task(table.add([item]))
+        Returns:
+            Throughput statistics of the write.
+        """
+        return await self._write(
+            collection_name,
+            data,
+            lambda table, reader: (
+                table.merge_insert("id")
+                .when_matched_update_all()
+                .when_not_matched_insert_all()
+                .execute(reader)
+            ),
+            **kwargs,
+        )
+
+    async def delete(self, collection_name: str, ids: t.List[int]):
+        """
+        Delete rows by id.
+        """
+        if not ids:
+            return
+        table = await self._client.open_table(name=collection_name)
+        for start in range(0, len(ids), DELETE_BATCH_SIZE):
+            part = ids[start : start + DELETE_BATCH_SIZE]
+            await table.delete(f"id IN ({', '.join(str(int(id_)) for id_ in part)})")
 
     async def search(
         self,
         collection_name: str,
         data: List[List] | List,
         limit: int = 5,
+        nprobes: int | None = None,
+        refine_factor: int | None = None,
+        output_fields: t.Sequence[str] = ("id", "content"),
         **kwargs,
-    ):
+    ) -> t.List[t.List[t.Dict[str, t.Any]]]:
         """
-        Search relevant data.
+        Search relevant data by cosine similarity.
 
         If target table don't have index, it will exhaustively scans the entire vector space.
+
+        Args:
+            collection_name: The name of the collection to search.
+            data: The query vectors, or a single query vector.
+            limit: The number of results per query.
+            nprobes: The number of IVF partitions searched.
+            refine_factor: Fetch `limit * refine_factor` candidates and rank them again with the raw vectors,
+                which recovers the recall lost to PQ.
+            output_fields: The fields returned in the entity of every hit.
+
+        Returns:
+            The hits of every query, best first, with the cosine similarity as distance.
         """
+        if data and not isinstance(data[0], (list, tuple, np.ndarray)):
+            data = [data]
         table = await self._client.open_table(name=collection_name)
-        return await table.vector_search(query_vector=data).limit(limit=limit).to_list()
+
+        async def search_one(vector) -> t.List[t.Dict[str, t.Any]]:
+            query = table.vector_search(vector).distance_type("cosine").limit(limit)
+            if nprobes:
+                query = query.nprobes(nprobes)
+            if refine_factor:
+                query = query.refine_factor(refine_factor)
+            # Scores are selected explicitly, LanceDB will stop projecting them by default.
+            rows = await query.select([*output_fields, "_distance"]).to_list()
+            return [to_hit(row, "_distance") for row in rows]
+
+        return await asyncio.gather(*(search_one(vector) for vector in data))
+
+    async def full_text_search(
+        self,
+        collection_name: str,
+        query: str,
+        limit: int = 5,
+        output_fields: t.Sequence[str] = ("id", "content"),
+    ) -> t.List[t.Dict[str, t.Any]]:
+        """
+        BM25 search over the full-text index, see `create_fts_index`.
+
+        Returns:
+            The hits, best first, with the BM25 score as distance.
+        """
+        table = await self._client.open_table(name=collection_name)
+        rows = (
+            await table.query()
+            .nearest_to_text(query)
+            .limit(limit)
+            .select([*output_fields, "_score"])
+            .to_list()
+        )
+        return [to_hit(row, "_score") for row in rows]
+
+    async def hybrid_search(
+        self,
+        collection_name: str,
+        query: t.Dict[str, t.Dict],
+        limit: int = 5,
+        vector_store: VectorSideStore | None = None,
+    ) -> t.List[t.Dict[str, t.Any]]:
+        """
+        Vector and full-text searches run concurrently, fused by reciprocal rank as Milvus `RRFRanker` does.
+
+        Args:
+            collection_name: The name of the collection to search.
+            query: The query built by `build_hybrid_search_query`, or by `MilvusStorage.build_hybrid_search_query`,
+                see `dense_search_args`.
+            limit: The number of fused results.
+            vector_store: The full-dimension vectors of a collection of shortened vectors, the dense candidates
+                of a query with a "rescore" entry are rescored with them.
+
+        Returns:
+            The hits, best first, with the fused score as distance.
+        """
+        sparse = query["sparse"]
+        dense_hits, sparse_hits = await asyncio.gather(
+            self.search(collection_name=collection_name, **dense_search_args(query)),
+            self.full_text_search(
+                collection_name=collection_name,
+                query=sparse["data"][0],
+                limit=sparse["limit"],
+            ),
+        )
+        dense_hits = dense_hits[0]
+        rescore = query.get("rescore")
+        if rescore is not None and not rescore["anns_field"] and vector_store:
+            vectors = await asyncio.to_thread(
+                vector_store.get_many, [hit["id"] for hit in dense_hits]
+            )
+            dense_hits = rescore_hits(
+                dense_hits, rescore["data"], rescore["limit"], None, vectors
+            )
+        return [
+            {**hit, "distance": score}
+            for hit, score in reciprocal_rank_fusion(
+                [dense_hits, sparse_hits], key=lambda hit: hit["id"], top_k=limit
+            )
+        ]
+
+    @classmethod
+    def build_hybrid_search_query(
+        cls,
+        query_embedding: t.List[float],
+        query: str,
+        params: SearchParams = None,
+    ) -> t.Dict:
+        """
+        Build hybrid search query, in the shape of `MilvusStorage.build_hybrid_search_query`.
+
+        Args:
+            query_embedding: The query vector.
+            query: The query text.
+            params: The search parameters, `nprobe` and `rescore_factor` are the `nprobes` and `refine_factor`
+                of the vector search.
+        """
+        params = params or SearchParams()
+        return {
+            "dense": {
+                "data": [query_embedding],
+                "param": {
+                    "nprobes": params.nprobe,
+                    "refine_factor": params.rescore_factor,
+                },
+                "limit": params.dense_limit,
+            },
+            "sparse": {
+                "data": [query],
+                "limit": params.sparse_limit,
+            },
+        }
 
     async def hierarchical_search(self, **kwargs):
         """
         Hierarchical search relevant data.
         """
-        raise NotImplementedError
 
     async def delete_collection(self, collection_name: str):
         """
         Delete a table.
         """
         await self._client.drop_table(name=collection_name)
+
+    async def drop_collection(self, collection_name: str):
+        """
+        Delete a table, under the name of `AsyncMilvusStorage`.
+        """
+        await self.delete_collection(collection_name=collection_name)
@@ -1,6 +1,8 @@
 import logging
+import time
 import typing as t
 from abc import ABC
+from concurrent.futures import ThreadPoolExecutor, as_completed
 
 from pymilvus import (
     MilvusClient,
@@ -14,10 +16,276 @@ from pymilvus import (
 )
 from pymilvus.milvus_client import IndexParams
 
+import numpy as np
+from pydantic import BaseModel, Field
+
 from core.storage.base import StorageBase
+from core.storage.fusion import reciprocal_rank_fusion
+from core.storage.side_store import VectorSideStore
 
 logger = logging.getLogger(__name__)
 
+# Milvus rejects gRPC messages over 64MB by default, keep every write well below.
+DEFAULT_WRITE_BATCH_ROWS = 1000
+DEFAULT_WRITE_BATCH_BYTES = 16 * 1024 * 1024
+DEFAULT_WRITE_CONCURRENCY = 4
+DEFAULT_WRITE_RETRIES = 3
+
+DEFAULT_HNSW_M = 16
+DEFAULT_HNSW_EF_CONSTRUCTION = 500
+DEFAULT_SEARCH_EF = 250
+DEFAULT_SEARCH_LIMIT = 5
+# Upper bounds of the search parameters a request may set: Milvus caps top-k at 16384, and so
+# MAX_SEARCH_LIMIT * MAX_RESCORE_FACTOR candidates of a rescored dense leg.
+MAX_SEARCH_EF = 4096
+MAX_SEARCH_LIMIT = 1024
+MAX_SEARCH_NPROBE = 4096
+MAX_RESCORE_FACTOR = 16
+
+# Storage type of the dense vectors by precision. Half precision halves the memory of the vectors and their
+# index; binary keeps one bit per dimension, and its candidates are rescored against full-precision vectors
+# kept in a memory-mapped field.
+VECTOR_PRECISIONS = {
+    "float32": DataType.FLOAT_VECTOR,
+    "float16": DataType.FLOAT16_VECTOR,
+    "bfloat16": DataType.BFLOAT16_VECTOR,
+    "binary": DataType.BINARY_VECTOR,
+}
+DEFAULT_VECTOR_PRECISION = "float32"
+DEFAULT_BINARY_NLIST = 128
+DEFAULT_SEARCH_NPROBE = 16
+DEFAULT_RESCORE_FACTOR = 4
+
+
+class SearchParams(BaseModel):
+    """
+    Parameters of a hybrid search.
+    """
+
+    ef: int = Field(
+        default=DEFAULT_SEARCH_EF,
+        ge=1,
+        le=MAX_SEARCH_EF,
+        description="HNSW search breadth of the dense leg, traded between recall and latency.",
+    )
+    dense_limit: int = Field(
+        default=DEFAULT_SEARCH_LIMIT,
+        ge=1,
+        le=MAX_SEARCH_LIMIT,
+        description="Candidates returned by the dense leg.",
+    )
+    sparse_limit: int = Field(
+        default=DEFAULT_SEARCH_LIMIT,
+        ge=1,
+        le=MAX_SEARCH_LIMIT,
+        description="Candidates returned by the BM25 leg.",
+    )
+    limit: int = Field(
+        default=DEFAULT_SEARCH_LIMIT,
+        ge=1,
+        le=MAX_SEARCH_LIMIT,
+        description="Results returned after fusing both legs.",
+    )
+    nprobe: int = Field(
+        default=DEFAULT_SEARCH_NPROBE,
+        ge=1,
+        le=MAX_SEARCH_NPROBE,
+        description="IVF clusters probed by the dense leg, of binary vectors or LanceDB tables.",
+    )
+    rescore_factor: int = Field(
+        default=DEFAULT_RESCORE_FACTOR,
+        ge=1,
+        le=MAX_RESCORE_FACTOR,
+        description="Candidates per dense result rescored at full precision, of binary or shortened vectors, "
+        "or the refine factor of LanceDB tables.",
+    )
+
+
+def quantize_vector(
+    vector: t.List[float], precision: str = DEFAULT_VECTOR_PRECISION
+) -> t.Union[t.List[float], np.ndarray, bytes]:
+    """
+    Encode a full-precision vector for a vector field of `precision`, see `VECTOR_PRECISIONS`.
+    """
+    if precision == "float32":
+        return vector
+    array = np.asarray(vector, dtype=np.float32)
+    if precision == "float16":
+        return array.astype(np.float16)
+    if precision == "bfloat16":
+        # NumPy has no bfloat16 dtype, pymilvus sends raw bytes as binary vectors: queries would be rejected.
+        import ml_dtypes
+
+        return array.astype(ml_dtypes.bfloat16)
+    if precision == "binary":
+        # The sign of every dimension, hamming distance then approximates the angle.
+        return np.packbits(array > 0).tobytes()
+    raise ValueError(f"Unknown vector precision: {precision}")
+
+
+def quantize_rows(
+    data: t.List[t.Dict[str, t.Any]], precision: str = DEFAULT_VECTOR_PRECISION
+) -> t.List[t.Dict[str, t.Any]]:
+    """
+    Encode the "vector" of every row for a collection of `precision`, binary rows keep the full-precision
+    vector in "full_vector" for rescoring.
+    """
+    if precision == "float32":
+        return data
+    return [
+        {
+            **row,
+            "vector": quantize_vector(row["vector"], precision),
+            **({"full_vector": row["vector"]} if precision == "binary" else {}),
+        }
+        for row in data
+    ]
+
+
+def rescore_hits(
+    hits: t.List[t.Dict[str, t.Any]],
+    query_embedding: t.List[float],
+    limit: int,
+    field: str | None = "full_vector",
+    vectors: t.Sequence[t.Optional[t.Sequence[float]]] | None = None,
+) -> t.List[t.Dict[str, t.Any]]:
+    """
+    Rerank the candidates of a quantized or shortened search by their cosine similarity to the query at full
+    precision.
+
+    :param hits: the candidates, with their full-precision vector in the entity `field`.
+    :param query_embedding: the full-precision query vector.
+    :param limit: the number of hits to keep.
+    :param field: the entity field of the full-precision vectors.
+    :param vectors: the full-precision vectors of the hits, from a side store, instead of `field`. Hits
+        without a vector are ranked last.
+    :return: the best `limit` hits, with the cosine similarity as distance and without `field`.
+    """
+    if not hits:
+        return []
+    if vectors is None:
+        vectors = [hit["entity"][field] for hit in hits]
+    present = [index for index, vector in enumerate(vectors) if vector is not None]
+    scores = np.full(len(hits), -np.inf, dtype=np.float32)
+    if present:
+        matrix = np.asarray([vectors[index] for index in present], dtype=np.float32)
+        matrix /= np.maximum(np.linalg.norm(matrix, axis=1, keepdims=True), 1e-12)
+        query = np.asarray(query_embedding, dtype=np.float32)
+        scores[present] = matrix @ (query / max(float(np.linalg.norm(query)), 1e-12))
+    return [
+        {
+            "id": hits[index]["id"],
+            "distance": float(scores[index]),
+            "entity": {
+                key: value
+                for key, value in hits[index]["entity"].items()
+                if key != field
+            },
+        }
+        for index in np.argsort(-scores)[:limit]
+    ]
+
+
+def fuse_rescored(
+    dense_hits: t.List[t.Dict[str, t.Any]],
+    sparse_hits: t.List[t.Dict[str, t.Any]],
+    query: t.Dict[str, t.Dict],
+    limit: int,
+    vectors: t.Sequence[t.Optional[t.Sequence[float]]] | None = None,
+) -> t.List[t.Dict[str, t.Any]]:
+    """
+    Rescore the dense candidates of a hybrid search, then fuse them with the BM25 hits as `RRFRanker` does.
+
+    :param vectors: the full-precision vectors of the dense hits, when they aren't stored in Milvus.
+    """
+    rescore = query["rescore"]
+    dense_hits = rescore_hits(
+        dense_hits, rescore["data"], rescore["limit"], rescore["anns_field"], vectors
+    )
+    return [
+        {**hit, "distance": score}
+        for hit, score in reciprocal_rank_fusion(
+            [dense_hits, sparse_hits], key=lambda hit: hit["id"], top_k=limit
+        )
+    ]
+
+
+def estimate_row_bytes(row: t.Dict[str, t.Any]) -> int:
+    """
+    Rough wire size of a row: 4 bytes per vector element, utf-8 length of strings, 8 bytes for scalars.
+    """
+    size = 0
+    for value in row.values():
+        if isinstance(value, str):
+            size += len(value.encode("utf-8"))
+        elif isinstance(value, (bytes, bytearray)):
+            size += len(value)
+        elif isinstance(value, (list, tuple)):
+            size += 4 * len(value)
+        elif isinstance(value, dict):
+            size += 12 * len(value)
+        else:
+            size += 8
+    return size
+
+
+def split_batches(
+    data: t.List[t.Dict[str, t.Any]],
+    max_rows: int = DEFAULT_WRITE_BATCH_ROWS,
+    max_bytes: int = DEFAULT_WRITE_BATCH_BYTES,
+) -> t.List[t.Tuple[t.List[t.Dict[str, t.Any]], int]]:
+    """
+    Split rows into batches bounded by row count and estimated bytes.
+
+    :return: list of (rows, estimated bytes).
+    """
+    batches, current, current_bytes = [], [], 0
+    for row in data:
+        row_bytes = estimate_row_bytes(row)
+        if current and (
+            len(current) >= max_rows or current_bytes + row_bytes > max_bytes
+        ):
+            batches.append((current, current_bytes))
+            current, current_bytes = [], 0
+        current.append(row)
+        current_bytes += row_bytes
+    if current:
+        batches.append((current, current_bytes))
+    return batches
+
+
+def write_report(
+    collection_name: str,
+    batches: t.List[t.Tuple[t.List[t.Dict[str, t.Any]], int]],
+    failed_rows: int,
+    errors: t.List[Exception],
+    elapsed: float,
+) -> t.Dict[str, t.Any]:
+    """
+    Log the throughput of a batched write and re-raise its first error.
+
+    :return: throughput statistics of the write.
+    """
+    elapsed = max(elapsed, 1e-9)
+    rows = sum(len(batch) for batch, _ in batches)
+    total_bytes = sum(size for _, size in batches)
+    stats = {
+        "rows": rows,
+        "batches": len(batches),
+        "failed_rows": failed_rows,
+        "seconds": elapsed,
+        "rows_per_second": (rows - failed_rows) / elapsed,
+        "mb_per_second": total_bytes / elapsed / 1024 / 1024,
+    }
+    logger.info(
+        f"Wrote {rows} rows in {len(batches)} batches to {collection_name}: "
+        f"{stats['rows_per_second']:.1f} rows/s, {stats['mb_per_second']:.2f} MB/s."
+    )
+    if errors:
+        logger.error(f"Failed to store {failed_rows} rows due to: {errors[0]}")
+        raise errors[0]
+    return stats
+
 
 class MilvusStorage(StorageBase, ABC):
     def __init__(self, uri: str, **kwargs):
@@ -32,16 +300,26 @@ class MilvusStorage(StorageBase, ABC):
         index_params: IndexParams = None,
         enable_bm25: bool = False,
         sparse_field: str = None,
+        auto_id: bool = True,
+        precision: str = DEFAULT_VECTOR_PRECISION,
     ):
+        """
+        :param precision: the storage precision of the default schema, see `VECTOR_PRECISIONS`. Rows must
+            then be encoded with `quantize_rows`, and searches built with the same precision.
+        """
         dimension = dimension if dimension else 768
         sparse_field = sparse_field if sparse_field else "sparse"
         schema = (
             schema
             if schema
-            else MilvusStorage._default_collection_schema(dimension=dimension)
+            else MilvusStorage._default_collection_schema(
+                dimension=dimension, auto_id=auto_id, precision=precision
+            )
         )
         index_params = (
-            index_params if index_params else MilvusStorage._default_collection_index()
+            index_params
+            if index_params
+            else MilvusStorage._default_collection_index(precision=precision)
         )
 
         # TODO: Next version will refactor this part.
@@ -70,28 +348,79 @@ class MilvusStorage(StorageBase, ABC):
         )
 
     @staticmethod
-    def _default_collection_index() -> IndexParams:
+    def _default_collection_index(
+        M: int = DEFAULT_HNSW_M,
+        ef_construction: int = DEFAULT_HNSW_EF_CONSTRUCTION,
+        precision: str = DEFAULT_VECTOR_PRECISION,
+    ) -> IndexParams:
         """
         Default index params for collection. Default index is HNSW with COSINE metric.
 
+        Binary vectors get a BIN_IVF_FLAT index with HAMMING metric instead, and their full-precision vectors a
+        FLAT index, which is only read to rescore candidates.
+
         Please feel free to change the index params according to your needs.
+
+        :param M: the maximum number of neighbors per HNSW node.
+        :param ef_construction: the search breadth while building the graph.
+        :param precision: the storage precision of the vectors, see `VECTOR_PRECISIONS`.
         """
         logger.debug("Using default index params.")
-        return IndexParams(
+        index_params = IndexParams()
+        if precision == "binary":
+            index_params.add_index(
+                field_name="vector",
+                metric_type="HAMMING",
+                index_type="BIN_IVF_FLAT",
+                index_name="vector_index",
+                params={"nlist": DEFAULT_BINARY_NLIST},
+            )
+            index_params.add_index(
+                field_name="full_vector",
+                metric_type="COSINE",
+                index_type="FLAT",
+                index_name="full_vector_index",
+            )
+            return index_params
+        index_params.add_index(
             field_name="vector",
             metric_type="COSINE",
             index_type="HNSW",
             index_name="vector_index",
             # details of index params please refer to :https://milvus.io/docs/zh/index.md?tab=floating#Indexes-supported-in-Milvus
-            params={"M": 16, "efConstruction": 500},
+            params={"M": M, "efConstruction": ef_construction},
         )
+        return index_params
 
     @staticmethod
-    def _default_collection_schema(dimension: int) -> CollectionSchema:
+    def _default_collection_schema(
+        dimension: int,
+        auto_id: bool = True,
+        precision: str = DEFAULT_VECTOR_PRECISION,
+    ) -> CollectionSchema:
         """
         Default collection schema for collection. Default vector dimension is 768.
+
+        Set `auto_id` to False to provide deterministic ids, which makes `upsert` idempotent.
+
+        With binary `precision`, the full-precision vectors are kept in a memory-mapped "full_vector" field, so
+        only the binary codes stay in memory.
         """
         logger.debug("Using default collection schema.")
+        if precision not in VECTOR_PRECISIONS:
+            raise ValueError(f"Unknown vector precision: {precision}")
+        full_vector = (
+            [
+                FieldSchema(
+                    name="full_vector",
+                    dtype=DataType.FLOAT_VECTOR,
+                    dim=dimension,
+                    mmap_enabled=True,
+                )
+            ]
+            if precision == "binary"
+            else []
+        )
         return CollectionSchema(
             description="Default collection schema.",
             # this is a preserver field, store like a json string
@@ -101,13 +430,14 @@ class MilvusStorage(StorageBase, ABC):
                     name="id",
                     dtype=DataType.INT64,
                     is_primary=True,
-                    auto_id=True,
+                    auto_id=auto_id,
                 ),
                 FieldSchema(
                     name="vector",
-                    dtype=DataType.FLOAT_VECTOR,
+                    dtype=VECTOR_PRECISIONS[precision],
                     dim=dimension,
                 ),
+                *full_vector,
                 FieldSchema(
                     name="content",
                     dtype=DataType.VARCHAR,
@@ -128,12 +458,83 @@ class MilvusStorage(StorageBase, ABC):
     def get_collection_info(self, collection_name: str):
         return self.client.describe_collection(collection_name=collection_name)
 
-    def store(self, collection_name: str, data: t.List[t.Dict[str, t.Any]]):
-        try:
-            self.client.insert(collection_name=collection_name, data=data)
-        except Exception as e:
-            logger.error(f"Failed to store data due to: {e}")
-            raise e
+    def drop_collection(self, collection_name: str):
+        self.client.drop_collection(collection_name=collection_name)
+
+    def _write(
+        self,
+        method: t.Callable,
+        collection_name: str,
+        data: t.List[t.Dict[str, t.Any]],
+        batch_rows: int = DEFAULT_WRITE_BATCH_ROWS,
+        batch_bytes: int = DEFAULT_WRITE_BATCH_BYTES,
+        concurrency: int = DEFAULT_WRITE_CONCURRENCY,
+        max_retries: int = DEFAULT_WRITE_RETRIES,
+        delay: float = 1.0,
+    ) -> t.Dict[str, t.Any]:
+        """
+        Write rows in size-bounded batches with bounded concurrency, retrying each failed batch on its own.
+
+        :return: throughput statistics of the write.
+        """
+        batches = split_batches(data, max_rows=batch_rows, max_bytes=batch_bytes)
+
+        def write_batch(rows: t.List[t.Dict[str, t.Any]]):
+            for attempt in range(max_retries):
+                try:
+                    return method(collection_name=collection_name, data=rows)
+                except Exception as e:
+                    if attempt == max_retries - 1:
+                        raise
+                    logger.warning(
+                        f"Write of {len(rows)} rows failed (attempt {attempt + 1}/{max_retries}): {e}"
+                    )
+                    time.sleep(delay * 2**attempt)
+
+        start = time.perf_counter()
+        failed_rows, errors = 0, []
+        with ThreadPoolExecutor(max_workers=concurrency) as executor:
+            futures = {
+                executor.submit(write_batch, rows): len(rows) for rows, _ in batches
+            }
+            for future in as_completed(futures):
+                try:
+                    future.result()
+                except Exception as e:
+                    failed_rows += futures[future]
+                    errors.append(e)
+
+        return write_report(
+            collection_name, batches, failed_rows, errors, time.perf_counter() - start
+        )
+
+    def store(
+        self, collection_name: str, data: t.List[t.Dict[str, t.Any]], **kwargs
+    ) -> t.Dict[str, t.Any]:
+        """
+        Insert rows in size-bounded batches, see `_write` for the batching options.
+
+        :return: throughput statistics of the insert.
+        """
+        return self._write(self.client.insert, collection_name, data, **kwargs)
+
+    def upsert(
+        self, collection_name: str, data: t.List[t.Dict[str, t.Any]], **kwargs
+    ) -> t.Dict[str, t.Any]:
+        """
+        Insert or replace rows by primary key, the collection must not use auto id.
+
+        :return: throughput statistics of the upsert.
+        """
+        return self._write(self.client.upsert, collection_name, data, **kwargs)
+
+    def delete(self, collection_name: str, ids: t.List[int]):
+        """
+        Delete rows by primary key.
+        """
+        if not ids:
+            return
+        self.client.delete(collection_name=collection_name, ids=ids)
 
     def search(
         self,
@@ -174,7 +575,11 @@ class MilvusStorage(StorageBase, ABC):
         pass
 
     def hybrid_search(
-        self, collection_name: str, query: t.Dict[str, t.Dict], limit: int = 5
+        self,
+        collection_name: str,
+        query: t.Dict[str, t.Dict],
+        limit: int = 5,
+        vector_store: VectorSideStore | None = None,
     ) -> t.List[t.Dict]:
         """
         Hybrid search: search with both dense and sparse vectors.
@@ -203,6 +608,21 @@ class MilvusStorage(StorageBase, ABC):
             }
         }
         """
+        if "rescore" in query:
+            field = query["rescore"]["anns_field"]
+            dense_hits, sparse_hits = (
+                self._search_request(
+                    collection_name, query["dense"], [field] if field else []
+                ),
+                self._search_request(collection_name, query["sparse"]),
+            )
+            vectors = (
+                None
+                if field
+                else vector_store.get_many([hit["id"] for hit in dense_hits])
+            )
+            return fuse_rescored(dense_hits, sparse_hits, query, limit, vectors)
+
         dense_req, sparse_req = (
             AnnSearchRequest(**query["dense"]),
             AnnSearchRequest(**query["sparse"]),
@@ -219,23 +639,71 @@ class MilvusStorage(StorageBase, ABC):
         )
         return res[0]
 
+    def _search_request(
+        self,
+        collection_name: str,
+        request: t.Dict[str, t.Any],
+        output_fields: t.List[str] = (),
+    ) -> t.List[t.Dict[str, t.Any]]:
+        """
+        Run one leg of a hybrid search query on its own.
+        """
+        return self.client.search(
+            collection_name=collection_name,
+            anns_field=request["anns_field"],
+            data=request["data"],
+            search_params=request["param"],
+            limit=request["limit"],
+            output_fields=["id", "content", *output_fields],
+        )[0]
+
     @classmethod
     def build_hybrid_search_query(
-        cls, query_embedding: t.List[float], query: str
+        cls,
+        query_embedding: t.List[float],
+        query: str,
+        params: SearchParams = None,
+        precision: str = DEFAULT_VECTOR_PRECISION,
+        rescore_embedding: t.List[float] | None = None,
     ) -> t.Dict:
         """
         Build hybrid search query.
+
+        For binary vectors, or when `rescore_embedding` is given, the dense leg fetches `rescore_factor` times
+        more candidates, and the query gets a "rescore" entry: the candidates are rescored at full precision
+        before being fused with the BM25 hits.
+
+        :param params: the search parameters, see `SearchParams` for the defaults.
+        :param precision: the storage precision of the collection, see `VECTOR_PRECISIONS`.
+        :param rescore_embedding: the full-dimension query embedding, when `query_embedding` is shortened.
+            The full-dimension vectors of the candidates are then read from a `VectorSideStore`.
         """
-        return {
-            "dense": {
-                "data": [query_embedding],
+        params = params or SearchParams()
+        rescore = precision == "binary" or rescore_embedding is not None
+        dense_limit = params.dense_limit * (params.rescore_factor if rescore else 1)
+        if precision == "binary":
+            dense = {
+                "data": [quantize_vector(query_embedding, precision)],
+                "anns_field": "vector",
+                "param": {
+                    "metric_type": "HAMMING",
+                    "params": {"nprobe": params.nprobe},
+                },
+                "limit": dense_limit,
+            }
+        else:
+            dense = {
+                "data": [quantize_vector(query_embedding, precision)],
                 "anns_field": "vector",
                 "param": {
                     "metric_type": "COSINE",
-                    "params": {"ef": 250},
+                    # HNSW requires ef >= limit.
+                    "params": {"ef": max(params.ef, dense_limit)},
                 },
-                "limit": 5,
-            },
+                "limit": dense_limit,
+            }
+        hybrid_query = {
+            "dense": dense,
             "sparse": {
                 "data": [query],
                 "anns_field": "sparse",
@@ -243,6 +711,13 @@ class MilvusStorage(StorageBase, ABC):
                     "metric_type": "BM25",
                     "params": {"drop_ratio_build": 0.0},
                 },
-                "limit": 5,
+                "limit": params.sparse_limit,
             },
         }
+        if rescore:
+            hybrid_query["rescore"] = {
+                "data": rescore_embedding or query_embedding,
+                "anns_field": None if rescore_embedding else "full_vector",
+                "limit": params.dense_limit,
+            }
+        return hybrid_query
@@ -0,0 +1,238 @@
+import asyncio
+import itertools
+import logging
+import time
+import typing as t
+
+from pymilvus import AnnSearchRequest, AsyncMilvusClient, RRFRanker
+
+from core.storage.base import StorageBase
+from core.storage.milvus import (
+    DEFAULT_WRITE_BATCH_BYTES,
+    DEFAULT_WRITE_BATCH_ROWS,
+    DEFAULT_WRITE_CONCURRENCY,
+    DEFAULT_WRITE_RETRIES,
+    MilvusStorage,
+    fuse_rescored,
+    split_batches,
+    write_report,
+)
+from core.storage.side_store import VectorSideStore
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_POOL_SIZE = 2
+
+
+class AsyncMilvusStorage(StorageBase):
+    """
+    Async Milvus storage meant to be shared by the whole process.
+
+    Data operations (search, hybrid search, insert, upsert, delete) go through a small pool of `AsyncMilvusClient`
+    channels and never block the event loop. Collection management, which the async client doesn't cover, is
+    delegated to a `MilvusStorage` in a worker thread; it only runs at startup and on re-index.
+
+    Create it once, inside the running event loop (e.g. the FastAPI lifespan), and `close` it on shutdown.
+    """
+
+    def __init__(self, uri: str, pool_size: int = DEFAULT_POOL_SIZE, **kwargs):
+        """
+        :param uri: the Milvus uri.
+        :param pool_size: the number of gRPC channels requests are spread over.
+        """
+        super().__init__(**kwargs)
+        self._clients = [AsyncMilvusClient(uri=uri) for _ in range(pool_size)]
+        self._next_client = itertools.cycle(self._clients)
+        self._admin = MilvusStorage(uri=uri)
+
+    @property
+    def client(self) -> AsyncMilvusClient:
+        """
+        The next client of the pool, round-robin.
+        """
+        return next(self._next_client)
+
+    async def create_collection(self, **kwargs):
+        """
+        Create a collection, see `MilvusStorage.create_collection` for the parameters.
+        """
+        await asyncio.to_thread(self._admin.create_collection, **kwargs)
+
+    async def list_collections(self) -> t.List[str]:
+        return await asyncio.to_thread(self._admin.list_collections)
+
+    async def get_collection_info(self, collection_name: str):
+        return await asyncio.to_thread(
+            self._admin.get_collection_info, collection_name=collection_name
+        )
+
+    async def drop_collection(self, collection_name: str):
+        await asyncio.to_thread(
+            self._admin.drop_collection, collection_name=collection_name
+        )
+
+    async def _write(
+        self,
+        method: str,
+        collection_name: str,
+        data: t.List[t.Dict[str, t.Any]],
+        batch_rows: int = DEFAULT_WRITE_BATCH_ROWS,
+        batch_bytes: int = DEFAULT_WRITE_BATCH_BYTES,
+        concurrency: int = DEFAULT_WRITE_CONCURRENCY,
+        max_retries: int = DEFAULT_WRITE_RETRIES,
+        delay: float = 1.0,
+    ) -> t.Dict[str, t.Any]:
+        """
+        Async counterpart of `MilvusStorage._write`: size-bounded batches, bounded concurrency and
+        per-batch retries.
+        """
+        batches = split_batches(data, max_rows=batch_rows, max_bytes=batch_bytes)
+        semaphore = asyncio.Semaphore(concurrency)
+
+        async def write_batch(rows: t.List[t.Dict[str, t.Any]]):
+            async with semaphore:
+                for attempt in range(max_retries):
+                    try:
+                        return await getattr(self.client, method)(
+                            collection_name=collection_name, data=rows
+                        )
+                    except Exception as e:
+                        if attempt == max_retries - 1:
+                            raise
+                        logger.warning(
+                            f"Write of {len(rows)} rows failed (attempt {attempt + 1}/{max_retries}): {e}"
+                        )
+                        await asyncio.sleep(delay * 2**attempt)
+
+        start = time.perf_counter()
+        results = await asyncio.gather(
+            *(write_batch(rows) for rows, _ in batches), return_exceptions=True
+        )
+        errors = [result for result in results if isinstance(result, Exception)]
+        failed_rows = sum(
+            len(rows)
+            for (rows, _), result in zip(batches, results)
+            if isinstance(result, Exception)
+        )
+        return write_report(
+            collection_name, batches, failed_rows, errors, time.perf_counter() - start
+        )
+
+    async def store(
+        self, collection_name: str, data: t.List[t.Dict[str, t.Any]], **kwargs
+    ) -> t.Dict[str, t.Any]:
+        """
+        Insert rows in size-bounded batches.
+
+        :return: throughput statistics of the insert.
+        """
+        return await self._write("insert", collection_name, data, **kwargs)
+
+    async def upsert(
+        self, collection_name: str, data: t.List[t.Dict[str, t.Any]], **kwargs
+    ) -> t.Dict[str, t.Any]:
+        """
+        Insert or replace rows by primary key, the collection must not use auto id.
+
+        :return: throughput statistics of the upsert.
+        """
+        return await self._write("upsert", collection_name, data, **kwargs)
+
+    async def delete(self, collection_name: str, ids: t.List[int]):
+        """
+        Delete rows by primary key.
+        """
+        if not ids:
+            return
+        await self.client.delete(collection_name=collection_name, ids=ids)
+
+    async def search(
+        self,
+        collection_name: str,
+        anns_field: str | None,
+        data: t.List[t.List] | t.List,
+        search_params: t.Dict[str, t.Any],
+        output_fields: t.List[str],
+        consistency_level: str = "Bounded",
+        limit: int = 5,
+        **kwargs,
+    ) -> t.List[t.List[t.Dict[str, t.Any]]]:
+        """
+        Dense vector search, see `MilvusStorage.search` for the parameters.
+        """
+        return await self.client.search(
+            collection_name=collection_name,
+            anns_field=anns_field if anns_field else "vector",
+            data=data,
+            search_params=search_params,
+            limit=limit,
+            output_fields=output_fields,
+            consistency_level=consistency_level,
+        )
+
+    async def hierarchical_search(self, **kwargs):
+        pass
+
+    async def _search_request(
+        self,
+        collection_name: str,
+        request: t.Dict[str, t.Any],
+        output_fields: t.List[str] = (),
+    ) -> t.List[t.Dict[str, t.Any]]:
+        """
+        Run one leg of a hybrid search query on its own.
+        """
+        res = await self.client.search(
+            collection_name=collection_name,
+            anns_field=request["anns_field"],
+            data=request["data"],
+            search_params=request["param"],
+            limit=request["limit"],
+            output_fields=["id", "content", *output_fields],
+        )
+        return res[0]
+
+    async def hybrid_search(
+        self,
+        collection_name: str,
+        query: t.Dict[str, t.Dict],
+        limit: int = 5,
+        vector_store: VectorSideStore | None = None,
+    ) -> t.List[t.Dict]:
+        """
+        Hybrid search with both dense and sparse vectors, `query` is built by
+        `MilvusStorage.build_hybrid_search_query`.
+        """
+        if "rescore" in query:
+            field = query["rescore"]["anns_field"]
+            dense_hits, sparse_hits = await asyncio.gather(
+                self._search_request(
+                    collection_name, query["dense"], [field] if field else []
+                ),
+                self._search_request(collection_name, query["sparse"]),
+            )
+            vectors = (
+                None
+                if field
+                else await asyncio.to_thread(
+                    vector_store.get_many, [hit["id"] for hit in dense_hits]
+                )
+            )
+            return fuse_rescored(dense_hits, sparse_hits, query, limit, vectors)
+
+        res = await self.client.hybrid_search(
+            collection_name=collection_name,
+            output_fields=["id", "content"],
+            reqs=[
+                AnnSearchRequest(**query["dense"]),
+                AnnSearchRequest(**query["sparse"]),
+            ],
+            ranker=RRFRanker(),
+            limit=limit,
+        )
+        return res[0]
+
+    async def close(self):
+        for client in self._clients:
+            await client.close()
+        self._admin.client.close()
@@ -0,0 +1,613 @@
+import asyncio
+import functools
+import json
+import logging
+import os
+import shutil
+import threading
+import typing as t
+from pathlib import Path
+
+import numpy as np
+
+from core.storage.base import StorageBase
+from core.storage.bm25 import BaseTokenizer, BM25Index
+from core.storage.fusion import reciprocal_rank_fusion
+from core.storage.side_store import VectorSideStore
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_MAX_SEGMENTS = 8
+DEFAULT_COMPACT_RATIO = 0.2
+# Queries scored per matrix product, bounds the (rows x queries) score matrix.
+DEFAULT_QUERY_BATCH = 256
+# Attempts to open a collection whose files are removed by a concurrent write.
+DEFAULT_LOAD_RETRIES = 3
+
+
+def _normalize(vectors: np.ndarray) -> np.ndarray:
+    return vectors / np.maximum(np.linalg.norm(vectors, axis=1, keepdims=True), 1e-12)
+
+
+def _save_atomic(path: Path, array: np.ndarray):
+    tmp_path = path.with_suffix(".tmp.npy")
+    np.save(tmp_path, array)
+    os.replace(tmp_path, path)
+
+
+class Segment:
+    """
+    An immutable batch of rows: unit float32 vectors, their chunk ids, and their contents as one utf-8 blob
+    sliced by a parallel array of offsets. Every file is memory-mapped read-only, so processes mapping the
+    same segment share its pages.
+    """
+
+    def __init__(self, directory: Path, seq: int):
+        self.seq = seq
+        prefix = directory / f"{seq:06d}"
+        self.vectors = np.load(f"{prefix}.vectors.npy", mmap_mode="r")
+        self.ids = np.load(f"{prefix}.ids.npy", mmap_mode="r")
+        self.offsets = np.load(f"{prefix}.offsets.npy", mmap_mode="r")
+        contents = Path(f"{prefix}.contents.bin")
+        # An empty file can't be mapped.
+        self.contents = (
+            np.memmap(contents, dtype=np.uint8, mode="r")
+            if contents.stat().st_size
+            else np.empty(0, dtype=np.uint8)
+        )
+
+    @staticmethod
+    def write(
+        directory: Path,
+        seq: int,
+        vectors: np.ndarray,
+        ids: np.ndarray,
+        contents: t.List[str],
+    ):
+        prefix = directory / f"{seq:06d}"
+        encoded = [content.encode("utf-8") for content in contents]
+        offsets = np.zeros(len(encoded) + 1, dtype=np.int64)
+        np.cumsum([len(blob) for blob in encoded], out=offsets[1:])
+        with open(f"{prefix}.contents.bin", "wb") as f:
+            f.write(b"".join(encoded))
+        _save_atomic(Path(f"{prefix}.offsets.npy"), offsets)
+        _save_atomic(Path(f"{prefix}.ids.npy"), ids.astype(np.int64))
+        _save_atomic(Path(f"{prefix}.vectors.npy"), vectors.astype(np.float32))
+
+    @staticmethod
+    def remove(directory: Path, seq: int):
+        for suffix in ("vectors.npy", "ids.npy", "offsets.npy", "contents.bin"):
+            Path(directory / f"{seq:06d}.{suffix}").unlink(missing_ok=True)
+
+    def content(self, row: int) -> str:
+        return bytes(self.contents[self.offsets[row] : self.offsets[row + 1]]).decode(
+            "utf-8"
+        )
+
+    def __len__(self) -> int:
+        return len(self.ids)
+
+
+class _Collection:
+    """
+    The mapped segments of a collection, as listed by its manifest file.
+
+    The manifest lists the live segments, and tombstones: chunk id -> the first segment not affected by the
+    deletion of the chunk. Upserted rows are written to a segment after their tombstone, so they stay alive.
+    Collections with full-text search also name the header of their BM25 index in `bm25/`, saved on every
+    write, see `BM25Index.save`.
+
+    Files are removed one write late, so readers of the previous manifest can still open it: segments merged by
+    a compaction are retired, and only removed by the next one.
+    """
+
+    def __init__(
+        self,
+        directory: Path,
+        tokenizer: BaseTokenizer = None,
+        bm25: t.Optional[BM25Index] = None,
+    ):
+        """
+        :param bm25: a BM25 index already in memory, used instead of loading it when the manifest names it.
+        """
+        self.directory = directory
+        self.path = directory / "collection.json"
+        self.version = self._version()
+        with open(self.path, "r") as f:
+            manifest = json.load(f)
+        self.dimension: int = manifest["dimension"]
+        self.next_segment: int = manifest["next_segment"]
+        self.tombstones: t.Dict[int, int] = {
+            int(chunk_id): seq for chunk_id, seq in manifest["tombstones"].items()
+        }
+        self.segments = [Segment(directory, seq) for seq in manifest["segments"]]
+        self.retired: t.List[int] = manifest.get("retired", [])
+        self.fts: bool = manifest.get("fts", False)
+        self.bm25_name: t.Optional[str] = manifest.get("bm25")
+        self.bm25 = None
+        if bm25 is not None and bm25.header == self.bm25_name:
+            # The writer just saved this index, and readers may already have it loaded.
+            self.bm25 = bm25
+        elif self.bm25_name:
+            self.bm25 = BM25Index.load(directory / "bm25", self.bm25_name, tokenizer)
+        elif self.fts:
+            self.bm25 = BM25Index(tokenizer)
+        # Per segment, True for rows that are deleted or replaced.
+        self.dead = [self._dead_rows(segment) for segment in self.segments]
+
+    def _dead_rows(self, segment: Segment) -> np.ndarray:
+        deleted = [
+            chunk_id for chunk_id, seq in self.tombstones.items() if seq > segment.seq
+        ]
+        return np.isin(segment.ids, np.asarray(deleted, dtype=np.int64))
+
+    @staticmethod
+    def save(
+        directory: Path,
+        dimension: int,
+        segments: t.List[int],
+        next_segment: int,
+        tombstones: t.Dict[int, int],
+        fts: bool = False,
+        bm25: t.Optional[str] = None,
+        retired: t.Sequence[int] = (),
+    ):
+        """
+        Atomically write the manifest, readers switch to the new segments on their next search.
+        """
+        tmp_path = directory / "collection.json.tmp"
+        with open(tmp_path, "w") as f:
+            json.dump(
+                {
+                    "dimension": dimension,
+                    "segments": segments,
+                    "next_segment": next_segment,
+                    "tombstones": {
+                        str(chunk_id): seq for chunk_id, seq in tombstones.items()
+                    },
+                    "fts": fts,
+                    "bm25": bm25,
+                    "retired": list(retired),
+                },
+                f,
+            )
+        os.replace(tmp_path, directory / "collection.json")
+
+    def _version(self) -> t.Tuple[int, int]:
+        # The manifest is replaced, not rewritten, so a new inode is a new version.
+        stat = self.path.stat()
+        return stat.st_ino, stat.st_mtime_ns
+
+    def stale(self) -> bool:
+        return self._version() != self.version
+
+    def live_rows(self) -> int:
+        return sum(len(segment) - int(dead.sum()) for segment, dead in self.live())
+
+    def live(self) -> t.Iterator[t.Tuple[Segment, np.ndarray]]:
+        return zip(self.segments, self.dead)
+
+    @functools.cached_property
+    def rows(self) -> t.Dict[int, t.Tuple[Segment, int]]:
+        """
+        The segment and row of every live chunk id.
+        """
+        return {
+            int(segment.ids[row]): (segment, int(row))
+            for segment, dead in self.live()
+            for row in np.flatnonzero(~dead)
+        }
+
+
+class NumpyStorage(StorageBase):
+    """
+    In-process vector store: a collection is a directory of memory-mapped float32 matrices.
+
+    Rows are appended as immutable segments and never modified, deletions are tombstones. Once there are more
+    than `max_segments` segments, or more than `compact_ratio` of the rows are dead, the live rows are merged
+    into a single segment. Top-k is one matrix product per segment plus `argpartition`, queries are scored
+    together, by batches of `DEFAULT_QUERY_BATCH`.
+
+    Vectors are normalized on write and scored by cosine similarity. Contents are indexed by an in-process
+    `BM25Index` unless `enable_fts` is off. Results have the shape of Milvus hits, and `hybrid_search` takes
+    the query of `MilvusStorage.build_hybrid_search_query`, so it can stand in for `AsyncMilvusStorage`.
+
+    One process writes, any number of processes (e.g. uvicorn workers) open the same directory with
+    `read_only=True`: the mapped pages are shared, and readers pick up new segments from the manifest.
+    """
+
+    def __init__(
+        self,
+        root: t.Union[str, os.PathLike],
+        read_only: bool = False,
+        max_segments: int = DEFAULT_MAX_SEGMENTS,
+        compact_ratio: float = DEFAULT_COMPACT_RATIO,
+        tokenizer: BaseTokenizer = None,
+        **kwargs,
+    ):
+        """
+        :param root: the directory of the collections.
+        :param read_only: whether this process only searches, writes then raise.
+        :param max_segments: the number of segments that triggers a compaction.
+        :param compact_ratio: the fraction of dead rows that triggers a compaction.
+        :param tokenizer: the tokenizer of full-text search, `BigramTokenizer` by default.
+        """
+        super().__init__(**kwargs)
+        self.root = Path(root)
+        self.read_only = read_only
+        self.max_segments = max_segments
+        self.compact_ratio = compact_ratio
+        self.tokenizer = tokenizer
+        self._collections: t.Dict[str, _Collection] = {}
+        self._lock = threading.Lock()
+
+    def _collection(
+        self, collection_name: str, bm25: t.Optional[BM25Index] = None
+    ) -> _Collection:
+        """
+        The collection as its manifest currently lists it, reloaded when the manifest changed.
+
+        :param bm25: the BM25 index the writer just saved, by default the one of the collection is reused if
+            it is still current.
+        """
+        collection = self._collections.get(collection_name)
+        if collection is None or collection.stale():
+            if bm25 is None and collection is not None:
+                bm25 = collection.bm25
+            for attempt in range(DEFAULT_LOAD_RETRIES):
+                try:
+                    collection = _Collection(
+                        self.root / collection_name, self.tokenizer, bm25=bm25
+                    )
+                    break
+                except FileNotFoundError:
+                    # Files of a manifest two writes old are removed, the current one names newer files.
+                    if attempt == DEFAULT_LOAD_RETRIES - 1:
+                        raise
+            self._collections[collection_name] = collection
+        return collection
+
+    def _check_writable(self):
+        if self.read_only:
+            raise PermissionError("This NumpyStorage is read-only.")
+
+    async def create_collection(
+        self,
+        collection_name: str,
+        dimension: int = 1536,
+        enable_fts: bool = True,
+        **kwargs,
+    ):
+        """
+        Create an empty collection, other Milvus options are accepted and ignored.
+
+        :param collection_name: the name of the collection.
+        :param dimension: the dimension of the vectors.
+        :param enable_fts: whether to index contents for full-text search.
+        """
+        self._check_writable()
+        directory = self.root / collection_name
+        directory.mkdir(parents=True, exist_ok=False)
+        _Collection.save(
+            directory,
+            dimension,
+            segments=[],
+            next_segment=0,
+            tombstones={},
+            fts=enable_fts,
+        )
+
+    async def list_collections(self) -> t.List[str]:
+        if not self.root.exists():
+            return []
+        return sorted(
+            path.name
+            for path in self.root.iterdir()
+            if (path / "collection.json").exists()
+        )
+
+    async def get_collection_info(self, collection_name: str) -> t.Dict[str, t.Any]:
+        collection = self._collection(collection_name)
+        return {
+            "dimension": collection.dimension,
+            "segments": len(collection.segments),
+            "rows": collection.live_rows(),
+        }
+
+    async def drop_collection(self, collection_name: str):
+        self._check_writable()
+        directory = self.root / collection_name
+        self._collections.pop(collection_name, None)
+        shutil.rmtree(directory)
+
+    def _write(
+        self,
+        collection_name: str,
+        data: t.List[t.Dict[str, t.Any]],
+        delete_ids: t.Iterable[int] = (),
+    ) -> t.Dict[str, t.Any]:
+        self._check_writable()
+        with self._lock:
+            collection = self._collection(collection_name)
+            seq = collection.next_segment
+            tombstones = dict(collection.tombstones)
+            tombstones.update((int(chunk_id), seq) for chunk_id in delete_ids)
+            segments = [segment.seq for segment in collection.segments]
+            if data:
+                # A segment holds one row per id: within a write, the last row of an id wins.
+                data = list({int(row["id"]): row for row in data}.values())
+                vectors = np.asarray([row["vector"] for row in data], dtype=np.float32)
+                if vectors.shape[1] != collection.dimension:
+                    raise ValueError(
+                        f"Expected vectors of dimension {collection.dimension}, got {vectors.shape[1]}."
+                    )
+                Segment.write(
+                    collection.directory,
+                    seq,
+                    vectors=_normalize(vectors),
+                    ids=np.asarray([row["id"] for row in data], dtype=np.int64),
+                    contents=[row.get("content", "") for row in data],
+                )
+                segments.append(seq)
+            bm25, bm25_name = None, collection.bm25_name
+            if collection.bm25 is not None:
+                # Searches keep reading the published index, the changes go to a copy published with the
+                # manifest, together with the rows it refers to.
+                bm25 = collection.bm25.copy()
+                bm25.delete(delete_ids)
+                bm25.add((row["id"], row.get("content", "")) for row in data)
+                bm25_name = bm25.save(collection.directory / "bm25")
+            _Collection.save(
+                collection.directory,
+                collection.dimension,
+                segments=segments,
+                next_segment=seq + 1,
+                tombstones=tombstones,
+                fts=collection.fts,
+                bm25=bm25_name,
+                retired=collection.retired,
+            )
+            collection = self._collection(collection_name, bm25=bm25)
+
+            total = sum(len(segment) for segment in collection.segments)
+            if len(collection.segments) > self.max_segments or (
+                total and total - collection.live_rows() > self.compact_ratio * total
+            ):
+                self._compact(collection_name)
+        return {"rows": len(data), "batches": 1 if data else 0, "failed_rows": 0}
+
+    def _compact(self, collection_name: str):
+        """
+        Merge the live rows of every segment into one, and drop the tombstones they consumed.
+        """
+        collection = self._collection(collection_name)
+        seq = collection.next_segment
+        live = [(segment, ~dead) for segment, dead in collection.live()]
+        vectors = [segment.vectors[keep] for segment, keep in live]
+        ids = [segment.ids[keep] for segment, keep in live]
+        contents = [
+            segment.content(row)
+            for segment, keep in live
+            for row in np.flatnonzero(keep)
+        ]
+        segments = []
+        if contents:
+            Segment.write(
+                collection.directory,
+                seq,
+                vectors=np.concatenate(vectors),
+                ids=np.concatenate(ids),
+                contents=contents,
+            )
+            segments.append(seq)
+        _Collection.save(
+            collection.directory,
+            collection.dimension,
+            segments=segments,
+            next_segment=seq + 1,
+            tombstones={},
+            fts=collection.fts,
+            bm25=collection.bm25_name,
+            retired=[segment.seq for segment in collection.segments],
+        )
+        # Readers of the previous manifest may not have mapped the merged segments yet, only those retired by
+        # the previous compaction are removed. Mapped files stay alive until their readers refresh.
+        for seq in collection.retired:
+            Segment.remove(collection.directory, seq)
+        logger.info(
+            f"Compacted {len(collection.segments)} segments of {collection_name} into {len(contents)} rows."
+        )
+
+    async def store(
+        self, collection_name: str, data: t.List[t.Dict[str, t.Any]], **kwargs
+    ) -> t.Dict[str, t.Any]:
+        """
+        Append rows with "id", "vector" and "content" as a new segment.
+
+        :return: statistics of the write.
+        """
+        return await asyncio.to_thread(self._write, collection_name, data)
+
+    async def upsert(
+        self, collection_name: str, data: t.List[t.Dict[str, t.Any]], **kwargs
+    ) -> t.Dict[str, t.Any]:
+        """
+        Insert or replace rows by id.
+
+        :return: statistics of the write.
+        """
+        return await asyncio.to_thread(
+            self._write, collection_name, data, [row["id"] for row in data]
+        )
+
+    async def delete(self, collection_name: str, ids: t.List[int]):
+        if not ids:
+            return
+        await asyncio.to_thread(self._write, collection_name, [], ids)
+
+    def _compact_locked(self, collection_name: str):
+        with self._lock:
+            self._compact(collection_name)
+
+    async def compact(self, collection_name: str):
+        """
+        Merge the segments of a collection now, instead of waiting for the thresholds.
+        """
+        self._check_writable()
+        await asyncio.to_thread(self._compact_locked, collection_name)
+
+    def search_vectors(
+        self,
+        collection_name: str,
+        data: t.Union[t.List[t.List[float]], np.ndarray],
+        limit: int = 5,
+        output_fields: t.Sequence[str] = ("id", "content"),
+    ) -> t.List[t.List[t.Dict[str, t.Any]]]:
+        """
+        Exact top-k by cosine similarity, synchronous: small collections are faster to search inline than
+        on a worker thread.
+
+        :param collection_name: the collection to search.
+        :param data: the query vectors.
+        :param limit: the number of hits per query.
+        :param output_fields: the fields of the hit entities, among "id" and "content".
+        :return: the hits of every query, best first, with the cosine similarity as distance.
+        """
+        collection = self._collection(collection_name)
+        queries = _normalize(np.atleast_2d(np.asarray(data, dtype=np.float32)))
+        results = []
+        for start in range(0, len(queries), DEFAULT_QUERY_BATCH):
+            batch = queries[start : start + DEFAULT_QUERY_BATCH]
+            # The top-k of every segment: (scores, segment position, rows), then the top-k of those.
+            candidates: t.List[t.Tuple[np.ndarray, int, np.ndarray]] = []
+            for position, (segment, dead) in enumerate(collection.live()):
+                if not len(segment):
+                    continue
+                scores = batch @ segment.vectors.T
+                scores[:, dead] = -np.inf
+                k = min(limit, scores.shape[1])
+                rows = np.argpartition(-scores, k - 1, axis=1)[:, :k]
+                candidates.append(
+                    (np.take_along_axis(scores, rows, axis=1), position, rows)
+                )
+            for index in range(len(batch)):
+                hits = sorted(
+                    (
+                        (float(score), position, int(row))
+                        for scores, position, rows in candidates
+                        for score, row in zip(scores[index], rows[index])
+                        if score > -np.inf
+                    ),
+                    reverse=True,
+                )[:limit]
+                results.append(
+                    [
+                        self._hit(
+                            collection.segments[position], row, score, output_fields
+                        )
+                        for score, position, row in hits
+                    ]
+                )
+        return results
+
+    @staticmethod
+    def _hit(
+        segment: Segment, row: int, score: float, output_fields: t.Sequence[str]
+    ) -> t.Dict[str, t.Any]:
+        chunk_id = int(segment.ids[row])
+        entity = {}
+        if "id" in output_fields:
+            entity["id"] = chunk_id
+        if "content" in output_fields:
+            entity["content"] = segment.content(row)
+        return {"id": chunk_id, "distance": score, "entity": entity}
+
+    async def search(
+        self,
+        collection_name: str,
+        data: t.Union[t.List[t.List[float]], np.ndarray],
+        limit: int = 5,
+        output_fields: t.Sequence[str] = ("id", "content"),
+        **kwargs,
+    ) -> t.List[t.List[t.Dict[str, t.Any]]]:
+        """
+        Exact vector search, see `search_vectors`.
+        """
+        return self.search_vectors(collection_name, data, limit, output_fields)
+
+    def full_text_search(
+        self, collection_name: str, query: str, limit: int = 5
+    ) -> t.List[t.Dict[str, t.Any]]:
+        """
+        BM25 search of the contents, synchronous as `search_vectors`.
+
+        :return: the hits, best first, with the BM25 score as distance.
+        """
+        collection = self._collection(collection_name)
+        if collection.bm25 is None:
+            raise ValueError(f"Full-text search is disabled on {collection_name}.")
+        rows = collection.rows
+        return [
+            self._hit(*rows[chunk_id], score, ("id", "content"))
+            for chunk_id, score in collection.bm25.search(query, limit)
+            # The index and the segments are published together, but a mismatch must not fail the search.
+            if chunk_id in rows
+        ]
+
+    async def hybrid_search(
+        self,
+        collection_name: str,
+        query: t.Dict[str, t.Dict],
+        limit: int = 5,
+        vector_store: t.Optional[VectorSideStore] = None,
+    ) -> t.List[t.Dict[str, t.Any]]:
+        """
+        A `MilvusStorage.build_hybrid_search_query` query: vector and BM25 searches fused by reciprocal rank,
+        as Milvus `RRFRanker` does. Collections without full-text search only run the dense leg.
+
+        Vectors are stored at full precision, so a "rescore" entry for a quantized collection searches with
+        its full-precision query directly. For shortened vectors, the candidates are rescored with the
+        full-dimension vectors of `vector_store`, if given.
+
+        :param vector_store: the full-dimension vectors of the collection, see `MilvusStorage.hybrid_search`.
+        :return: the hits, best first, with the fused score as distance.
+        """
+        dense, sparse = query["dense"], query["sparse"]
+        rescore = query.get("rescore")
+        if rescore is not None and rescore["anns_field"]:
+            dense_hits = self.search_vectors(
+                collection_name, [rescore["data"]], rescore["limit"]
+            )
+        else:
+            dense_hits = self.search_vectors(
+                collection_name, dense["data"], dense["limit"]
+            )
+            if rescore is not None and vector_store is not None:
+                from core.storage.milvus import rescore_hits
+
+                vectors = await asyncio.to_thread(
+                    vector_store.get_many, [hit["id"] for hit in dense_hits[0]]
+                )
+                dense_hits = [
+                    rescore_hits(
+                        dense_hits[0],
+                        rescore["data"],
+                        rescore["limit"],
+                        field=None,
+                        vectors=vectors,
+                    )
+                ]
+        if self._collection(collection_name).bm25 is None:
+            return dense_hits[0][:limit]
+        sparse_hits = self.full_text_search(
+            collection_name, sparse["data"][0], sparse["limit"]
+        )
+        return [
+            {**hit, "distance": score}
+            for hit, score in reciprocal_rank_fusion(
+                [dense_hits[0], sparse_hits], key=lambda hit: hit["id"], top_k=limit
+            )
+        ]
+
+    async def hierarchical_search(self, **kwargs):
+        pass
@@ -0,0 +1,91 @@
+import logging
+import os
+import sqlite3
+import threading
+import typing as t
+from pathlib import Path
+
+import numpy as np
+
+logger = logging.getLogger(__name__)
+
+# Stay below the default sqlite limit of host parameters.
+_SQLITE_BATCH = 500
+
+
+class VectorSideStore:
+    """
+    Full-precision vectors by chunk id, kept on disk next to a collection indexed with shortened or quantized
+    vectors, and read only to rescore its candidates.
+
+    Vectors are stored as float32 blobs in sqlite, so the store costs no memory on the search nodes.
+    """
+
+    def __init__(self, path: t.Union[str, os.PathLike]):
+        """
+        :param path: the sqlite database file, use ":memory:" for a non-persistent store.
+        """
+        if str(path) != ":memory:":
+            Path(path).parent.mkdir(parents=True, exist_ok=True)
+        self._db = sqlite3.connect(str(path), check_same_thread=False)
+        self._db.execute("PRAGMA journal_mode=WAL")
+        self._db.execute(
+            "CREATE TABLE IF NOT EXISTS vectors (id INTEGER PRIMARY KEY, vector BLOB NOT NULL)"
+        )
+        self._lock = threading.Lock()
+        logger.debug(f"Vector side store opened at {path}")
+
+    def put_many(self, items: t.Mapping[int, t.Sequence[float]]):
+        """
+        Insert or replace the vectors of chunk ids.
+        """
+        rows = [
+            (chunk_id, np.asarray(vector, dtype=np.float32).tobytes())
+            for chunk_id, vector in items.items()
+        ]
+        with self._lock, self._db:
+            self._db.executemany(
+                "INSERT OR REPLACE INTO vectors (id, vector) VALUES (?, ?)", rows
+            )
+
+    def get_many(self, ids: t.Sequence[int]) -> t.List[t.Optional[np.ndarray]]:
+        """
+        :return: the vectors in id order, None for unknown ids.
+        """
+        found: t.Dict[int, np.ndarray] = {}
+        unique = list(set(ids))
+        with self._lock:
+            for start in range(0, len(unique), _SQLITE_BATCH):
+                part = unique[start : start + _SQLITE_BATCH]
+                rows = self._db.execute(
+                    "SELECT id, vector FROM vectors WHERE id IN (%s)"
+                    % ",".join("?" * len(part)),
+                    part,
+                ).fetchall()
+                found.update(
+                    (chunk_id, np.frombuffer(blob, dtype=np.float32))
+                    for chunk_id, blob in rows
+                )
+        return [found.get(chunk_id) for chunk_id in ids]
+
+    def delete(self, ids: t.Iterable[int]):
+        ids = list(ids)
+        with self._lock, self._db:
+            for start in range(0, len(ids), _SQLITE_BATCH):
+                part = ids[start : start + _SQLITE_BATCH]
+                self._db.execute(
+                    "DELETE FROM vectors WHERE id IN (%s)" % ",".join("?" * len(part)),
+                    part,
+                )
+
+    def clear(self):
+        with self._lock, self._db:
+            self._db.execute("DELETE FROM vectors")
+
+    def __len__(self) -> int:
+        with self._lock:
+            return self._db.execute("SELECT COUNT(*) FROM vectors").fetchone()[0]
+
+    def close(self):
+        with self._lock:
+            self._db.close()
@@ -0,0 +1,86 @@
+import logging
+import threading
+import typing as t
+from collections import deque
+
+import numpy as np
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_LATENCY_WINDOW = 50
+DEFAULT_LATENCY_PERCENTILE = 95
+
+
+class EfController:
+    """
+    Adapt the HNSW search breadth `ef` to a latency SLO.
+
+    Search latencies are observed over a sliding window. Once the window is full, ef is cut multiplicatively
+    when the chosen percentile exceeds the SLO, and raised additively when it stays below `headroom` times the
+    SLO, so tail latency is bounded during spikes and recall comes back when load drops. The window is cleared
+    after every change, so each ef is judged on its own latencies.
+    """
+
+    def __init__(
+        self,
+        slo_ms: float,
+        initial_ef: int,
+        min_ef: int,
+        max_ef: int,
+        window: int = DEFAULT_LATENCY_WINDOW,
+        percentile: float = DEFAULT_LATENCY_PERCENTILE,
+        headroom: float = 0.7,
+        decrease: float = 0.75,
+        increase: int = 16,
+    ):
+        """
+        :param slo_ms: the latency objective, in milliseconds.
+        :param initial_ef: the starting ef.
+        :param min_ef: the lower bound of ef, at least the result limit of the dense leg.
+        :param max_ef: the upper bound of ef.
+        :param window: the number of observations per decision.
+        :param percentile: the latency percentile compared with the SLO.
+        :param headroom: the fraction of the SLO below which ef is raised.
+        :param decrease: the factor applied to ef on an SLO violation.
+        :param increase: the step added to ef when there is headroom.
+        """
+        if not min_ef <= initial_ef <= max_ef:
+            raise ValueError(
+                f"initial_ef ({initial_ef}) should be within [{min_ef}, {max_ef}]."
+            )
+        self.slo_ms = slo_ms
+        self.min_ef = min_ef
+        self.max_ef = max_ef
+        self.percentile = percentile
+        self.headroom = headroom
+        self.decrease = decrease
+        self.increase = increase
+        self._ef = initial_ef
+        self._latencies: t.Deque[float] = deque(maxlen=window)
+        self._lock = threading.Lock()
+
+    @property
+    def ef(self) -> int:
+        return self._ef
+
+    def observe(self, latency: float):
+        """
+        Record the latency of a search, in seconds, and adjust ef once the window is full.
+        """
+        with self._lock:
+            self._latencies.append(latency * 1000)
+            if len(self._latencies) < self._latencies.maxlen:
+                return
+            observed = float(np.percentile(self._latencies, self.percentile))
+            ef = self._ef
+            if observed > self.slo_ms:
+                ef = max(self.min_ef, int(ef * self.decrease))
+            elif observed < self.slo_ms * self.headroom:
+                ef = min(self.max_ef, ef + self.increase)
+            if ef != self._ef:
+                logger.info(
+                    f"p{self.percentile:g} search latency {observed:.1f}ms "
+                    f"(SLO {self.slo_ms}ms), ef {self._ef} -> {ef}."
+                )
+                self._ef = ef
+            self._latencies.clear()
@@ -2,25 +2,38 @@ import logging
 import secrets
 from typing import Optional
 
-from fastapi import Depends, FastAPI, HTTPException, Security
+from fastapi import Depends, FastAPI, Header, HTTPException, Security
 from fastapi.concurrency import asynccontextmanager
 from fastapi.responses import StreamingResponse
 from fastapi.security import APIKeyHeader
 
+from conf import settings
+from core.storage.milvus_async import AsyncMilvusStorage
 from schema.chat import ChatRequest
+from service.milvus.cache import create_query_cache
 from service.milvus.chat import prepare_data, chat
+from service.milvus.rerank import get_reranker
+from utils.embedding_cache import get_embedding_cache
 from utils.yalog import Log
 
 
 @asynccontextmanager
 async def lifespan(app: FastAPI):
     Log.start()
-    await prepare_data(target="anyio")
+    # One storage, and so one set of gRPC channels, shared by every request of the worker.
+    app.state.milvus = AsyncMilvusStorage(uri=settings.db.MILVUS_URI)
+    app.state.query_cache = create_query_cache(collection_name="anyio")
+    # Fail now on a bad rerank setting, not on every query.
+    get_reranker()
+    version = await prepare_data(milvus=app.state.milvus, target="anyio")
+    if app.state.query_cache:
+        await app.state.query_cache.set_version(version)
     app.state.api_key = f"adc-{secrets.token_urlsafe(32)}"
     logging.info(f"API key: {app.state.api_key}")
     logging.info("Data loads sucessfully.")
     yield
     logging.info("Application shutdown")
+    await app.state.milvus.close()
     Log.close()
 
 
@@ -46,16 +59,58 @@ async def verify_api_key(
 
 
 @app.post("/query")
-async def query(request: ChatRequest, api_key: str = Security(verify_api_key)):
+async def query(
+    request: ChatRequest,
+    api_key: str = Security(verify_api_key),
+    cache_control: Optional[str] = Header(None),
+):
     """
     Chat with AI to get the answer from the documents.
+
+    Frequent questions are answered from the answer cache. Send `Cache-Control: no-cache` to get a fresh
+    answer, and `no-store` to keep it out of the cache. Requests with their own search parameters bypass the
+    cache.
     """
+    directives = {
+        directive.strip().lower() for directive in (cache_control or "").split(",")
+    }
     return StreamingResponse(
-        chat(request.query),
+        chat(
+            request.query,
+            milvus=app.state.milvus,
+            cache=app.state.query_cache,
+            replay_answer="no-cache" not in directives,
+            record_answer="no-store" not in directives,
+            params=request.search,
+        ),
         media_type="text/event-stream",
     )
 
 
+@app.post("/reindex")
+async def reindex(api_key: str = Security(verify_api_key)):
+    """
+    Re-index the documents, only added, modified or deleted files are processed.
+    """
+    version = await prepare_data(milvus=app.state.milvus, target="anyio")
+    if app.state.query_cache:
+        await app.state.query_cache.set_version(version)
+    return {"message": "Documents are re-indexed."}
+
+
+@app.get("/stats")
+async def stats(api_key: str = Security(verify_api_key)):
+    """
+    Counters of the caches of this worker.
+    """
+    embedding_cache = get_embedding_cache()
+    query_cache = app.state.query_cache
+    return {
+        "embedding_cache": embedding_cache.stats() if embedding_cache else None,
+        "query_cache": query_cache.stats() if query_cache else None,
+    }
+
+
 if __name__ == "__main__":
     import uvicorn
 
@@ -1,8 +1,15 @@
+from typing import Optional
+
 from pydantic import BaseModel
 
+from core.storage.milvus import SearchParams
+
 
 class ChatRequest(BaseModel):
     query: str
+    # Overrides the search parameters of the collection, e.g. to compare recall. Such requests bypass the
+    # answer and context caches.
+    search: Optional[SearchParams] = None
 
 
 class ChatResponse(BaseModel):
@@ -0,0 +1,309 @@
+import asyncio
+import hashlib
+import json
+import logging
+import time
+import typing as t
+import uuid
+from collections import OrderedDict
+
+import numpy as np
+
+from conf import settings
+from utils.embedding_cache import normalize_text
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_QUERY_CACHE_TTL = 3600
+DEFAULT_QUERY_CACHE_ENTRIES = 1024
+DEFAULT_SEMANTIC_THRESHOLD = 0.95
+DEFAULT_MAX_ANSWER_BYTES = 64 * 1024
+
+
+class MemoryBackend:
+    """
+    In-process key-value store with TTL and LRU eviction.
+
+    Values are stored serialized, so callers always get their own copy. Entries set with `expire=False` are
+    kept apart and never evicted.
+    """
+
+    def __init__(
+        self,
+        max_entries: int = DEFAULT_QUERY_CACHE_ENTRIES,
+        ttl: float = DEFAULT_QUERY_CACHE_TTL,
+    ):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        # key -> (expiry, serialized value)
+        self._entries: OrderedDict[str, t.Tuple[float, str]] = OrderedDict()
+        self._persistent: t.Dict[str, str] = {}
+
+    async def get(self, key: str) -> t.Any:
+        if key in self._persistent:
+            return json.loads(self._persistent[key])
+        entry = self._entries.get(key)
+        if entry is None:
+            return None
+        expiry, value = entry
+        if expiry < time.monotonic():
+            del self._entries[key]
+            return None
+        self._entries.move_to_end(key)
+        return json.loads(value)
+
+    async def set(self, key: str, value: t.Any, expire: bool = True):
+        if not expire:
+            self._persistent[key] = json.dumps(value)
+            return
+        self._entries[key] = (time.monotonic() + self.ttl, json.dumps(value))
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.max_entries:
+            self._entries.popitem(last=False)
+
+
+class RedisBackend:
+    """
+    Redis key-value store, shared by every worker. Entries expire after `ttl`, LRU eviction is left to the
+    `maxmemory-policy` of the server.
+
+    Redis errors are logged and treated as cache misses, the cache must never fail a request.
+    """
+
+    def __init__(
+        self,
+        url: str,
+        ttl: float = DEFAULT_QUERY_CACHE_TTL,
+        prefix: str = "query_cache:",
+    ):
+        import redis.asyncio as aioredis
+
+        redis_pool = aioredis.BlockingConnectionPool.from_url(url=url)
+        self.redis_client = aioredis.Redis.from_pool(connection_pool=redis_pool)
+        self.ttl = ttl
+        self.prefix = prefix
+
+    async def get(self, key: str) -> t.Any:
+        try:
+            value = await self.redis_client.get(self.prefix + key)
+        except Exception as e:
+            logger.warning(f"Query cache get failed: {e}")
+            return None
+        return None if value is None else json.loads(value)
+
+    async def set(self, key: str, value: t.Any, expire: bool = True):
+        try:
+            await self.redis_client.set(
+                self.prefix + key,
+                json.dumps(value),
+                ex=int(self.ttl) if expire else None,
+            )
+        except Exception as e:
+            logger.warning(f"Query cache set failed: {e}")
+
+
+class QueryCache:
+    """
+    Query-path cache of one collection.
+
+    - Rewrites are cached by exact normalized query. They don't depend on the indexed documents, so they
+      survive re-ingestion.
+    - Retrieved contexts are cached semantically: a query whose embedding is within `threshold` cosine
+      similarity of a cached query reuses its contexts. Entries are tagged with the collection version, which
+      `prepare_data` bumps on every re-ingest, so stale contexts are never served.
+    - Final answers are cached as their streamed chunks, by exact normalized query, collection version and
+      hash of the prompt template, to be replayed on the next identical question.
+
+    The index of query embeddings is kept in process, the payloads and the collection version live in the
+    backend, so with Redis a re-index on one worker invalidates the contexts of all of them. Hits and misses
+    are counted per cache, see `CACHES`.
+    """
+
+    CACHES = ("rewrite", "contexts", "answer")
+
+    def __init__(
+        self,
+        collection_name: str,
+        backend: t.Union[MemoryBackend, RedisBackend] = None,
+        threshold: float = DEFAULT_SEMANTIC_THRESHOLD,
+        max_entries: int = DEFAULT_QUERY_CACHE_ENTRIES,
+        ttl: float = DEFAULT_QUERY_CACHE_TTL,
+        max_answer_bytes: int = DEFAULT_MAX_ANSWER_BYTES,
+    ):
+        """
+        :param collection_name: the collection the cached contexts come from.
+        :param backend: where entries are stored, defaults to an in-process backend.
+        :param threshold: the minimum cosine similarity to reuse cached contexts.
+        :param max_entries: the size bound of the in-process embedding index.
+        :param ttl: seconds after which an index entry expires.
+        :param max_answer_bytes: answers larger than this are not cached.
+        """
+        self.collection_name = collection_name
+        self.backend = backend or MemoryBackend(max_entries=max_entries, ttl=ttl)
+        self.threshold = threshold
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.max_answer_bytes = max_answer_bytes
+        # key -> (version, expiry, unit query embedding)
+        self._index: OrderedDict[str, t.Tuple[int, float, np.ndarray]] = OrderedDict()
+        # cache -> [hits, misses]
+        self._counters: t.Dict[str, t.List[int]] = {
+            cache: [0, 0] for cache in self.CACHES
+        }
+
+    @staticmethod
+    def _digest(query: str) -> str:
+        return hashlib.sha256(
+            normalize_text(query).casefold().encode("utf-8")
+        ).hexdigest()
+
+    async def version(self) -> int:
+        return await self.backend.get(f"version:{self.collection_name}") or 0
+
+    async def set_version(self, version: int):
+        """
+        Record the collection version, contexts cached under an older version are no longer served.
+        """
+        await self.backend.set(f"version:{self.collection_name}", version, expire=False)
+
+    async def get_rewrite(self, query: str) -> t.Optional[t.List[str]]:
+        queries = await self.backend.get(f"rewrite:{self._digest(query)}")
+        self._count("rewrite", queries is not None)
+        return queries
+
+    async def set_rewrite(self, query: str, queries: t.List[str]):
+        await self.backend.set(f"rewrite:{self._digest(query)}", queries)
+
+    async def _answer_key(self, query: str, template: str) -> str:
+        template_hash = hashlib.sha256(template.encode("utf-8")).hexdigest()[:16]
+        return f"answer:{self.collection_name}:{await self.version()}:{template_hash}:{self._digest(query)}"
+
+    async def get_answer(self, query: str, template: str) -> t.Optional[t.List[str]]:
+        """
+        The streamed chunks of the answer cached for `query`.
+
+        :param template: the prompt template the answer was generated with.
+        """
+        chunks = await self.backend.get(await self._answer_key(query, template))
+        self._count("answer", chunks is not None)
+        return chunks
+
+    async def set_answer(self, query: str, template: str, chunks: t.List[str]):
+        """
+        Cache the streamed chunks of a completed answer, unless it is empty or too large.
+        """
+        size = sum(len(chunk.encode("utf-8")) for chunk in chunks)
+        if not size or size > self.max_answer_bytes:
+            return
+        await self.backend.set(await self._answer_key(query, template), chunks)
+
+    async def get_contexts(
+        self, query_embedding: t.List[float]
+    ) -> t.Optional[t.List[t.Dict[str, t.Any]]]:
+        """
+        The contexts cached for the most similar query, if it is similar enough.
+        """
+        version = await self.version()
+        now = time.monotonic()
+        for key in [
+            key
+            for key, (entry_version, expiry, _) in self._index.items()
+            if entry_version != version or expiry < now
+        ]:
+            del self._index[key]
+        if not self._index:
+            self._count("contexts", False)
+            return None
+
+        keys = list(self._index)
+        matrix = np.stack([self._index[key][2] for key in keys])
+        similarities = matrix @ self._unit(query_embedding)
+        best = int(np.argmax(similarities))
+        if similarities[best] < self.threshold:
+            self._count("contexts", False)
+            return None
+
+        contexts = await self.backend.get(keys[best])
+        if contexts is None:
+            # Evicted from the backend, forget it.
+            self._index.pop(keys[best], None)
+        else:
+            self._index.move_to_end(keys[best])
+        self._count("contexts", contexts is not None)
+        return contexts
+
+    async def set_contexts(
+        self, query_embedding: t.List[float], contexts: t.List[t.Dict[str, t.Any]]
+    ):
+        version = await self.version()
+        key = f"contexts:{self.collection_name}:{version}:{uuid.uuid4().hex}"
+        await self.backend.set(key, contexts)
+        self._index[key] = (
+            version,
+            time.monotonic() + self.ttl,
+            self._unit(query_embedding),
+        )
+        while len(self._index) > self.max_entries:
+            self._index.popitem(last=False)
+
+    @staticmethod
+    def _unit(embedding: t.List[float]) -> np.ndarray:
+        vector = np.asarray(embedding, dtype=np.float32)
+        norm = np.linalg.norm(vector)
+        return vector / norm if norm else vector
+
+    def _count(self, cache: str, hit: bool):
+        self._counters[cache][0 if hit else 1] += 1
+
+    def stats(self) -> t.Dict[str, t.Any]:
+        """
+        Hits, misses and hit rate of each cache, and the size of the embedding index.
+        """
+        stats: t.Dict[str, t.Any] = {
+            cache: {
+                "hits": hits,
+                "misses": misses,
+                "hit_rate": hits / (hits + misses) if hits + misses else 0.0,
+            }
+            for cache, (hits, misses) in self._counters.items()
+        }
+        stats["index_entries"] = len(self._index)
+        return stats
+
+
+async def replay(chunks: t.List[str], interval: float = 0.0) -> t.AsyncIterator[str]:
+    """
+    Stream cached answer chunks again, at network speed or one every `interval` seconds.
+    """
+    for index, chunk in enumerate(chunks):
+        if interval and index:
+            await asyncio.sleep(interval)
+        yield chunk
+
+
+def create_query_cache(collection_name: str) -> t.Optional[QueryCache]:
+    """
+    Build the query cache of a collection from settings, returns None when it is disabled.
+    """
+    if not settings.get("cache.ENABLED", True):
+        return None
+    ttl = settings.get("cache.TTL", DEFAULT_QUERY_CACHE_TTL)
+    max_entries = settings.get("cache.MAX_ENTRIES", DEFAULT_QUERY_CACHE_ENTRIES)
+    if settings.get("cache.BACKEND", "memory") == "redis":
+        from utils.constants import BASE_REDIS_URI
+
+        backend = RedisBackend(
+            url=f"{BASE_REDIS_URI}/{settings.redis.cache.db}", ttl=ttl
+        )
+    else:
+        backend = MemoryBackend(max_entries=max_entries, ttl=ttl)
+    return QueryCache(
+        collection_name=collection_name,
+        backend=backend,
+        threshold=settings.get("cache.SEMANTIC_THRESHOLD", DEFAULT_SEMANTIC_THRESHOLD),
+        max_entries=max_entries,
+        ttl=ttl,
+        max_answer_bytes=settings.get(
+            "cache.MAX_ANSWER_BYTES", DEFAULT_MAX_ANSWER_BYTES
+        ),
+    )
@@ -1,108 +1,511 @@
 import asyncio
 import logging
+import time
 import logfire
-from typing import List
-
-import simplemind as sm
+from typing import Dict, List, Tuple
 
 from conf import settings
+from core.data_processor.constants import DEFAULT_DEDUP_THRESHOLD
+from core.data_processor.dedup import ChunkDeduplicator
+from core.data_processor.manifest import Manifest, chunk_id, file_digest
 from core.data_processor.markdown_processor import MarkdownProcessor
-from core.storage.milvus import MilvusStorage
-from utils.constants import SEMAPHORE
-from utils.llm import SimpleLLM as sl
-from utils.llm import try_parse_json_object
+from core.data_processor.markdown_splitter import MarkdownChunker
+from core.storage.fusion import reciprocal_rank_fusion
+from core.storage.milvus import (
+    DEFAULT_VECTOR_PRECISION,
+    MilvusStorage,
+    SearchParams,
+    quantize_rows,
+    rescore_hits,
+)
+from core.storage.milvus_async import AsyncMilvusStorage
+from core.storage.side_store import VectorSideStore
+from core.storage.tuning import EfController
+from service.milvus.cache import QueryCache, replay
+from service.milvus.compression import get_context_compressor
+from service.milvus.rerank import get_reranker
+from utils.concurrency import batched, buffered
+from utils.constants import INGEST_BATCH_SIZE, INGEST_QUEUE_SIZE, SEMAPHORE
+from utils.llm import (
+    estimate_tokens,
+    get_embedding_batcher,
+    get_llm,
+    truncate_embedding,
+    try_parse_json_object,
+)
 from utils.prompt import query_prompt, rewrite_prompt
+from utils.tools import list_files
 
 logger = logging.getLogger(__name__)
 
-MILVUS_URL = settings.db.MILVUS_URI
+MANIFEST_DIR = "data/.manifests"
+SIDE_STORE_DIR = "data/.cache/full_vectors"
+EMBEDDING_MODEL = "text-embedding-3-small"
+# The full size of `EMBEDDING_MODEL` embeddings.
+EMBEDDING_DIMENSIONS = 1536
+# Chunks kept after fusing the query variants, and the token budget of the prompt context they are packed in.
+DEFAULT_TOP_K = 10
+DEFAULT_CONTEXT_TOKENS = 3000
 
+_prepare_lock = asyncio.Lock()
+# Latency controllers of the search ef, per collection.
+_ef_controllers: Dict[str, EfController] = {}
+# Metadata of the prepared collections, which their searches must follow.
+_collection_metadata: Dict[str, Dict] = {}
+_side_stores: Dict[str, VectorSideStore] = {}
 
-async def prepare_data(target: str = "art_design"):
-    with logfire.span("prepare_data"):
-        milvus = MilvusStorage(uri=MILVUS_URL)
-        # TODO: Check if the collection exists.
-        if target in milvus.list_collections():
-            return
-        with logfire.span("prepare_data.md_processor"):
-            md_processor = MarkdownProcessor(file_path=f"data/{target}")
-            chunks = await md_processor.process()
-
-        with logfire.span("embedding data"):
-            embeddings_generator = sl()
-            semaphore = asyncio.Semaphore(SEMAPHORE)
-
-            async def gen_chunk_embedding(inputs: str, model: str):
-                async with semaphore:
-                    return {
-                        "vector": await embeddings_generator.embedding(
-                            model=model, inputs=inputs
-                        ),
-                        "content": inputs,
-                    }
-
-            points = await asyncio.gather(
-                *(
-                    gen_chunk_embedding(
-                        inputs=chunk.page_content, model="text-embedding-3-small"
-                    )
-                    for chunk in chunks
-                )
-            )
 
-        milvus.create_collection(
-            collection_name=target,
-            dimension=1536,
-            enable_bm25=True,
+def collection_metadata() -> Dict:
+    """
+    How the vectors of a collection are embedded and stored, from settings:
+
+    - `embedding.DIMENSIONS`: the size of the indexed embeddings, shortened Matryoshka embeddings (e.g. 256 or
+      512) cut the memory and latency of the vector index. The full size by default.
+    - `embedding.RESCORE`: whether full-size embeddings of shortened ones are kept in a side store, to rescore
+      the candidates of the dense search.
+    - `db.VECTOR_PRECISION`: see `vector_precision`.
+    - the chunker and its configuration, so a change of the chunker re-chunks every file instead of mixing its
+      chunks with those of the previous one.
+
+    It is recorded in the manifest of the collection, which is rebuilt when it changes.
+    """
+    dimensions = settings.get("embedding.DIMENSIONS", EMBEDDING_DIMENSIONS)
+    return {
+        # The chunker of `MarkdownProcessor` with its default settings, as used by `_ingest_files`.
+        "chunker": MarkdownChunker().config(),
+        "model": EMBEDDING_MODEL,
+        "dimensions": dimensions,
+        "precision": vector_precision(),
+        "rescore": dimensions < EMBEDDING_DIMENSIONS
+        and settings.get("embedding.RESCORE", False),
+    }
+
+
+def request_dimensions(metadata: Dict) -> int | None:
+    """
+    The embedding size requested from the API for a collection. Embeddings kept for rescoring are requested at
+    full size and shortened locally, with `truncate_embedding`.
+    """
+    if metadata["rescore"] or metadata["dimensions"] >= EMBEDDING_DIMENSIONS:
+        return None
+    return metadata["dimensions"]
+
+
+def side_store(collection_name: str) -> VectorSideStore:
+    """
+    The store of the full-size embeddings of a collection.
+    """
+    if collection_name not in _side_stores:
+        _side_stores[collection_name] = VectorSideStore(
+            f"{SIDE_STORE_DIR}/{collection_name}.sqlite3"
         )
-        milvus.store(collection_name=target, data=points)
+    return _side_stores[collection_name]
+
+
+async def prepare_data(milvus: AsyncMilvusStorage, target: str = "art_design") -> int:
+    """
+    Bring the collection of `target` in sync with the files under `data/{target}`.
 
+    Only added or modified files are re-chunked and re-embedded, chunks no longer referenced by any file are
+    deleted. Chunk ids are derived from their content, so every write is an idempotent upsert.
 
-async def search_relevant_contents(queries: List[str]):
-    milvus = MilvusStorage(uri=MILVUS_URL)
-    with logfire.span("chat.milvus_search"):
-        relevant_contents = []
-        for query in queries:
-            try:
-                query_embedding = await sl().embedding(
-                    model="text-embedding-3-small", inputs=query
+    :return: the collection version, bumped whenever the collection changes.
+    """
+    async with _prepare_lock:
+        with logfire.span("prepare_data"):
+            manifest = Manifest.load(f"{MANIFEST_DIR}/{target}.json")
+            metadata = collection_metadata()
+
+            collections = await milvus.list_collections()
+            if target in collections and not manifest.files:
+                # Collections created before the manifest use auto ids and can't be updated incrementally.
+                logfire.warning(f"Collection {target} has no manifest, rebuilding it.")
+                await milvus.drop_collection(collection_name=target)
+                collections.remove(target)
+            elif target in collections and manifest.metadata != metadata:
+                logfire.warning(
+                    f"Collection {target} was built with {manifest.metadata}, rebuilding it with {metadata}."
                 )
-                logfire.info(f"query_embedding: {query_embedding}")
-                query_req = MilvusStorage.build_hybrid_search_query(
-                    query_embedding=query_embedding, query=query
+                await milvus.drop_collection(collection_name=target)
+                collections.remove(target)
+            if target not in collections:
+                manifest.reset()
+                manifest.metadata = metadata
+                if metadata["rescore"]:
+                    await asyncio.to_thread(side_store(target).clear)
+                await milvus.create_collection(
+                    collection_name=target,
+                    dimension=metadata["dimensions"],
+                    enable_bm25=True,
+                    auto_id=False,
+                    precision=metadata["precision"],
                 )
-                relevant_contents.extend(
-                    milvus.hybrid_search(
-                        collection_name="anyio",
-                        query=query_req,
+            _collection_metadata[target] = metadata
+
+            current = {path: file_digest(path) for path in list_files(f"data/{target}")}
+            added, modified, deleted = manifest.diff(current)
+            logfire.info(
+                f"prepare_data {target}: {len(added)} added, {len(modified)} modified, {len(deleted)} deleted files."
+            )
+            if not (added or modified or deleted):
+                return manifest.version
+
+            stale_ids = manifest.chunk_ids()
+            for path in deleted:
+                manifest.remove_file(path)
+            await _ingest_files(
+                milvus=milvus,
+                target=target,
+                files=added + modified,
+                digests=current,
+                manifest=manifest,
+            )
+
+            stale = list(stale_ids - manifest.chunk_ids())
+            await milvus.delete(collection_name=target, ids=stale)
+            if metadata["rescore"]:
+                await asyncio.to_thread(side_store(target).delete, stale)
+            manifest.version += 1
+            manifest.save()
+            return manifest.version
+
+
+async def _ingest_files(
+    milvus: AsyncMilvusStorage,
+    target: str,
+    files: List[str],
+    digests: Dict[str, str],
+    manifest: Manifest,
+):
+    """
+    Streaming ingestion: load -> split -> embed -> upsert.
+
+    Stages are connected by bounded queues, so memory stays constant regardless of the corpus size and
+    embedding of the next batch overlaps with the upsert of the current one. Exact and near-duplicate chunks
+    are dropped before embedding, the files they come from reference the surviving chunk instead. A file is
+    recorded in the manifest once all of its chunks, or the survivors of its duplicates, are written.
+
+    Vectors are embedded and stored as recorded in `manifest.metadata`, see `collection_metadata`.
+    """
+    metadata = manifest.metadata
+    md_processor = MarkdownProcessor(file_path=f"data/{target}")
+    embeddings_generator = get_llm()
+    dedup = ChunkDeduplicator(
+        threshold=settings.get("ingest.DEDUP_THRESHOLD", DEFAULT_DEDUP_THRESHOLD)
+    )
+    # Files with chunks still in flight: path -> [remaining chunks, written chunk ids, complete].
+    in_flight: Dict[str, List] = {}
+    # Whether each chunk sent to embedding was written, and the files waiting on the survivors still in flight.
+    outcomes: Dict[str, bool] = {}
+    waiting: Dict[str, List[str]] = {}
+
+    def finish(path: str):
+        remaining, written, complete = in_flight.pop(path)
+        # A file with chunks that failed to embed gets no hash, so the next sync retries it.
+        manifest.set_file(
+            path, digest=digests[path] if complete else "", chunk_ids=written
+        )
+
+    def resolve(path: str, content_id: str, written: bool):
+        state = in_flight[path]
+        state[0] -= 1
+        if written:
+            state[1].append(content_id)
+        else:
+            state[2] = False
+        if state[0] == 0:
+            finish(path)
+
+    async def split():
+        with logfire.span("prepare_data.md_processor"):
+            async for path, chunks in md_processor.astream(files=files):
+                state = in_flight[path] = [len(chunks), [], True]
+                for chunk in chunks:
+                    content = chunk.page_content
+                    survivor, duplicate = dedup.add(
+                        chunk_id(content), content, source=path
                     )
+                    if not duplicate:
+                        yield path, content
+                    elif survivor in outcomes:
+                        resolve(path, survivor, outcomes[survivor])
+                    else:
+                        # Only complete once the survivor is written, a failed survivor fails this file too.
+                        waiting.setdefault(survivor, []).append(path)
+                if state[0] == 0 and path in in_flight:
+                    finish(path)
+
+    async def embed():
+        async for batch in batched(
+            buffered(split(), maxsize=INGEST_QUEUE_SIZE), size=INGEST_BATCH_SIZE
+        ):
+            with logfire.span("embedding data"):
+                embeddings = await embeddings_generator.embed_many(
+                    model=metadata["model"],
+                    inputs=[content for _, content in batch],
+                    concurrency=SEMAPHORE,
+                    dimensions=request_dimensions(metadata),
                 )
-            except Exception as e:
-                logfire.exception(f"milvus_search error: {e}")
+            yield [
+                (path, content, vector)
+                for (path, content), vector in zip(batch, embeddings)
+            ]
+
+    failed = 0
+    async for batch in buffered(embed(), maxsize=2):
+        points = {
+            chunk_id(content): {
+                "id": chunk_id(content),
+                "vector": truncate_embedding(vector, metadata["dimensions"]),
+                "content": content,
+            }
+            for _, content, vector in batch
+            if vector is not None
+        }
+        if points and metadata["rescore"]:
+            await asyncio.to_thread(
+                side_store(target).put_many,
+                {
+                    chunk_id(content): vector
+                    for _, content, vector in batch
+                    if vector is not None
+                },
+            )
+        if points:
+            await milvus.upsert(
+                collection_name=target,
+                data=quantize_rows(list(points.values()), metadata["precision"]),
+            )
+
+        for path, content, vector in batch:
+            content_id = chunk_id(content)
+            outcomes[content_id] = vector is not None
+            if vector is None:
+                failed += 1
+            resolve(path, content_id, outcomes[content_id])
+            for duplicate_path in waiting.pop(content_id, []):
+                resolve(duplicate_path, content_id, outcomes[content_id])
+
+    if failed:
+        logfire.warning(f"{failed} chunks failed to embed and are skipped.")
+    logfire.info(f"{dedup.duplicates} duplicate chunks are skipped.")
+    if embeddings_generator.embedding_cache:
+        logfire.info(
+            f"embedding cache stats: {embeddings_generator.embedding_cache.stats()}"
+        )
+
+
+def search_params(collection_name: str) -> SearchParams:
+    """
+    Search parameters of a collection, from the `search.<collection>` settings.
+
+    When `search.LATENCY_SLO_MS` is set, ef is driven by the latency controller of the collection.
+    """
+    overrides = settings.get(f"search.{collection_name}", {})
+    params = SearchParams(**{key.lower(): value for key, value in overrides.items()})
+    controller = _ef_controller(collection_name, params)
+    return params.model_copy(update={"ef": controller.ef}) if controller else params
+
+
+def vector_precision() -> str:
+    """
+    Storage precision of the dense vectors, from `db.VECTOR_PRECISION`, see `VECTOR_PRECISIONS`.
+    """
+    return settings.get("db.VECTOR_PRECISION", DEFAULT_VECTOR_PRECISION)
+
 
-        relevant_contents = sorted(
-            relevant_contents, key=lambda x: x.get("distance"), reverse=True
+def _ef_controller(collection_name: str, params: SearchParams) -> EfController | None:
+    slo_ms = settings.get("search.LATENCY_SLO_MS")
+    if slo_ms is None:
+        return None
+    if collection_name not in _ef_controllers:
+        min_ef = max(params.dense_limit, settings.get("search.MIN_EF", 16))
+        _ef_controllers[collection_name] = EfController(
+            slo_ms=slo_ms,
+            initial_ef=max(params.ef, min_ef),
+            min_ef=min_ef,
+            max_ef=max(params.ef, min_ef, settings.get("search.MAX_EF", 512)),
         )
+    return _ef_controllers[collection_name]
 
-        for index, item in enumerate(relevant_contents):
-            logfire.info(f"{index}: {item}")
 
-        relevant_contents = [
-            str(index + 1) + "." + item.get("entity").get("content")
-            for index, item in enumerate(relevant_contents)
-        ]
-        relevant_contents = list(set(relevant_contents))
-        return relevant_contents
+async def search_relevant_contents(
+    milvus: AsyncMilvusStorage,
+    queries: List[str],
+    top_k: int = DEFAULT_TOP_K,
+    params: SearchParams | None = None,
+) -> List[Dict]:
+    """
+    Retrieve contents for every query variant, fused into one ranking.
+    """
+    result_lists, _ = await _search_queries(
+        milvus=milvus, queries=queries, params=params
+    )
+    return fuse_results(result_lists, top_k=top_k)
 
 
-async def rewrite(query: str):
+async def _search_queries(
+    milvus: AsyncMilvusStorage, queries: List[str], params: SearchParams | None = None
+) -> Tuple[List[List[Dict]], int]:
+    """
+    Hybrid search every query variant.
+
+    All variants are embedded in one batched call and their hybrid searches run concurrently, a failing
+    variant only loses its own results.
+
+    :param params: the search parameters of this request, defaults to those of the collection. Searches with
+        the collection parameters feed its latency controller.
+    :return: the hits of the variants that were searched, and the number of variants that failed.
+    """
+    controller = None
+    if params is None:
+        params = search_params("anyio")
+        controller = _ef_controllers.get("anyio")
+    metadata = _collection_metadata.get("anyio") or collection_metadata()
+    with logfire.span("chat.milvus_search", ef=params.ef):
+        # Batched with the queries of the other concurrent requests.
+        query_embeddings = await get_embedding_batcher(
+            model=metadata["model"], dimensions=request_dimensions(metadata)
+        ).embed_many(queries)
+
+        async def search(query: str, query_embedding: List[float] | None):
+            if query_embedding is None:
+                raise ValueError(f"Failed to embed query: {query}")
+            query_req = _hybrid_query(query, query_embedding, params, metadata)
+            start = time.perf_counter()
+            result = await milvus.hybrid_search(
+                collection_name="anyio",
+                query=query_req,
+                limit=params.limit,
+                vector_store=side_store("anyio") if metadata["rescore"] else None,
+            )
+            if controller:
+                controller.observe(time.perf_counter() - start)
+            return result
+
+        results = await asyncio.gather(
+            *(
+                search(query, query_embedding)
+                for query, query_embedding in zip(queries, query_embeddings)
+            ),
+            return_exceptions=True,
+        )
+        result_lists = []
+        for query, result in zip(queries, results):
+            if isinstance(result, Exception):
+                logfire.error(f"milvus_search error for {query}: {result}")
+                continue
+            result_lists.append(result)
+        return result_lists, len(queries) - len(result_lists)
+
+
+def _hybrid_query(
+    query: str, query_embedding: List[float], params: SearchParams, metadata: Dict
+) -> Dict:
+    return MilvusStorage.build_hybrid_search_query(
+        query_embedding=truncate_embedding(query_embedding, metadata["dimensions"]),
+        query=query,
+        params=params,
+        precision=metadata["precision"],
+        rescore_embedding=query_embedding if metadata["rescore"] else None,
+    )
+
+
+async def dense_confidence(
+    milvus: AsyncMilvusStorage, query: str, params: SearchParams | None = None
+) -> float:
+    """
+    The cosine similarity between a query and its best dense match, rescored at full precision as the dense leg
+    of the hybrid search is. Hybrid hits are ranked by RRF, whose scores only depend on ranks (at most 2 / 61,
+    for a chunk first in both legs), so they can't tell how well the query is matched.
+
+    :return: the similarity, 0.0 when it can't be computed.
+    """
+    params = params or search_params("anyio")
+    metadata = _collection_metadata.get("anyio") or collection_metadata()
+    try:
+        # Coalesced with the embedding of the hybrid search of the same query.
+        (query_embedding,) = await get_embedding_batcher(
+            model=metadata["model"], dimensions=request_dimensions(metadata)
+        ).embed_many([query])
+        if query_embedding is None:
+            return 0.0
+        query_req = _hybrid_query(query, query_embedding, params, metadata)
+        dense, rescore = query_req["dense"], query_req.get("rescore")
+        field = rescore["anns_field"] if rescore else None
+        (hits,) = await milvus.search(
+            collection_name="anyio",
+            anns_field=dense["anns_field"],
+            data=dense["data"],
+            search_params=dense["param"],
+            output_fields=["id", field] if field else ["id"],
+            limit=dense["limit"] if rescore else 1,
+        )
+        if rescore:
+            vectors = (
+                None
+                if field
+                else await asyncio.to_thread(
+                    side_store("anyio").get_many, [hit["id"] for hit in hits]
+                )
+            )
+            hits = rescore_hits(hits, rescore["data"], 1, field, vectors)
+        return float(hits[0]["distance"]) if hits else 0.0
+    except Exception as e:
+        logfire.error(f"dense_confidence error for {query}: {e}")
+        return 0.0
+
+
+def fuse_results(
+    result_lists: List[List[Dict]], top_k: int = DEFAULT_TOP_K
+) -> List[Dict]:
+    """
+    Fuse the hits of every variant by chunk id with reciprocal rank fusion.
+
+    The distances of separate hybrid searches are RRF scores of their own, so only the ranks are compared.
+
+    :return: the top_k chunks as {"id", "content", "score"}, best first.
+    """
+    fused = reciprocal_rank_fusion(result_lists, key=lambda hit: hit["id"], top_k=top_k)
+    relevant_contents = [
+        {"id": hit["id"], "content": hit["entity"]["content"], "score": score}
+        for hit, score in fused
+    ]
+    for index, item in enumerate(relevant_contents):
+        logfire.info(f"{index}: {item}")
+    return relevant_contents
+
+
+def build_context(
+    relevant_contents: List[Dict], max_tokens: int = DEFAULT_CONTEXT_TOKENS
+) -> str:
+    """
+    Pack the best chunks into the prompt context, as long as they fit in `max_tokens` estimated tokens.
+
+    A chunk too large for the remaining budget is skipped, the next smaller ones may still fit.
+    """
+    parts = []
+    for item in relevant_contents:
+        part = f"[{len(parts) + 1}] {item['content']}"
+        tokens = estimate_tokens(part)
+        if tokens > max_tokens:
+            continue
+        parts.append(part)
+        max_tokens -= tokens
+    return "\n\n".join(parts)
+
+
+async def rewrite(query: str, cache: QueryCache | None = None):
+    if cache and (queries := await cache.get_rewrite(query)) is not None:
+        logfire.info(f"cached queries: {queries}")
+        return queries
     rewrite_query = rewrite_prompt.format(query=query)
     logfire.info(f"rewrite_query: {rewrite_query}")
     with logfire.span("chat.llm_rewrite"):
         try:
-            response = sm.generate_text(
+            response = await get_llm().generate_text(
                 prompt=rewrite_query,
-                llm_model="gpt-4o-mini",
+                model="gpt-4o-mini",
             )
             logfire.info(f"raw response: {response}")
             response, queries = try_parse_json_object(response)
@@ -111,19 +514,161 @@ async def rewrite(query: str):
         except Exception as e:
             logfire.exception(f"llm_rewrite error: {e}")
             return []
+        if cache and queries:
+            await cache.set_rewrite(query, queries)
         return queries
 
 
-async def chat(query: str):
-    queries = await rewrite(query=query)
-    queries.append(query)
-    relevant_contents = await search_relevant_contents(queries=queries)
-    prompt = query_prompt.format(relevant_contents=relevant_contents, query=query)
+async def _rewrite_and_search(
+    milvus: AsyncMilvusStorage,
+    query: str,
+    cache: QueryCache | None = None,
+    params: SearchParams | None = None,
+) -> Tuple[List[List[Dict]], int]:
+    queries = await rewrite(query=query, cache=cache)
+    if not queries:
+        return [], 0
+    return await _search_queries(milvus=milvus, queries=queries, params=params)
+
+
+async def retrieve(
+    milvus: AsyncMilvusStorage,
+    query: str,
+    cache: QueryCache | None = None,
+    confidence_score: float | None = None,
+    max_wait: float | None = None,
+    top_k: int = DEFAULT_TOP_K,
+    params: SearchParams | None = None,
+) -> Tuple[List[Dict], bool]:
+    """
+    Speculative retrieval: the original query is searched right away, concurrently with the LLM rewrite,
+    and the rewritten variants are searched as soon as the rewrite returns. Their hits are fused.
+
+    The rewrite is then off the critical path, and generation can start before it completes.
+
+    :param confidence_score: when the cosine similarity between the original query and its best dense match
+        reaches this score, the variants are not waited for, see `dense_confidence`.
+    :param max_wait: seconds after which the variants still in flight are dropped.
+    :param top_k: the number of chunks returned.
+    :param params: the search parameters of this request, defaults to those of the collection.
+    :return: the fused chunks, and whether retrieval was degraded: a query or variant failed to be embedded or
+        searched. Degraded results should not be cached.
+    """
+    start = time.perf_counter()
+
+    variants = asyncio.create_task(
+        _rewrite_and_search(milvus=milvus, query=query, cache=cache, params=params)
+    )
+    try:
+        search = _search_queries(milvus=milvus, queries=[query], params=params)
+        if confidence_score is None:
+            result_lists, failed = await search
+        else:
+            (result_lists, failed), confidence = await asyncio.gather(
+                search, dense_confidence(milvus=milvus, query=query, params=params)
+            )
+            if result_lists and confidence >= confidence_score:
+                logfire.info(
+                    f"retrieve: original query is confident ({confidence:.4f})."
+                )
+                return fuse_results(result_lists, top_k=top_k), False
+
+        timeout = (
+            None
+            if max_wait is None
+            else max(0.0, max_wait - (time.perf_counter() - start))
+        )
+        done, _ = await asyncio.wait({variants}, timeout=timeout)
+        if variants in done:
+            variant_lists, variants_failed = variants.result()
+            result_lists += variant_lists
+            failed += variants_failed
+        else:
+            logfire.warning(f"retrieve: variants not back after {max_wait}s, dropped.")
+        return fuse_results(result_lists, top_k=top_k), failed > 0
+    finally:
+        variants.cancel()
+
+
+async def chat(
+    query: str,
+    milvus: AsyncMilvusStorage,
+    cache: QueryCache | None = None,
+    replay_answer: bool = True,
+    record_answer: bool = True,
+    params: SearchParams | None = None,
+):
+    """
+    Answer a query from the documents, streaming the answer chunks.
+
+    :param cache: the query cache, disabled by default.
+    :param replay_answer: whether a cached answer may be replayed.
+    :param record_answer: whether the answer may be cached, only answers streamed to completion from a
+        complete retrieval are.
+    :param params: the search parameters of this request, defaults to those of the collection. Contexts and
+        answers are only cached for the collection parameters, the rewrite cache is still used.
+    """
+    if params is not None:
+        replay_answer = record_answer = False
+    if cache and replay_answer:
+        if (chunks := await cache.get_answer(query, query_prompt)) is not None:
+            logfire.info(f"replaying cached answer of {len(chunks)} chunks")
+            async for chunk in replay(
+                chunks, interval=settings.get("cache.REPLAY_INTERVAL", 0.0)
+            ):
+                yield chunk
+            return
+
+    relevant_contents = None
+    degraded = False
+    query_embedding = None
+    compressor = get_context_compressor()
+    cache_contexts = cache is not None and params is None
+    if cache_contexts or compressor:
+        # Requested as the search requests it, so the search reuses this embedding instead of embedding again.
+        metadata = _collection_metadata.get("anyio") or collection_metadata()
+        try:
+            query_embedding = await get_embedding_batcher(
+                model=metadata["model"], dimensions=request_dimensions(metadata)
+            ).embed(query)
+        except Exception as e:
+            # Retrieval embeds on its own, the context cache and the compression are only skipped.
+            logfire.warning(f"query embedding failed, skipping the context cache: {e}")
+    if cache_contexts and query_embedding is not None:
+        relevant_contents = await cache.get_contexts(query_embedding)
+        logfire.info(f"query cache stats: {cache.stats()}")
+    if relevant_contents is None:
+        relevant_contents, degraded = await retrieve(
+            milvus=milvus,
+            query=query,
+            cache=cache,
+            confidence_score=settings.get("retrieval.CONFIDENCE_SCORE"),
+            max_wait=settings.get("retrieval.MAX_WAIT"),
+            top_k=settings.get("retrieval.TOP_K", DEFAULT_TOP_K),
+            params=params,
+        )
+        if degraded or not relevant_contents:
+            logfire.warning("retrieval is empty or degraded, nothing will be cached.")
+        elif cache_contexts and query_embedding is not None:
+            await cache.set_contexts(query_embedding, relevant_contents)
+    if reranker := get_reranker():
+        relevant_contents = await reranker.rerank(query, relevant_contents)
+    if compressor and query_embedding is not None:
+        with logfire.span("chat.compress"):
+            relevant_contents = await compressor.compress(
+                query_embedding, relevant_contents
+            )
+    context = build_context(
+        relevant_contents,
+        max_tokens=settings.get("retrieval.CONTEXT_TOKENS", DEFAULT_CONTEXT_TOKENS),
+    )
+    prompt = query_prompt.format(relevant_contents=context, query=query)
     logfire.info(f"prompt: {prompt}")
+    chunks = []
     with logfire.span("chat.llm_generate"):
-        for chunk in sm.generate_text(
-            prompt=prompt, llm_model="gpt-4o-mini", stream=True
-        ):
+        async for chunk in get_llm().stream_text(prompt=prompt, model="gpt-4o-mini"):
             logfire.info(f"sending chunk: {chunk}")
+            chunks.append(chunk)
             yield chunk
-            await asyncio.sleep(0)
+    if cache and record_answer and relevant_contents and not degraded:
+        await cache.set_answer(query, query_prompt, chunks)
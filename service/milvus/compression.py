@@ -0,0 +1,255 @@
+import logging
+import re
+import typing as t
+from collections import OrderedDict
+
+import numpy as np
+
+from conf import settings
+from core.data_processor.constants import TEXT_SPLITTERS
+from utils.llm import (
+    DEFAULT_QUERY_EMBEDDING_DELAY,
+    DEFAULT_QUERY_EMBEDDING_RETRIES,
+    SimpleLLM,
+    estimate_tokens,
+    get_llm,
+)
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_CHUNK_TOKENS = 128
+DEFAULT_NEIGHBORS = 1
+DEFAULT_COMPRESSION_CACHE_ENTRIES = 4096
+
+# Latin sentence ends, the documents mix them with the CJK punctuation of `TEXT_SPLITTERS`.
+_LATIN_SENTENCE_END = r"(?<=[.!?])\s+"
+
+
+def sentence_spans(
+    text: str, separators: t.Sequence[str] = TEXT_SPLITTERS
+) -> t.List[t.Tuple[int, int]]:
+    """
+    (start, end) offsets of the sentences of `text`, a sentence keeps its trailing punctuation.
+    """
+    pattern = re.compile(
+        "|".join(
+            [re.escape(separator) for separator in separators] + [_LATIN_SENTENCE_END]
+        )
+    )
+    spans = []
+    start = 0
+    for end in [match.end() for match in pattern.finditer(text)] + [len(text)]:
+        chunk_start, chunk_end = start, end
+        while chunk_start < chunk_end and text[chunk_start].isspace():
+            chunk_start += 1
+        while chunk_end > chunk_start and text[chunk_end - 1].isspace():
+            chunk_end -= 1
+        if chunk_start < chunk_end:
+            spans.append((chunk_start, chunk_end))
+        start = end
+    return spans
+
+
+def shorten(matrix: np.ndarray, dimensions: int) -> np.ndarray:
+    """
+    Shorten unit Matryoshka embeddings to their first `dimensions`, L2-normalized again, as `truncate_embedding`.
+    """
+    if matrix.shape[1] <= dimensions:
+        return matrix
+    matrix = matrix[:, :dimensions]
+    return matrix / np.maximum(np.linalg.norm(matrix, axis=1, keepdims=True), 1e-12)
+
+
+class ContextCompressor:
+    """
+    Extractive compression of retrieved chunks.
+
+    Each chunk is split into sentences, which are scored against the query embedding by cosine similarity.
+    The best sentences are kept, each with its neighbors, until the chunk reaches its token budget; the kept
+    sentences stay in their original order. Sentence embeddings are requested once per chunk and kept in an
+    LRU, so popular chunks are compressed without any embedding request.
+    """
+
+    def __init__(
+        self,
+        model: str = "text-embedding-3-small",
+        llm: t.Optional[SimpleLLM] = None,
+        max_chunk_tokens: int = DEFAULT_CHUNK_TOKENS,
+        neighbors: int = DEFAULT_NEIGHBORS,
+        max_cache_entries: int = DEFAULT_COMPRESSION_CACHE_ENTRIES,
+    ):
+        """
+        :param model: the embedding model, the same as the query embedding.
+        :param llm: the client used to embed sentences, defaults to the shared one, see `get_llm`.
+        :param max_chunk_tokens: the estimated token budget of a compressed chunk.
+        :param neighbors: the sentences kept on each side of a selected sentence.
+        :param max_cache_entries: the number of chunks whose sentence embeddings are kept in memory.
+        """
+        self.model = model
+        self.llm = llm or get_llm()
+        self.max_chunk_tokens = max_chunk_tokens
+        self.neighbors = neighbors
+        self.max_cache_entries = max_cache_entries
+        # chunk content -> (sentence spans, unit sentence embeddings)
+        self._cache: OrderedDict[
+            str, t.Tuple[t.List[t.Tuple[int, int]], np.ndarray]
+        ] = OrderedDict()
+
+    async def _sentences(
+        self, contents: t.List[str]
+    ) -> t.List[t.Optional[t.Tuple[t.List[t.Tuple[int, int]], np.ndarray]]]:
+        """
+        Sentence spans and embeddings of every chunk, None for chunks whose sentences could not be embedded.
+        """
+        results = [self._cache.get(content) for content in contents]
+        missing = {
+            content: sentence_spans(content)
+            for content, result in zip(contents, results)
+            if result is None
+        }
+        inputs = [
+            content[start:end]
+            for content, spans in missing.items()
+            for start, end in spans
+        ]
+        # The answer waits on these embeddings: query retries, as `get_embedding_batcher`, not those of ingestion.
+        embeddings = (
+            await self.llm.embed_many(
+                model=self.model,
+                inputs=inputs,
+                max_retries=settings.get(
+                    "embedding.QUERY_RETRIES", DEFAULT_QUERY_EMBEDDING_RETRIES
+                ),
+                delay=settings.get(
+                    "embedding.QUERY_RETRY_DELAY", DEFAULT_QUERY_EMBEDDING_DELAY
+                ),
+            )
+            if inputs
+            else []
+        )
+
+        position = 0
+        for content, spans in missing.items():
+            vectors = embeddings[position : position + len(spans)]
+            position += len(spans)
+            if any(vector is None for vector in vectors):
+                continue
+            matrix = np.asarray(vectors, dtype=np.float32)
+            matrix /= np.maximum(np.linalg.norm(matrix, axis=1, keepdims=True), 1e-12)
+            self._cache[content] = (spans, matrix)
+            while len(self._cache) > self.max_cache_entries:
+                self._cache.popitem(last=False)
+
+        for index, content in enumerate(contents):
+            if content in self._cache:
+                self._cache.move_to_end(content)
+                results[index] = self._cache[content]
+        return results
+
+    def _select(
+        self, content: str, spans: t.List[t.Tuple[int, int]], scores: np.ndarray
+    ) -> str:
+        selected: t.Set[int] = set()
+        tokens = 0
+        for best in np.argsort(-scores):
+            window = range(
+                max(0, best - self.neighbors),
+                min(len(spans), best + self.neighbors + 1),
+            )
+            added = [index for index in window if index not in selected]
+            cost = sum(
+                estimate_tokens(content[slice(*spans[index])]) for index in added
+            )
+            if selected and tokens + cost > self.max_chunk_tokens:
+                break
+            selected.update(added)
+            tokens += cost
+
+        parts = []
+        previous = None
+        for index in sorted(selected):
+            start, end = spans[index]
+            if previous is not None and index != previous + 1:
+                parts.append(" … ")
+            elif previous is not None:
+                # Contiguous sentences keep their original separator.
+                start = spans[previous][1]
+            parts.append(content[start:end])
+            previous = index
+        return "".join(parts)
+
+    async def compress(
+        self,
+        query_embedding: t.List[float],
+        relevant_contents: t.List[t.Dict[str, t.Any]],
+    ) -> t.List[t.Dict[str, t.Any]]:
+        """
+        Compress the content of every retrieved chunk, chunks already within budget are left untouched.
+
+        :param query_embedding: the embedding of the user query, the sentence embeddings are shortened to its size.
+        :param relevant_contents: the retrieved chunks, with their text in "content".
+        :return: the chunks with compressed content, in the same order.
+        """
+        long_chunks = [
+            index
+            for index, item in enumerate(relevant_contents)
+            if estimate_tokens(item["content"]) > self.max_chunk_tokens
+        ]
+        if not long_chunks:
+            return relevant_contents
+
+        sentences = await self._sentences(
+            [relevant_contents[index]["content"] for index in long_chunks]
+        )
+        query = np.asarray(query_embedding, dtype=np.float32)
+        query = query / max(float(np.linalg.norm(query)), 1e-12)
+
+        # Score the sentences of every chunk in one matrix product.
+        embedded = [result for result in sentences if result is not None]
+        scores = (
+            shorten(np.concatenate([matrix for _, matrix in embedded]), len(query))
+            @ query
+            if embedded
+            else np.empty(0, dtype=np.float32)
+        )
+
+        before = sum(estimate_tokens(item["content"]) for item in relevant_contents)
+        relevant_contents = list(relevant_contents)
+        position = 0
+        for index, result in zip(long_chunks, sentences):
+            if result is None:
+                continue
+            spans, _ = result
+            item = relevant_contents[index]
+            relevant_contents[index] = {
+                **item,
+                "content": self._select(
+                    item["content"], spans, scores[position : position + len(spans)]
+                ),
+            }
+            position += len(spans)
+        after = sum(estimate_tokens(item["content"]) for item in relevant_contents)
+        logger.info(f"Compressed retrieved contents from ~{before} to ~{after} tokens.")
+        return relevant_contents
+
+
+_default_compressor: t.Optional[ContextCompressor] = None
+
+
+def get_context_compressor() -> t.Optional[ContextCompressor]:
+    """
+    The process-wide context compressor, None when compression is disabled in settings.
+    """
+    global _default_compressor
+    if not settings.get("retrieval.COMPRESSION", False):
+        return None
+    if _default_compressor is None:
+        _default_compressor = ContextCompressor(
+            max_chunk_tokens=settings.get(
+                "retrieval.COMPRESSION_CHUNK_TOKENS", DEFAULT_CHUNK_TOKENS
+            ),
+            neighbors=settings.get(
+                "retrieval.COMPRESSION_NEIGHBORS", DEFAULT_NEIGHBORS
+            ),
+        )
+    return _default_compressor
@@ -0,0 +1,260 @@
+import asyncio
+import hashlib
+import logging
+import re
+import time
+import typing as t
+from abc import ABC, abstractmethod
+from collections import Counter
+
+import httpx
+import logfire
+
+from conf import settings
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_RERANK_BATCH_SIZE = 32
+# The length (in tokens) of a typical chunk, for the length normalization of `LexicalScorer`.
+DEFAULT_LEXICAL_AVERAGE_LENGTH = 200
+
+# Latin words, or single CJK characters.
+_TOKEN = re.compile(r"[a-z0-9_]+|[㐀-鿿豈-﫿]")
+
+
+class BaseScorer(ABC):
+    """
+    interface for rerank scorers, higher scores are more relevant.
+    """
+
+    @abstractmethod
+    async def score(self, query: str, documents: t.List[str]) -> t.List[float]:
+        """
+        Score every document against the query, in document order.
+        """
+        raise NotImplementedError("Subclass should implement this method.")
+
+
+class LexicalScorer(BaseScorer):
+    """
+    BM25 term saturation and length normalization, without IDF, so it needs no index nor model. Cheap, and good
+    at promoting chunks that contain the identifiers of the query.
+
+    IDF computed over the candidates would change with every candidate list, so the score of a chunk only
+    depends on the query and the chunk instead: the share of query terms it matches, each saturated, in [0, 1).
+    Scores are comparable across requests, and so is a `rerank.THRESHOLD` on them.
+    """
+
+    def __init__(
+        self,
+        k1: float = 1.2,
+        b: float = 0.75,
+        average_length: float = DEFAULT_LEXICAL_AVERAGE_LENGTH,
+    ):
+        """
+        :param average_length: the reference length (in tokens) of a chunk, longer ones are penalized.
+        """
+        self.k1 = k1
+        self.b = b
+        self.average_length = average_length
+
+    @staticmethod
+    def tokenize(text: str) -> t.List[str]:
+        return _TOKEN.findall(text.lower())
+
+    async def score(self, query: str, documents: t.List[str]) -> t.List[float]:
+        terms = set(self.tokenize(query))
+        if not terms:
+            return [0.0] * len(documents)
+
+        scores = []
+        for document in documents:
+            count = Counter(self.tokenize(document))
+            length = sum(count.values())
+            norm = self.k1 * (1 - self.b + self.b * length / self.average_length)
+            score = sum(
+                count[term] / (count[term] + norm) for term in terms if term in count
+            )
+            scores.append(score / len(terms))
+        return scores
+
+
+class HttpScorer(BaseScorer):
+    """
+    Remote rerank endpoint following the Cohere/Jina API: `{"model", "query", "documents"}` in,
+    `{"results": [{"index", "relevance_score"}]}` out.
+    """
+
+    def __init__(
+        self, url: str, model: str, api_key: str | None = None, timeout: float = 5.0
+    ):
+        headers = {"Authorization": f"Bearer {api_key}"} if api_key else {}
+        self.client = httpx.AsyncClient(headers=headers, timeout=timeout)
+        self.url = url
+        self.model = model
+
+    async def score(self, query: str, documents: t.List[str]) -> t.List[float]:
+        resp = await self.client.post(
+            self.url,
+            json={"model": self.model, "query": query, "documents": documents},
+        )
+        resp.raise_for_status()
+        scores = [0.0] * len(documents)
+        for result in resp.json()["results"]:
+            scores[result["index"]] = result["relevance_score"]
+        return scores
+
+
+class CrossEncoderScorer(BaseScorer):
+    """
+    Local cross-encoder, run on CPU in a worker thread. Needs `sentence-transformers`, which is not a
+    dependency of the project.
+    """
+
+    def __init__(self, model: str = "BAAI/bge-reranker-base"):
+        from sentence_transformers import CrossEncoder
+
+        self.model = CrossEncoder(model, device="cpu")
+
+    async def score(self, query: str, documents: t.List[str]) -> t.List[float]:
+        scores = await asyncio.to_thread(
+            self.model.predict, [(query, document) for document in documents]
+        )
+        return [float(score) for score in scores]
+
+
+class DeterministicScorer(BaseScorer):
+    """
+    Stand-in scorer for tests: a stable pseudo-random score in [0, 1) per (query, document) pair.
+    """
+
+    def __init__(self):
+        self.calls: t.List[int] = []
+
+    async def score(self, query: str, documents: t.List[str]) -> t.List[float]:
+        self.calls.append(len(documents))
+        return [
+            int.from_bytes(
+                hashlib.sha256(f"{query}\0{document}".encode("utf-8")).digest()[:8],
+                "big",
+            )
+            / 2**64
+            for document in documents
+        ]
+
+
+class Reranker:
+    """
+    Rerank retrieved chunks with a scorer, and cut off the weak ones.
+
+    Candidates are scored in concurrent batches, then only those scoring at least `threshold` are kept, at most
+    `top_n` of them. When the scorer fails, the candidates are kept in their retrieval order: reranking is an
+    improvement, not a requirement to answer.
+    """
+
+    def __init__(
+        self,
+        scorer: BaseScorer,
+        batch_size: int = DEFAULT_RERANK_BATCH_SIZE,
+        threshold: float | None = None,
+        top_n: int | None = None,
+    ):
+        """
+        :param scorer: scores the candidates.
+        :param batch_size: the number of candidates per scorer call.
+        :param threshold: the minimum score of a kept candidate, disabled by default.
+        :param top_n: the maximum number of kept candidates, all by default.
+        """
+        self.scorer = scorer
+        self.batch_size = batch_size
+        self.threshold = threshold
+        self.top_n = top_n
+
+    async def rerank(
+        self, query: str, relevant_contents: t.List[t.Dict[str, t.Any]]
+    ) -> t.List[t.Dict[str, t.Any]]:
+        """
+        :param query: the user query.
+        :param relevant_contents: the candidates, with their text in "content".
+        :return: the kept candidates with their "rerank_score", best first, or the candidates as they are when
+            the scorer fails.
+        """
+        if not relevant_contents:
+            return relevant_contents
+
+        start = time.perf_counter()
+        with logfire.span("chat.rerank"):
+            try:
+                batches = await asyncio.gather(
+                    *(
+                        self.scorer.score(
+                            query,
+                            [
+                                item["content"]
+                                for item in relevant_contents[
+                                    index : index + self.batch_size
+                                ]
+                            ],
+                        )
+                        for index in range(0, len(relevant_contents), self.batch_size)
+                    )
+                )
+            except Exception as e:
+                logfire.error(f"Rerank failed, keeping the retrieval order: {e!r}")
+                return relevant_contents
+            scores = [score for batch in batches for score in batch]
+            ranked = sorted(
+                (
+                    {**item, "rerank_score": score}
+                    for item, score in zip(relevant_contents, scores)
+                    if self.threshold is None or score >= self.threshold
+                ),
+                key=lambda item: item["rerank_score"],
+                reverse=True,
+            )[: self.top_n]
+        logger.info(
+            f"Reranked {len(relevant_contents)} chunks, kept {len(ranked)}, "
+            f"in {(time.perf_counter() - start) * 1000:.1f}ms."
+        )
+        return ranked
+
+
+_default_reranker: t.Optional[Reranker] = None
+
+
+def get_reranker() -> t.Optional[Reranker]:
+    """
+    The process-wide reranker, None when `rerank.SCORER` is not set.
+
+    `rerank.SCORER` is one of "lexical", "http" (with `rerank.URL`, `rerank.MODEL` and `rerank.API_KEY`) or
+    "cross_encoder" (with `rerank.MODEL`). Call it at startup, so a bad setting fails there rather than on
+    every query.
+
+    :raise ValueError: if `rerank.SCORER` is unknown.
+    """
+    global _default_reranker
+    name = settings.get("rerank.SCORER")
+    if not name:
+        return None
+    if _default_reranker is None:
+        if name == "lexical":
+            scorer = LexicalScorer()
+        elif name == "http":
+            scorer = HttpScorer(
+                url=settings.rerank.URL,
+                model=settings.rerank.MODEL,
+                api_key=settings.get("rerank.API_KEY"),
+            )
+        elif name == "cross_encoder":
+            scorer = CrossEncoderScorer(
+                model=settings.get("rerank.MODEL", "BAAI/bge-reranker-base")
+            )
+        else:
+            raise ValueError(f"Unknown rerank scorer: {name}")
+        _default_reranker = Reranker(
+            scorer=scorer,
+            batch_size=settings.get("rerank.BATCH_SIZE", DEFAULT_RERANK_BATCH_SIZE),
+            threshold=settings.get("rerank.THRESHOLD"),
+            top_n=settings.get("rerank.TOP_N"),
+        )
+    return _default_reranker
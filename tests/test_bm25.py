@@ -0,0 +1,118 @@
+import math
+from collections import Counter
+
+import numpy as np
+import pytest
+
+from core.storage.bm25 import BigramTokenizer, BM25Index
+
+DOCUMENTS = {
+    1: "anyio task groups cancel every child task on error",
+    2: "使用 anyio 创建任务组，任务组会取消所有子任务",
+    3: "memory object streams send and receive items",
+    4: "取消范围可以设置超时",
+    5: "task group task group task group",
+}
+
+
+def test_bigram_tokenizer():
+    assert BigramTokenizer().tokenize("AnyIO 任务组, 取 task_group") == [
+        "anyio",
+        "任务",
+        "务组",
+        "取",
+        "task_group",
+    ]
+
+
+def bm25(query, documents, k1=1.2, b=0.75):
+    """
+    Textbook BM25 of whitespace-separated documents, the reference of `BM25Index`.
+    """
+    counts = [Counter(document.split()) for document in documents]
+    average_length = sum(sum(count.values()) for count in counts) / len(counts)
+    scores = []
+    for count in counts:
+        norm = k1 * (1 - b + b * sum(count.values()) / average_length)
+        score = 0.0
+        for term in set(query.split()) & set(count):
+            df = sum(term in other for other in counts)
+            idf = math.log(1 + (len(counts) - df + 0.5) / (df + 0.5))
+            score += idf * count[term] * (k1 + 1) / (count[term] + norm)
+        scores.append(score)
+    return scores
+
+
+def test_bm25_matches_reference():
+    # Latin text only, the reference doesn't tokenize CJK.
+    documents = {chunk_id: DOCUMENTS[chunk_id] for chunk_id in (1, 3, 5)}
+    index = BM25Index()
+    index.add(documents.items())
+    query = "task group cancel"
+
+    expected = bm25(query, list(documents.values()))
+    hits = index.search(query, limit=10)
+    # Documents without any term of the query aren't hits.
+    assert [chunk_id for chunk_id, _ in hits] == [5, 1]
+    assert [score for _, score in hits] == pytest.approx(
+        [expected[2], expected[0]], rel=1e-5
+    )
+
+
+def test_bm25_add_delete_and_persist(tmp_path):
+    index = BM25Index(merge_ratio=100)
+    index.add(list(DOCUMENTS.items())[:3])
+    index.add(list(DOCUMENTS.items())[3:])
+    assert [chunk_id for chunk_id, _ in index.search("取消任务")] == [2, 4]
+
+    index.delete([2])
+    index.add([(1, "超时会取消任务")])
+    assert len(index) == 4
+    assert [chunk_id for chunk_id, _ in index.search("取消任务")] == [1, 4]
+
+    index.save(tmp_path)
+    loaded = BM25Index.load(tmp_path)
+    assert loaded.search("取消任务") == pytest.approx(index.search("取消任务"))
+    # Mapped copy-on-write, the saved files are untouched by changes.
+    loaded.delete([1])
+    loaded.add([(6, "cancel scope timeout")])
+    assert [chunk_id for chunk_id, _ in loaded.search("取消 timeout")] == [6, 4]
+    assert [chunk_id for chunk_id, _ in BM25Index.load(tmp_path).search("超时")] == [
+        1,
+        4,
+    ]
+
+
+def test_bm25_saves_deltas(tmp_path):
+    rng = np.random.default_rng(0)
+    words = [f"w{i}" for i in range(30)]
+    index = BM25Index(merge_ratio=100, max_deltas=3)
+    headers = []
+    for step in range(8):
+        index.add(
+            (int(chunk_id), " ".join(rng.choice(words, size=6)))
+            for chunk_id in rng.integers(0, 40, size=5)
+        )
+        index.delete(rng.integers(0, 40, size=2).tolist())
+        headers.append(index.save(tmp_path))
+        # Only the first save writes a base, the others write deltas.
+        assert len(list(tmp_path.glob("base.*"))) == 1
+
+        loaded = BM25Index.load(tmp_path, merge_ratio=100, max_deltas=3)
+        assert len(loaded) == len(index)
+        for query in ("w1 w2", "w3 w17 w29", "w5"):
+            assert loaded.search(query, limit=10) == pytest.approx(
+                index.search(query, limit=10)
+            )
+        # The loaded index saves incrementally too.
+        index = loaded
+
+    # Readers of the previous header keep working, older ones are removed.
+    assert len(BM25Index.load(tmp_path, headers[-2])) > 0
+    with pytest.raises(FileNotFoundError):
+        BM25Index.load(tmp_path, headers[-3])
+    assert len(list(tmp_path.glob("delta.*"))) <= 4
+
+    index.merge()
+    index.save(tmp_path)
+    assert len(list(tmp_path.glob("base.*"))) == 2
@@ -0,0 +1,55 @@
+import numpy as np
+import pytest
+
+from service.milvus.compression import ContextCompressor, sentence_spans, shorten
+
+
+class FakeLLM:
+    """Embeds a sentence on two axes: mentions of anyio, and everything else."""
+
+    def __init__(self):
+        self.calls = []
+
+    async def embed_many(self, model, inputs, max_retries, delay):
+        # The retries of query embeddings, not the backoff of ingestion.
+        assert (max_retries, delay) == (2, 0.05)
+        self.calls.append(list(inputs))
+        return [[1.0, 0.0] if "anyio" in text else [0.0, 1.0] for text in inputs]
+
+
+def test_sentence_spans():
+    text = "第一句。第二句！ Third one. Fourth?\n\nfifth"
+    assert [text[start:end] for start, end in sentence_spans(text)] == [
+        "第一句。",
+        "第二句！",
+        "Third one.",
+        "Fourth?",
+        "fifth",
+    ]
+
+
+@pytest.mark.asyncio
+async def test_compress_keeps_relevant_sentences():
+    llm = FakeLLM()
+    compressor = ContextCompressor(llm=llm, max_chunk_tokens=12, neighbors=0)
+    filler = "Something unrelated is said here."
+    content = f"{filler} {filler} Use anyio to run tasks. {filler} {filler}"
+    relevant_contents = [{"id": 1, "content": content}, {"id": 2, "content": "short"}]
+
+    compressed = await compressor.compress([1.0, 0.0], relevant_contents)
+
+    assert compressed[0]["content"].startswith("Use anyio to run tasks.")
+    assert len(compressed[0]["content"]) < len(content)
+    assert compressed[1] == relevant_contents[1]
+    assert relevant_contents[0]["content"] == content
+
+    # Sentence embeddings of the chunk are cached.
+    await compressor.compress([1.0, 0.0], relevant_contents)
+    assert len(llm.calls) == 1
+
+
+def test_shorten():
+    matrix = np.array([[0.6, 0.8, 0.0], [0.0, 0.6, 0.8]], dtype=np.float32)
+
+    assert shorten(matrix, 3) is matrix
+    assert np.allclose(shorten(matrix, 2), [[0.6, 0.8], [0.0, 1.0]])
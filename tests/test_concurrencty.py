@@ -1,5 +1,7 @@
+import asyncio
+
 import pytest
-from utils.concurrency import iterate_in_threadpool
+from utils.concurrency import batched, buffered, iterate_in_threadpool
 
 
 @pytest.mark.asyncio
@@ -11,3 +13,33 @@ async def test_iterate_in_threadpool():
     async for item in iterate_in_threadpool(mock_iterator()):
         print(item)
         assert item in range(5)
+
+
+@pytest.mark.asyncio
+async def test_buffered_applies_backpressure():
+    produced = []
+
+    async def source():
+        for i in range(10):
+            produced.append(i)
+            yield i
+
+    consumed = []
+    async for batch in batched(buffered(source(), maxsize=2), size=3):
+        await asyncio.sleep(0.01)
+        # The producer never runs further ahead than the buffer (plus the item it is blocked on).
+        assert len(produced) - len(consumed) - len(batch) <= 3
+        consumed += batch
+
+    assert consumed == list(range(10))
+
+
+@pytest.mark.asyncio
+async def test_buffered_propagates_errors():
+    async def source():
+        yield 1
+        raise ValueError("boom")
+
+    with pytest.raises(ValueError):
+        async for _ in buffered(source(), maxsize=2):
+            pass
@@ -0,0 +1,35 @@
+import typing as t
+
+import pytest
+from langchain_core.documents import Document
+
+from core.data_processor.base import BaseDataProcessor
+from utils.run_config import RunConfig
+
+
+class TextProcessor(BaseDataProcessor):
+    def load(self, file_path) -> t.List[Document]:
+        with open(file_path) as f:
+            return [Document(page_content=f.read())]
+
+    def split(self, documents: t.List[Document]) -> t.List[Document]:
+        return self.text_splitter.split_documents(documents)
+
+
+@pytest.mark.asyncio
+async def test_astream_parses_in_process_pool(tmp_path):
+    for i in range(5):
+        (tmp_path / f"{i}.txt").write_text(f"document {i}\n\n" + "anyio\n" * 50)
+
+    processor = TextProcessor(
+        file_path=tmp_path,
+        run_config=RunConfig(max_workers=2),
+        chunk_size=100,
+        chunk_overlap=20,
+    )
+    results = {path: chunks async for path, chunks in processor.astream()}
+
+    assert sorted(results) == sorted(str(path) for path in processor.files)
+    for path, chunks in results.items():
+        assert len(chunks) > 1
+        assert all(len(chunk.page_content) <= 100 for chunk in chunks)
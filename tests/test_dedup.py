@@ -0,0 +1,27 @@
+from core.data_processor.dedup import ChunkDeduplicator
+
+BANNER = (
+    "You are reading the documentation for the stable release of AnyIO. "
+    "Task groups run tasks concurrently and cancel the remaining ones when one of them fails. "
+)
+
+
+def test_exact_and_near_duplicates():
+    dedup = ChunkDeduplicator(threshold=0.8)
+
+    assert dedup.add(1, BANNER, source="a.md") == (1, False)
+    # Whitespace and case differences are exact duplicates.
+    assert dedup.add(2, "  " + BANNER.upper(), source="b.md") == (1, True)
+    # A small edit is a near duplicate.
+    assert dedup.add(3, BANNER.replace("stable", "latest"), "c.md") == (1, True)
+    assert dedup.add(4, "Memory object streams move objects.", "d.md") == (4, False)
+
+    assert dedup.sources == {1: ["a.md", "b.md", "c.md"], 4: ["d.md"]}
+    assert dedup.duplicates == 2
+
+
+def test_exact_only():
+    dedup = ChunkDeduplicator(threshold=1.0)
+    assert dedup.add(1, BANNER, source="a.md") == (1, False)
+    assert dedup.add(2, BANNER.replace("stable", "latest"), "b.md") == (2, False)
+    assert dedup.add(1, BANNER, source="c.md") == (1, True)
@@ -0,0 +1,47 @@
+import pytest
+
+from utils.embedding_cache import EmbeddingCache
+
+
+def test_embedding_cache_persists(tmp_path):
+    path = tmp_path / "embeddings.sqlite3"
+    key = EmbeddingCache.make_key(model="fake", text="hello  world")
+    assert key == EmbeddingCache.make_key(model="fake", text=" hello world\n")
+    assert key != EmbeddingCache.make_key(
+        model="fake", text="hello world", dimensions=256
+    )
+
+    cache = EmbeddingCache(path=path)
+    cache.put(key, [0.5, 0.25])
+    cache.close()
+
+    cache = EmbeddingCache(path=path)
+    assert cache.get_many([key, "missing"]) == [[0.5, 0.25], None]
+    assert cache.stats()["hits"] == 1
+    assert cache.stats()["misses"] == 1
+
+
+def test_embedding_cache_evicts_by_size():
+    # Every entry takes 8 bytes, so only two of them fit in memory.
+    cache = EmbeddingCache(path=":memory:", max_memory_bytes=16)
+    for key in ("a", "b", "c"):
+        cache.put(key, [1.0, 2.0])
+
+    assert cache.stats()["memory_entries"] == 2
+    assert cache.stats()["memory_bytes"] == 16
+    # Evicted entries are still served from sqlite.
+    assert cache.get("a") == [1.0, 2.0]
+
+
+@pytest.mark.asyncio
+async def test_embedding_cache_async(tmp_path):
+    path = tmp_path / "embeddings.sqlite3"
+    cache = EmbeddingCache(path=path)
+    await cache.aput_many({"a": [1.0], "b": [2.0]})
+    assert await cache.aget_many(["b", "missing", "a"]) == [[2.0], None, [1.0]]
+    cache.close()
+
+    # Written through to sqlite.
+    cache = EmbeddingCache(path=path)
+    assert await cache.aget_many(["a"]) == [[1.0]]
+    assert cache.stats()["hits"] == 1
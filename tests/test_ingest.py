@@ -0,0 +1,65 @@
+import pytest
+from langchain_core.documents import Document
+
+from core.data_processor.manifest import Manifest, chunk_id
+from service.milvus import chat
+
+FILES = {
+    "a.md": ["shared admonition that fails to embed", "only in a"],
+    "b.md": ["shared admonition that fails to embed", "only in b"],
+    "c.md": ["only in c"],
+}
+
+
+class FakeProcessor:
+    def __init__(self, file_path):
+        pass
+
+    async def astream(self, files):
+        for path in files:
+            yield path, [Document(page_content=content) for content in FILES[path]]
+
+
+class FakeLLM:
+    embedding_cache = None
+
+    async def embed_many(self, model, inputs, **kwargs):
+        return [None if "fails" in text else [1.0, 0.0] for text in inputs]
+
+
+class FakeMilvus:
+    def __init__(self):
+        self.ids = set()
+
+    async def upsert(self, collection_name, data):
+        self.ids.update(row["id"] for row in data)
+
+
+@pytest.mark.asyncio
+async def test_ingest_retries_files_of_failed_survivors(tmp_path, monkeypatch):
+    monkeypatch.setattr(chat, "MarkdownProcessor", FakeProcessor)
+    monkeypatch.setattr(chat, "get_llm", FakeLLM)
+    manifest = Manifest(tmp_path / "manifest.json")
+    manifest.metadata = {
+        "model": "fake",
+        "dimensions": 2,
+        "precision": "float32",
+        "rescore": False,
+    }
+    milvus = FakeMilvus()
+
+    await chat._ingest_files(
+        milvus=milvus,
+        target="test",
+        files=list(FILES),
+        digests={path: f"digest of {path}" for path in FILES},
+        manifest=manifest,
+    )
+
+    assert milvus.ids == {chunk_id(f"only in {name}") for name in "abc"}
+    # b.md only references the failed chunk through deduplication, it is retried as well.
+    assert {path: entry["hash"] for path, entry in manifest.files.items()} == {
+        "a.md": "",
+        "b.md": "",
+        "c.md": "digest of c.md",
+    }
@@ -0,0 +1,118 @@
+import numpy as np
+import pytest
+
+from core.storage.lancedb import LanceDBStorage, dense_search_args, ivf_pq_params
+from core.storage.milvus import MilvusStorage, SearchParams
+from core.storage.side_store import VectorSideStore
+from utils.llm import truncate_embedding
+
+
+def rows(count: int, dimension: int = 8):
+    vectors = np.random.default_rng(0).standard_normal((count, dimension))
+    return [
+        {
+            "id": index,
+            "vector": vector.tolist(),
+            "content": f"apple {index}" if index % 10 == 0 else f"banana {index}",
+        }
+        for index, vector in enumerate(vectors)
+    ]
+
+
+def test_ivf_pq_params():
+    assert ivf_pq_params(num_rows=1_000_000, dimension=1536) == {
+        "num_partitions": 1000,
+        "num_sub_vectors": 96,
+    }
+    # Small tables keep at least 256 rows per partition.
+    assert ivf_pq_params(num_rows=3000, dimension=264)["num_partitions"] == 11
+    assert ivf_pq_params(num_rows=3000, dimension=264)["num_sub_vectors"] == 33
+
+
+@pytest.mark.asyncio
+async def test_lancedb_storage(tmp_path):
+    storage = await LanceDBStorage.create(uri=str(tmp_path))
+    await storage.create_collection(collection_name="test", dimension=8)
+    data = rows(300)
+
+    stats = await storage.store(collection_name="test", data=data, batch_rows=128)
+    assert stats["batches"] == 3
+    assert await storage.get_collection_size(collection_name="test") == 300
+
+    await storage.upsert(
+        collection_name="test",
+        data=[{**data[0], "content": "cherry"}, {**data[1], "id": 300}],
+    )
+    await storage.delete(collection_name="test", ids=[2, 3])
+    assert await storage.get_collection_size(collection_name="test") == 299
+
+    await storage.create_index(collection_name="test")
+    hits = await storage.search(
+        collection_name="test", data=[data[5]["vector"]], limit=3, refine_factor=4
+    )
+    assert hits[0][0]["id"] == 5
+    # Cosine similarity, as Milvus reports it: 1 for the query vector itself.
+    assert hits[0][0]["distance"] == pytest.approx(1.0, abs=1e-3)
+    assert hits[0][0]["distance"] > hits[0][1]["distance"]
+    assert set(hits[0][0]["entity"]) == {"id", "content"}
+    assert hits[0][0]["entity"]["content"] == "banana 5"
+
+    assert [
+        hit["id"]
+        for hit in await storage.full_text_search(
+            collection_name="test", query="cherry"
+        )
+    ] == [0]
+
+    query = LanceDBStorage.build_hybrid_search_query(data[10]["vector"], "cherry")
+    fused = await storage.hybrid_search(collection_name="test", query=query, limit=3)
+    # The best hit of each leg comes first.
+    assert {fused[0]["id"], fused[1]["id"]} == {0, 10}
+    assert fused[0]["distance"] >= fused[-1]["distance"]
+
+
+@pytest.mark.asyncio
+async def test_lancedb_storage_takes_milvus_queries(tmp_path):
+    storage = await LanceDBStorage.create(uri=str(tmp_path))
+    await storage.create_collection(collection_name="test", dimension=8)
+    data = rows(300)
+    await storage.store(collection_name="test", data=data)
+    await storage.create_index(collection_name="test")
+
+    params = SearchParams(nprobe=4, rescore_factor=3)
+    query = MilvusStorage.build_hybrid_search_query(
+        data[10]["vector"], "apple", params=params, precision="binary"
+    )
+    # Tables keep float32 vectors: the full-precision query is searched, the rescoring candidates refine it.
+    assert dense_search_args(query) == {
+        "data": [data[10]["vector"]],
+        "limit": params.dense_limit,
+        "nprobes": 4,
+        "refine_factor": 3,
+    }
+    fused = await storage.hybrid_search(
+        collection_name="test", query=query, limit=3, vector_store=None
+    )
+    assert fused[0]["id"] == 10
+
+    # Shortened vectors are rescored with the full-size ones of the side store.
+    await storage.create_collection(collection_name="short", dimension=4)
+    await storage.store(
+        collection_name="short",
+        data=[{**row, "vector": truncate_embedding(row["vector"], 4)} for row in data],
+    )
+    store = VectorSideStore(":memory:")
+    store.put_many({row["id"]: row["vector"] for row in data})
+    query = MilvusStorage.build_hybrid_search_query(
+        truncate_embedding(data[7]["vector"], 4),
+        "banana",
+        params=params,
+        rescore_embedding=data[7]["vector"],
+    )
+    fused = await storage.hybrid_search(
+        collection_name="short", query=query, limit=3, vector_store=store
+    )
+    assert fused[0]["id"] == 7
+
+    await storage.drop_collection(collection_name="short")
+    assert await storage.list_collections() == ["test"]
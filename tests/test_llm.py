@@ -0,0 +1,207 @@
+import asyncio
+import typing as t
+from types import SimpleNamespace
+
+import httpx
+import openai
+import pytest
+
+from utils.embedding_cache import EmbeddingCache
+from utils.llm import EmbeddingBatcher, SimpleLLM, pack_batches, truncate_embedding
+
+
+def api_error(error: t.Type[openai.APIStatusError], status: int) -> Exception:
+    response = httpx.Response(
+        status, request=httpx.Request("POST", "https://api.test/embeddings")
+    )
+    return error("error", response=response, body=None)
+
+
+class FakeEmbeddings:
+    def __init__(self, bad: str = None, error: Exception = None):
+        self.bad = bad
+        self.error = error or api_error(openai.BadRequestError, 400)
+        self.calls = []
+
+    async def create(self, input, model, **kwargs):
+        self.calls.append(list(input))
+        if self.bad in input:
+            raise self.error
+        # Answer in reverse order to make sure results are mapped back by index.
+        data = [
+            SimpleNamespace(index=index, embedding=[float(len(text))])
+            for index, text in enumerate(input)
+        ]
+        return SimpleNamespace(data=data[::-1])
+
+
+def fake_llm(embeddings: FakeEmbeddings, cache: EmbeddingCache = None) -> SimpleLLM:
+    llm = SimpleLLM(embedding_cache=cache or EmbeddingCache(path=":memory:"))
+    llm._embedding_client = lambda model: (
+        SimpleNamespace(embeddings=embeddings),
+        model,
+    )
+    return llm
+
+
+@pytest.mark.asyncio
+async def test_embedding_batcher_coalesces_callers():
+    embeddings = FakeEmbeddings(bad="bad")
+    batcher = EmbeddingBatcher(
+        model="fake", llm=fake_llm(embeddings), window=0.01, max_retries=1
+    )
+
+    results = await asyncio.gather(
+        batcher.embed("a"),
+        batcher.embed_many(["bb", "bad"]),
+        batcher.embed("ccc"),
+    )
+
+    assert results == [[1.0], [[2.0], None], [3.0]]
+    # One request for every caller, then the failing batch is bisected.
+    assert sorted(embeddings.calls[0]) == ["a", "bad", "bb", "ccc"]
+    assert batcher.stats()["flushes"] == 1
+
+    # A full batch is flushed without waiting for the window.
+    batcher = EmbeddingBatcher(
+        model="fake", llm=fake_llm(FakeEmbeddings()), window=10, max_batch_inputs=2
+    )
+    assert await asyncio.wait_for(batcher.embed_many(["a", "bb"]), 1) == [
+        [1.0],
+        [2.0],
+    ]
+
+
+@pytest.mark.asyncio
+async def test_embedding_batcher_retries_without_waiting():
+    class FlakyEmbeddings(FakeEmbeddings):
+        async def create(self, input, model, **kwargs):
+            if not self.calls:
+                self.calls.append(list(input))
+                raise api_error(openai.RateLimitError, 429)
+            return await super().create(input, model, **kwargs)
+
+    embeddings = FlakyEmbeddings()
+    batcher = EmbeddingBatcher(model="fake", llm=fake_llm(embeddings), window=0)
+
+    start = asyncio.get_running_loop().time()
+    assert await batcher.embed("a") == [1.0]
+    assert asyncio.get_running_loop().time() - start < 0.5
+    assert len(embeddings.calls) == 2
+
+
+def test_pack_batches():
+    inputs = ["a" * 40] * 5
+    assert pack_batches(inputs, batch_size=2) == [[0, 1], [2, 3], [4]]
+    assert pack_batches(inputs, max_batch_tokens=25) == [[0, 1], [2, 3], [4]]
+
+
+@pytest.mark.asyncio
+async def test_embed_many():
+    embeddings = FakeEmbeddings()
+    inputs = ["a" * i for i in range(1, 8)]
+
+    results = await fake_llm(embeddings).embed_many(
+        model="fake", inputs=inputs, batch_size=3
+    )
+
+    assert results == [[float(i)] for i in range(1, 8)]
+    assert len(embeddings.calls) == 3
+
+
+@pytest.mark.asyncio
+async def test_embed_many_isolates_failure():
+    embeddings = FakeEmbeddings(bad="bad")
+    inputs = ["a", "b", "c", "bad", "d"]
+
+    results = await fake_llm(embeddings).embed_many(
+        model="fake", inputs=inputs, batch_size=2, max_retries=1, delay=0
+    )
+
+    assert results == [[1.0], [1.0], [1.0], None, [1.0]]
+    # The healthy batches are never sent twice.
+    assert embeddings.calls.count(["a", "b"]) == 1
+    assert embeddings.calls.count(["d"]) == 1
+
+
+@pytest.mark.asyncio
+async def test_embed_many_does_not_bisect_rate_limits():
+    embeddings = FakeEmbeddings(bad="bad", error=api_error(openai.RateLimitError, 429))
+    inputs = ["a", "b", "c", "bad"]
+
+    results = await fake_llm(embeddings).embed_many(
+        model="fake", inputs=inputs, max_retries=2, delay=0
+    )
+
+    assert results == [None] * 4
+    # Retried, then given up as a whole.
+    assert embeddings.calls == [inputs, inputs]
+
+
+@pytest.mark.asyncio
+async def test_embed_many_uses_cache():
+    embeddings = FakeEmbeddings()
+    cache = EmbeddingCache(path=":memory:")
+    llm = fake_llm(embeddings, cache=cache)
+
+    await llm.embed_many(model="fake", inputs=["a", "bb", "a"])
+    assert embeddings.calls == [["a", "bb"]]
+
+    results = await llm.embed_many(model="fake", inputs=["bb", " a ", "ccc"])
+    assert results == [[2.0], [1.0], [3.0]]
+    assert embeddings.calls[-1] == ["ccc"]
+    assert cache.stats()["hits"] == 2
+
+
+@pytest.mark.asyncio
+async def test_embed_many_dimensions_are_cached_apart():
+    embeddings = FakeEmbeddings()
+    llm = fake_llm(embeddings)
+
+    await llm.embed_many(model="fake", inputs=["a"])
+    await llm.embed_many(model="fake", inputs=["a"], dimensions=256)
+    await llm.embed_many(model="fake", inputs=["a"], dimensions=256)
+    assert embeddings.calls == [["a"], ["a"]]
+
+
+def test_truncate_embedding():
+    assert truncate_embedding([3.0, 4.0, 12.0], 2) == [0.6, 0.8]
+    assert truncate_embedding([3.0, 4.0], None) == [3.0, 4.0]
+    assert truncate_embedding([3.0, 4.0], 8) == [3.0, 4.0]
+
+
+class FakeCompletions:
+    def __init__(self, events: list):
+        self.events = events
+
+    async def create(self, model, messages, stream=False, **kwargs):
+        prompt = messages[0]["content"]
+
+        async def chunks():
+            for i in range(3):
+                # Simulate network latency between deltas.
+                await asyncio.sleep(0.01)
+                self.events.append(prompt)
+                delta = SimpleNamespace(content=f"{prompt}{i}")
+                yield SimpleNamespace(choices=[SimpleNamespace(delta=delta)])
+
+        return chunks()
+
+
+@pytest.mark.asyncio
+async def test_concurrent_streams_interleave():
+    events = []
+    llm = SimpleLLM(embedding_cache=EmbeddingCache(path=":memory:"))
+    llm.openai_client = SimpleNamespace(
+        chat=SimpleNamespace(completions=FakeCompletions(events))
+    )
+
+    async def consume(prompt: str):
+        return [delta async for delta in llm.stream_text(prompt=prompt)]
+
+    a, b = await asyncio.gather(consume("a"), consume("b"))
+
+    assert a == ["a0", "a1", "a2"]
+    assert b == ["b0", "b1", "b2"]
+    # The second stream starts before the first one finishes.
+    assert events.index("b") < len(events) - events[::-1].index("a") - 1
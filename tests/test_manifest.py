@@ -0,0 +1,40 @@
+from core.data_processor.manifest import Manifest, chunk_id, file_digest
+
+
+def test_chunk_id_is_deterministic():
+    assert chunk_id("hello") == chunk_id("hello")
+    assert chunk_id("hello") != chunk_id("world")
+    assert 0 <= chunk_id("hello") < 2**63
+
+
+def test_manifest_diff(tmp_path):
+    doc = tmp_path / "doc.md"
+    doc.write_text("# anyio")
+
+    manifest = Manifest(tmp_path / "manifest.json")
+    manifest.set_file("a.md", digest=file_digest(doc), chunk_ids=[1, 2])
+    manifest.set_file("b.md", digest="old", chunk_ids=[2, 3])
+    manifest.save()
+
+    manifest = Manifest.load(tmp_path / "manifest.json")
+    added, modified, deleted = manifest.diff(
+        {"a.md": file_digest(doc), "b.md": "new", "c.md": "new"}
+    )
+    assert (added, modified, deleted) == (["c.md"], ["b.md"], [])
+
+    assert manifest.sources() == {1: ["a.md"], 2: ["a.md", "b.md"], 3: ["b.md"]}
+
+    manifest.remove_file("b.md")
+    # Chunk 2 is still referenced by a.md.
+    assert manifest.chunk_ids() == {1, 2}
+
+
+def test_manifest_keeps_metadata(tmp_path):
+    manifest = Manifest(tmp_path / "manifest.json")
+    manifest.metadata = {"model": "fake", "dimensions": 256}
+    manifest.save()
+
+    assert Manifest.load(tmp_path / "manifest.json").metadata == {
+        "model": "fake",
+        "dimensions": 256,
+    }
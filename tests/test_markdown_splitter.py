@@ -0,0 +1,56 @@
+import json
+
+from core.data_processor.markdown_splitter import MarkdownChunker
+
+TEXT = """# Getting started
+
+AnyIO is an asynchronous networking and concurrency library.
+
+## Installation
+
+```python
+# this is not a header
+pip install anyio
+```
+
+## Tasks
+
+{tasks}
+"""
+
+
+def test_chunks_respect_size_and_headers():
+    text = TEXT.format(tasks="Task groups run tasks concurrently.\n" * 40)
+    chunker = MarkdownChunker(chunk_size=200, chunk_overlap=50)
+    chunks = chunker.split_text(text)
+
+    assert all(len(chunk.page_content) <= 200 for chunk in chunks)
+    for chunk in chunks:
+        start = chunk.metadata["start_index"]
+        assert text[start : start + len(chunk.page_content)] == chunk.page_content
+
+    installation = [c for c in chunks if "pip install" in c.page_content]
+    assert installation[0].metadata == {
+        "Header 1": "Getting started",
+        "Header 2": "Installation",
+        "start_index": installation[0].metadata["start_index"],
+    }
+
+    tasks = [c for c in chunks if c.metadata.get("Header 2") == "Tasks"]
+    assert len(tasks) > 1
+    # Chunks end on a separator and consecutive chunks overlap.
+    assert all(c.page_content.endswith("concurrently.") for c in tasks)
+    assert tasks[1].metadata["start_index"] < (
+        tasks[0].metadata["start_index"] + len(tasks[0].page_content)
+    )
+
+
+def test_hard_cut_without_separators():
+    chunks = MarkdownChunker(chunk_size=100, chunk_overlap=10).split_text("a" * 250)
+    assert [len(chunk.page_content) for chunk in chunks] == [100, 100, 50]
+
+
+def test_chunker_config_survives_json():
+    config = MarkdownChunker(chunk_size=256, chunk_overlap=32).config()
+    assert json.loads(json.dumps(config)) == config
+    assert config != MarkdownChunker().config()
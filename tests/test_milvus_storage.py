@@ -0,0 +1,252 @@
+import itertools
+
+import ml_dtypes
+import numpy as np
+import pydantic
+import pytest
+from pymilvus import DataType
+from pymilvus.client.prepare import Prepare
+from pymilvus.grpc_gen.common_pb2 import PlaceholderGroup, PlaceholderType
+
+from core.storage.milvus import (
+    MilvusStorage,
+    SearchParams,
+    quantize_rows,
+    quantize_vector,
+    split_batches,
+)
+from core.storage.milvus_async import AsyncMilvusStorage
+from core.storage.side_store import VectorSideStore
+from core.storage.tuning import EfController
+
+
+class FakeClient:
+    def __init__(self, fail_times: int = 0):
+        self.fail_times = fail_times
+        self.batches = []
+
+    def insert(self, collection_name, data):
+        if data[0]["id"] == 0 and self.fail_times:
+            self.fail_times -= 1
+            raise ConnectionError("transient")
+        self.batches.append([row["id"] for row in data])
+
+
+def fake_storage(client: FakeClient) -> MilvusStorage:
+    storage = MilvusStorage.__new__(MilvusStorage)
+    storage.client = client
+    return storage
+
+
+def rows(count: int):
+    return [{"id": i, "vector": [0.0] * 4, "content": "x" * 10} for i in range(count)]
+
+
+def test_split_batches_by_rows_and_bytes():
+    # Every row is estimated at 8 + 16 + 10 bytes.
+    assert [len(batch) for batch, _ in split_batches(rows(5), max_rows=2)] == [2, 2, 1]
+    assert [len(batch) for batch, _ in split_batches(rows(5), max_bytes=70)] == [
+        2,
+        2,
+        1,
+    ]
+
+
+def test_store_retries_failed_batch_only():
+    client = FakeClient(fail_times=2)
+    stats = fake_storage(client).store(
+        collection_name="test", data=rows(5), batch_rows=2, delay=0
+    )
+
+    assert sorted(client.batches) == [[0, 1], [2, 3], [4]]
+    assert stats["rows"] == 5
+    assert stats["batches"] == 3
+    assert stats["failed_rows"] == 0
+
+
+def test_store_raises_after_retries():
+    client = FakeClient(fail_times=10)
+    with pytest.raises(ConnectionError):
+        fake_storage(client).store(
+            collection_name="test", data=rows(5), batch_rows=2, delay=0
+        )
+    # The healthy batches are still written.
+    assert sorted(client.batches) == [[2, 3], [4]]
+
+
+class FakeAsyncClient(FakeClient):
+    async def upsert(self, collection_name, data):
+        self.insert(collection_name, data)
+
+
+@pytest.mark.asyncio
+async def test_async_upsert_spreads_over_pool():
+    clients = [FakeAsyncClient(fail_times=1), FakeAsyncClient()]
+    storage = AsyncMilvusStorage.__new__(AsyncMilvusStorage)
+    storage._clients = clients
+    storage._next_client = itertools.cycle(clients)
+
+    stats = await storage.upsert(
+        collection_name="test", data=rows(6), batch_rows=2, delay=0
+    )
+
+    assert stats["rows"] == 6
+    assert sorted(sum((client.batches for client in clients), [])) == [
+        [0, 1],
+        [2, 3],
+        [4, 5],
+    ]
+    assert all(client.batches for client in clients)
+
+
+def test_build_hybrid_search_query_params():
+    query = MilvusStorage.build_hybrid_search_query(
+        [0.0], "query", params=SearchParams(ef=8, dense_limit=20, sparse_limit=3)
+    )
+
+    assert query["dense"]["param"]["params"]["ef"] == 20
+    assert query["dense"]["limit"] == 20
+    assert query["sparse"]["limit"] == 3
+
+
+@pytest.mark.parametrize(
+    "field, value",
+    [
+        ("ef", 0),
+        ("ef", 10**6),
+        ("limit", -1),
+        ("dense_limit", 10**5),
+        ("rescore_factor", 100),
+    ],
+)
+def test_search_params_are_bounded(field, value):
+    with pytest.raises(pydantic.ValidationError):
+        SearchParams(**{field: value})
+
+
+def test_quantize_vector():
+    vector = [0.5, -1.25, 3.0e-3, 2.0, -0.0, 7.0, -7.0, 1.0, 0.1]
+
+    assert quantize_vector(vector, "float16").dtype == np.float16
+    bfloat16 = quantize_vector(vector, "bfloat16")
+    assert bfloat16.dtype == ml_dtypes.bfloat16
+    assert np.allclose(bfloat16.astype(np.float32), vector, rtol=1 / 128)
+    # One sign bit per dimension, padded to whole bytes.
+    assert quantize_vector(vector, "binary") == bytes([0b10110101, 0b10000000])
+    with pytest.raises(ValueError):
+        quantize_vector(vector, "int4")
+
+
+@pytest.mark.parametrize(
+    "precision, placeholder_type",
+    [
+        ("float32", PlaceholderType.FloatVector),
+        ("float16", PlaceholderType.Float16Vector),
+        ("bfloat16", PlaceholderType.BFloat16Vector),
+        ("binary", PlaceholderType.BinaryVector),
+    ],
+)
+def test_query_vectors_placeholder_type(precision, placeholder_type):
+    query = MilvusStorage.build_hybrid_search_query(
+        [0.5, -1.25, 0.1, 2.0, -0.3, 7.0, -7.0, 1.0], "anyio", precision=precision
+    )
+
+    # The placeholder the client builds for the search request, of the type of the vector field.
+    placeholders = PlaceholderGroup.FromString(
+        Prepare._prepare_placeholder_str(query["dense"]["data"])
+    ).placeholders
+    assert placeholders[0].type == placeholder_type
+
+
+def test_binary_schema_keeps_full_vectors():
+    schema = MilvusStorage._default_collection_schema(dimension=8, precision="binary")
+    fields = {field.name: field for field in schema.fields}
+
+    assert fields["vector"].dtype == DataType.BINARY_VECTOR
+    assert fields["full_vector"].dtype == DataType.FLOAT_VECTOR
+    assert quantize_rows([{"id": 1, "vector": [1.0] * 8}], "binary") == [
+        {"id": 1, "vector": b"\xff", "full_vector": [1.0] * 8}
+    ]
+
+
+class FakeSearchClient:
+    def search(self, collection_name, anns_field, data, search_params, limit, **kwargs):
+        if anns_field == "sparse":
+            return [[{"id": 3, "distance": 9.0, "entity": {"content": "c"}}]]
+        # Hamming ranks 1 first, the full-precision vectors rank 2 first.
+        return [
+            [
+                {
+                    "id": 1,
+                    "distance": 0,
+                    "entity": {"content": "a", "full_vector": [0.6, 0.8]},
+                },
+                {
+                    "id": 2,
+                    "distance": 1,
+                    "entity": {"content": "b", "full_vector": [1.0, 0.1]},
+                },
+            ][:limit]
+        ]
+
+
+def test_binary_hybrid_search_rescores_candidates():
+    query = MilvusStorage.build_hybrid_search_query(
+        [1.0, 0.0],
+        "query",
+        params=SearchParams(dense_limit=1, sparse_limit=1, rescore_factor=2),
+        precision="binary",
+    )
+    assert query["dense"]["limit"] == 2
+    assert query["dense"]["param"]["metric_type"] == "HAMMING"
+
+    storage = MilvusStorage.__new__(MilvusStorage)
+    storage.client = FakeSearchClient()
+    hits = storage.hybrid_search(collection_name="test", query=query, limit=2)
+
+    assert [hit["id"] for hit in hits] == [2, 3]
+    assert hits[0]["entity"] == {"content": "b"}
+
+
+def test_shortened_hybrid_search_rescores_from_side_store():
+    query = MilvusStorage.build_hybrid_search_query(
+        [1.0],
+        "query",
+        params=SearchParams(dense_limit=1, sparse_limit=1, rescore_factor=2),
+        rescore_embedding=[1.0, 0.0],
+    )
+    assert query["dense"]["limit"] == 2
+    assert query["dense"]["param"]["params"]["ef"] >= 2
+
+    store = VectorSideStore(":memory:")
+    store.put_many({1: [0.6, 0.8], 2: [1.0, 0.1]})
+    storage = MilvusStorage.__new__(MilvusStorage)
+    storage.client = FakeSearchClient()
+    hits = storage.hybrid_search(
+        collection_name="test", query=query, limit=2, vector_store=store
+    )
+
+    assert [hit["id"] for hit in hits] == [2, 3]
+    store.delete([2])
+    assert store.get_many([2, 1])[0] is None
+    assert len(store) == 1
+
+
+def test_ef_controller_follows_slo():
+    controller = EfController(
+        slo_ms=10, initial_ef=100, min_ef=50, max_ef=120, window=4
+    )
+    for _ in range(4):
+        controller.observe(0.02)
+    assert controller.ef == 75
+    for _ in range(8):
+        controller.observe(0.02)
+    assert controller.ef == 50
+
+    # Headroom raises ef again, up to its bound.
+    for _ in range(12):
+        controller.observe(0.001)
+    assert controller.ef == 98
+    for _ in range(8):
+        controller.observe(0.001)
+    assert controller.ef == 120
@@ -0,0 +1,152 @@
+import asyncio
+import json
+
+import numpy as np
+import pytest
+
+from core.storage.milvus import MilvusStorage
+from core.storage.bm25 import BM25Index
+from core.storage.numpy_store import NumpyStorage, Segment
+
+
+def rows(count: int, dimension: int = 8, start: int = 0):
+    vectors = np.random.default_rng(start).standard_normal((count, dimension))
+    return [
+        {
+            "id": start + index,
+            "vector": vector.tolist(),
+            "content": f"chunk {start + index}",
+        }
+        for index, vector in enumerate(vectors)
+    ]
+
+
+@pytest.mark.asyncio
+async def test_numpy_storage(tmp_path):
+    storage = NumpyStorage(tmp_path, max_segments=3)
+    await storage.create_collection(collection_name="test", dimension=8)
+    data = rows(100)
+    await storage.store(collection_name="test", data=data)
+    await storage.store(collection_name="test", data=rows(50, start=100))
+
+    hits = await storage.search(
+        collection_name="test", data=[data[5]["vector"], data[60]["vector"]], limit=3
+    )
+    assert [query_hits[0]["id"] for query_hits in hits] == [5, 60]
+    assert hits[0][0]["entity"] == {"id": 5, "content": "chunk 5"}
+    assert hits[0][0]["distance"] == pytest.approx(1.0)
+    assert hits[0][0]["distance"] >= hits[0][1]["distance"] >= hits[0][2]["distance"]
+
+    await storage.upsert(
+        collection_name="test", data=[{**data[5], "content": "replaced"}]
+    )
+    await storage.delete(collection_name="test", ids=[60])
+    hits = await storage.search(
+        collection_name="test", data=[data[5]["vector"], data[60]["vector"]], limit=3
+    )
+    assert hits[0][0]["entity"]["content"] == "replaced"
+    assert [hit["id"] for hit in hits[0]].count(5) == 1
+    assert 60 not in [hit["id"] for hit in hits[1]]
+
+    # A read-only process sees the writes, and keeps working after a compaction.
+    reader = NumpyStorage(tmp_path, read_only=True)
+    assert (await reader.get_collection_info(collection_name="test"))["rows"] == 149
+    await storage.store(collection_name="test", data=rows(10, start=150))
+    info = await reader.get_collection_info(collection_name="test")
+    assert info == {"dimension": 8, "segments": 1, "rows": 159}
+    with pytest.raises(PermissionError):
+        await reader.delete(collection_name="test", ids=[1])
+
+    assert [
+        hit["id"]
+        for hit in reader.full_text_search(collection_name="test", query="replaced")
+    ] == [5]
+    query = MilvusStorage.build_hybrid_search_query(data[7]["vector"], "replaced")
+    fused = await reader.hybrid_search(collection_name="test", query=query, limit=3)
+    # The best hit of each leg comes first.
+    assert {fused[0]["id"], fused[1]["id"]} == {5, 7}
+    assert len(fused) == 3
+
+
+@pytest.mark.asyncio
+async def test_numpy_storage_dedupes_ids_within_a_write(tmp_path):
+    storage = NumpyStorage(tmp_path)
+    await storage.create_collection(collection_name="test", dimension=8)
+    data = rows(3)
+    await storage.upsert(
+        collection_name="test",
+        data=[*data, {**data[1], "content": "first"}, {**data[1], "content": "last"}],
+    )
+
+    assert (await storage.get_collection_info(collection_name="test"))["rows"] == 3
+    hits = await storage.search(collection_name="test", data=[data[1]["vector"]])
+    assert [hit["id"] for hit in hits[0]].count(1) == 1
+    assert hits[0][0]["entity"]["content"] == "last"
+    assert [
+        hit["id"]
+        for hit in storage.full_text_search(collection_name="test", query="first")
+    ] == []
+
+
+@pytest.mark.asyncio
+async def test_numpy_storage_keeps_files_of_the_previous_manifest(tmp_path):
+    storage = NumpyStorage(tmp_path, max_segments=100)
+    await storage.create_collection(collection_name="test", dimension=8)
+    for start in range(0, 30, 10):
+        await storage.store(collection_name="test", data=rows(10, start=start))
+    directory = tmp_path / "test"
+
+    def manifest():
+        return json.loads((directory / "collection.json").read_text())
+
+    def opens(files):
+        segments = [Segment(directory, seq) for seq in files["segments"]]
+        bm25 = BM25Index.load(directory / "bm25", files["bm25"])
+        return sum(len(segment) for segment in segments), len(bm25)
+
+    # A reader that read the manifest just before a write, or a compaction, can still open its files.
+    for write in (
+        storage.delete(collection_name="test", ids=[3]),
+        storage.compact(collection_name="test"),
+        storage.store(collection_name="test", data=rows(5, start=30)),
+    ):
+        previous = manifest()
+        expected = opens(previous)
+        await write
+        assert opens(previous) == expected
+
+    # A compaction removes the segments retired by the previous one (0 to 2), and retires those it merges.
+    await storage.compact(collection_name="test")
+    assert sorted(path.name for path in directory.glob("*.ids.npy")) == [
+        "000004.ids.npy",
+        "000005.ids.npy",
+        "000006.ids.npy",
+    ]
+    assert len(list((directory / "bm25").glob("index.*.json"))) == 2
+
+
+@pytest.mark.asyncio
+async def test_numpy_storage_searches_during_writes(tmp_path):
+    storage = NumpyStorage(tmp_path)
+    await storage.create_collection(collection_name="test", dimension=8)
+    await storage.store(collection_name="test", data=rows(20))
+    query = MilvusStorage.build_hybrid_search_query(rows(1)[0]["vector"], "chunk")
+    writing = True
+
+    async def write():
+        nonlocal writing
+        for start in range(0, 300, 5):
+            await storage.upsert(collection_name="test", data=rows(10, start=start))
+        writing = False
+
+    async def search():
+        searches = 0
+        while writing or not searches:
+            assert storage.full_text_search(collection_name="test", query="chunk")
+            assert await storage.hybrid_search(collection_name="test", query=query)
+            await asyncio.sleep(0)
+            searches += 1
+
+    # Writes run in worker threads, searches on the loop read the collection without the lock.
+    await asyncio.gather(write(), search())
+    assert (await storage.get_collection_info(collection_name="test"))["rows"] == 305
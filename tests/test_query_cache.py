@@ -0,0 +1,63 @@
+import asyncio
+
+import pytest
+
+from service.milvus.cache import MemoryBackend, QueryCache, replay
+
+
+@pytest.mark.asyncio
+async def test_rewrite_cache_normalizes_queries():
+    cache = QueryCache(collection_name="test")
+    await cache.set_rewrite("How to  use anyio?", ["anyio usage"])
+
+    assert await cache.get_rewrite(" how to use AnyIO? ") == ["anyio usage"]
+    assert await cache.get_rewrite("how to install anyio?") is None
+    assert cache.stats()["rewrite"] == {"hits": 1, "misses": 1, "hit_rate": 0.5}
+    assert cache.stats()["answer"]["misses"] == 0
+
+
+@pytest.mark.asyncio
+async def test_semantic_cache_threshold_and_version():
+    cache = QueryCache(collection_name="test", threshold=0.9)
+    await cache.set_contexts([1.0, 0.0], ["context"])
+
+    assert await cache.get_contexts([0.99, 0.05]) == ["context"]
+    assert await cache.get_contexts([0.0, 1.0]) is None
+
+    # A re-ingest bumps the version, cached contexts are no longer served.
+    await cache.set_version(1)
+    assert await cache.get_contexts([1.0, 0.0]) is None
+    assert cache.stats()["index_entries"] == 0
+
+
+@pytest.mark.asyncio
+async def test_memory_backend_ttl_and_lru():
+    backend = MemoryBackend(max_entries=2, ttl=0.05)
+    await backend.set("version", 3, expire=False)
+    for key in ("a", "b", "c"):
+        await backend.set(key, [key])
+
+    assert await backend.get("a") is None
+    assert await backend.get("c") == ["c"]
+    await asyncio.sleep(0.1)
+    assert await backend.get("c") is None
+    assert await backend.get("version") == 3
+
+
+@pytest.mark.asyncio
+async def test_answer_cache_and_replay():
+    cache = QueryCache(collection_name="test", max_answer_bytes=16)
+    await cache.set_answer("What is anyio?", "template", ["Any", "IO"])
+    await cache.set_answer("too long", "template", ["x" * 17])
+
+    chunks = await cache.get_answer("what is  AnyIO?", "template")
+    assert chunks == ["Any", "IO"]
+    assert await cache.get_answer("too long", "template") is None
+    # A new prompt template or collection version misses.
+    assert await cache.get_answer("what is anyio?", "new template") is None
+    await cache.set_version(1)
+    assert await cache.get_answer("what is anyio?", "template") is None
+
+    start = asyncio.get_running_loop().time()
+    assert [chunk async for chunk in replay(chunks, interval=0.05)] == chunks
+    assert asyncio.get_running_loop().time() - start >= 0.05
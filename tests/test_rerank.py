@@ -0,0 +1,58 @@
+import pytest
+
+from service.milvus.rerank import DeterministicScorer, LexicalScorer, Reranker
+
+
+def chunks(*contents):
+    return [{"id": index, "content": content} for index, content in enumerate(contents)]
+
+
+@pytest.mark.asyncio
+async def test_lexical_scorer():
+    scores = await LexicalScorer().score(
+        "create_task_group 用法",
+        [
+            "use create_task_group to start tasks",
+            "unrelated text",
+            "create_task_group 的用法",
+        ],
+    )
+
+    # CJK text is matched character by character.
+    assert scores[2] > scores[0] > scores[1] == 0.0
+    assert all(score < 1.0 for score in scores)
+    # The score of a chunk doesn't depend on the other candidates.
+    alone = await LexicalScorer().score(
+        "create_task_group 用法", ["use create_task_group to start tasks"]
+    )
+    assert alone == scores[:1]
+
+
+@pytest.mark.asyncio
+async def test_reranker_batches_and_cuts_off():
+    scorer = DeterministicScorer()
+    candidates = chunks(*(f"chunk {i}" for i in range(5)))
+    reranker = Reranker(scorer, batch_size=2, top_n=3)
+
+    ranked = await reranker.rerank("query", candidates)
+
+    assert scorer.calls == [2, 2, 1]
+    assert len(ranked) == 3
+    scores = [item["rerank_score"] for item in ranked]
+    assert scores == sorted(scores, reverse=True)
+    # Deterministic, and the threshold drops weaker candidates.
+    assert await reranker.rerank("query", candidates) == ranked
+    kept = await Reranker(scorer, threshold=scores[1]).rerank("query", candidates)
+    assert kept == ranked[:2]
+
+
+@pytest.mark.asyncio
+async def test_reranker_keeps_order_when_scorer_fails():
+    class FailingScorer(DeterministicScorer):
+        async def score(self, query, documents):
+            raise TimeoutError("rerank endpoint timed out")
+
+    candidates = chunks("a", "b", "c")
+    assert await Reranker(FailingScorer(), top_n=2).rerank("query", candidates) == (
+        candidates
+    )
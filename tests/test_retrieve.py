@@ -0,0 +1,285 @@
+import asyncio
+
+import numpy as np
+import pytest
+
+from service.milvus import chat
+from core.storage.milvus import SearchParams
+from core.storage.numpy_store import NumpyStorage
+from core.storage.side_store import VectorSideStore
+from service.milvus.cache import QueryCache
+from utils.llm import truncate_embedding
+
+
+def hit(content: str, distance: float = 0.01):
+    return {"id": content, "distance": distance, "entity": {"content": content}}
+
+
+@pytest.fixture
+def fake_search(monkeypatch):
+    calls = []
+
+    async def rewrite(query, cache=None):
+        await asyncio.sleep(0.05)
+        calls.append("rewrite")
+        return ["variant"]
+
+    async def search_queries(milvus, queries, params=None):
+        calls.append(queries)
+        return [[hit(query)] for query in queries], 0
+
+    async def dense_confidence(milvus, query, params=None):
+        return 0.8
+
+    monkeypatch.setattr(chat, "rewrite", rewrite)
+    monkeypatch.setattr(chat, "_search_queries", search_queries)
+    monkeypatch.setattr(chat, "dense_confidence", dense_confidence)
+    return calls
+
+
+def contents(relevant_contents):
+    return [item["content"] for item in relevant_contents]
+
+
+@pytest.mark.asyncio
+async def test_retrieve_searches_original_before_rewrite(fake_search):
+    relevant_contents, degraded = await chat.retrieve(milvus=None, query="original")
+
+    # The original query is searched without waiting for the rewrite.
+    assert fake_search == [["original"], "rewrite", ["variant"]]
+    assert sorted(contents(relevant_contents)) == ["original", "variant"]
+    assert not degraded
+
+
+@pytest.mark.asyncio
+async def test_retrieve_reports_failed_searches(fake_search, monkeypatch):
+    async def search_queries(milvus, queries, params=None):
+        # Only the variant can be searched.
+        return [[hit(query)] for query in queries if query != "original"], 1
+
+    monkeypatch.setattr(chat, "_search_queries", search_queries)
+    relevant_contents, degraded = await chat.retrieve(milvus=None, query="original")
+
+    assert contents(relevant_contents) == ["variant"]
+    assert degraded
+
+
+@pytest.mark.asyncio
+async def test_retrieve_skips_variants_when_confident(fake_search):
+    relevant_contents, _ = await chat.retrieve(
+        milvus=None, query="original", confidence_score=0.75
+    )
+
+    assert contents(relevant_contents) == ["original"]
+    await asyncio.sleep(0.1)
+    assert "rewrite" not in fake_search
+
+    relevant_contents, _ = await chat.retrieve(
+        milvus=None, query="original", confidence_score=0.85
+    )
+    assert sorted(contents(relevant_contents)) == ["original", "variant"]
+
+
+@pytest.mark.asyncio
+async def test_dense_confidence_is_the_top_cosine(monkeypatch):
+    class FakeMilvus:
+        async def search(self, collection_name, anns_field, data, **kwargs):
+            assert kwargs["search_params"]["metric_type"] == "COSINE"
+            assert kwargs["limit"] == 1
+            return [[{"id": 1, "distance": 0.87, "entity": {"id": 1}}]]
+
+    monkeypatch.setattr(chat, "get_embedding_batcher", lambda **kwargs: FakeBatcher())
+    monkeypatch.setattr(chat, "search_params", lambda name: SearchParams())
+    assert await chat.dense_confidence(FakeMilvus(), "anyio") == 0.87
+
+    monkeypatch.setattr(
+        chat, "get_embedding_batcher", lambda **kwargs: FakeBatcher(ValueError())
+    )
+    assert await chat.dense_confidence(FakeMilvus(), "anyio") == 0.0
+
+
+@pytest.mark.asyncio
+async def test_retrieve_drops_late_variants(fake_search):
+    relevant_contents, _ = await chat.retrieve(
+        milvus=None, query="original", max_wait=0.01
+    )
+
+    assert contents(relevant_contents) == ["original"]
+
+
+def test_fuse_results_by_id():
+    # Distances of separate searches are ignored, a chunk found by every variant wins.
+    result_lists = [
+        [hit("a", 0.9), hit("b", 0.8)],
+        [hit("c", 0.03), hit("b", 0.02)],
+        [hit("b", 0.03), hit("c", 0.02)],
+    ]
+
+    fused = chat.fuse_results(result_lists, top_k=2)
+
+    assert contents(fused) == ["b", "c"]
+    assert fused[0]["score"] == pytest.approx(1 / 62 + 1 / 62 + 1 / 61)
+
+
+def test_build_context_respects_budget():
+    relevant_contents = [
+        {"content": "a" * 40},
+        {"content": "b" * 400},
+        {"content": "c" * 40},
+    ]
+
+    context = chat.build_context(relevant_contents, max_tokens=30)
+
+    assert context == f"[1] {'a' * 40}\n\n[2] {'c' * 40}"
+
+
+class FakeBatcher:
+    def __init__(self, error: Exception = None):
+        self.error = error
+
+    async def embed(self, text):
+        if self.error:
+            raise self.error
+        return [1.0, 0.0]
+
+    async def embed_many(self, texts):
+        return [await self.embed(text) for text in texts]
+
+
+class FakeLLM:
+    async def stream_text(self, prompt, model):
+        for chunk in ("Any", "IO"):
+            yield chunk
+
+
+@pytest.fixture
+def fake_chat(monkeypatch):
+    calls = []
+
+    async def retrieve(milvus, query, **kwargs):
+        calls.append(query)
+        if "degraded" in query:
+            return [], True
+        return [{"id": 1, "content": "context", "score": 0.03}], False
+
+    monkeypatch.setattr(chat, "retrieve", retrieve)
+    monkeypatch.setattr(chat, "get_llm", FakeLLM)
+    monkeypatch.setattr(chat, "get_reranker", lambda: None)
+    monkeypatch.setattr(chat, "get_context_compressor", lambda: None)
+    monkeypatch.setattr(chat, "get_embedding_batcher", lambda **kwargs: FakeBatcher())
+    return calls
+
+
+async def answer(**kwargs) -> str:
+    return "".join([chunk async for chunk in chat.chat(milvus=None, **kwargs)])
+
+
+@pytest.mark.asyncio
+async def test_chat_survives_query_embedding_failure(fake_chat, monkeypatch):
+    monkeypatch.setattr(
+        chat,
+        "get_embedding_batcher",
+        lambda **kwargs: FakeBatcher(ValueError("outage")),
+    )
+    cache = QueryCache(collection_name="test")
+
+    assert await answer(query="what is anyio?", cache=cache) == "AnyIO"
+    assert fake_chat == ["what is anyio?"]
+    assert cache.stats()["contexts"]["misses"] == 0
+
+
+@pytest.mark.asyncio
+async def test_chat_does_not_cache_degraded_retrieval(fake_chat):
+    cache = QueryCache(collection_name="test")
+
+    assert await answer(query="degraded query", cache=cache) == "AnyIO"
+    assert await cache.get_answer("degraded query", chat.query_prompt) is None
+    assert cache.stats()["index_entries"] == 0
+
+    assert await answer(query="what is anyio?", cache=cache) == "AnyIO"
+    assert await cache.get_answer("what is anyio?", chat.query_prompt) == ["Any", "IO"]
+    assert cache.stats()["index_entries"] == 1
+
+
+@pytest.mark.asyncio
+async def test_chat_with_search_params_bypasses_caches(fake_chat):
+    cache = QueryCache(collection_name="test")
+    await cache.set_answer("what is anyio?", chat.query_prompt, ["cached"])
+    await cache.set_contexts([1.0, 0.0], [{"id": 2, "content": "cached"}])
+
+    params = SearchParams(ef=64)
+    assert await answer(query="what is anyio?", cache=cache, params=params) == "AnyIO"
+    assert fake_chat == ["what is anyio?"]
+    assert cache.stats()["answer"]["hits"] == cache.stats()["contexts"]["hits"] == 0
+    assert cache.stats()["index_entries"] == 1
+
+
+@pytest.mark.asyncio
+async def test_search_queries_against_numpy_storage(tmp_path, monkeypatch):
+    vectors = np.random.default_rng(0).standard_normal((20, 8))
+
+    class Batcher:
+        async def embed_many(self, texts):
+            return [vectors[int(text.split()[-1])].tolist() for text in texts]
+
+    storage = NumpyStorage(tmp_path)
+    # Without full-text search, the hits keep their cosine similarity as distance.
+    await storage.create_collection(
+        collection_name="anyio", dimension=4, enable_fts=False
+    )
+    await storage.store(
+        collection_name="anyio",
+        data=[
+            {
+                "id": index,
+                "vector": truncate_embedding(vector.tolist(), 4),
+                "content": f"chunk {index}",
+            }
+            for index, vector in enumerate(vectors)
+        ],
+    )
+    metadata = {"model": "test", "dimensions": 4, "precision": "float32"}
+    monkeypatch.setattr(chat, "get_embedding_batcher", lambda **kwargs: Batcher())
+    monkeypatch.setattr(chat, "search_params", lambda name: SearchParams())
+    monkeypatch.setitem(
+        chat._collection_metadata, "anyio", {**metadata, "rescore": False}
+    )
+
+    result_lists, failed = await chat._search_queries(storage, ["chunk 3", "chunk 7"])
+    assert failed == 0
+    assert [hits[0]["id"] for hits in result_lists] == [3, 7]
+
+    # Shortened vectors are rescored with the full-size ones of the side store.
+    store = VectorSideStore(":memory:")
+    store.put_many({index: vector for index, vector in enumerate(vectors)})
+    monkeypatch.setattr(chat, "side_store", lambda name: store)
+    monkeypatch.setitem(
+        chat._collection_metadata, "anyio", {**metadata, "rescore": True}
+    )
+
+    (hits,), failed = await chat._search_queries(storage, ["chunk 3"])
+    assert failed == 0
+    unit = vectors / np.linalg.norm(vectors, axis=1, keepdims=True)
+    assert [hit["distance"] for hit in hits] == pytest.approx(
+        [float(unit[hit["id"]] @ unit[3]) for hit in hits], abs=1e-5
+    )
+
+
+@pytest.mark.asyncio
+async def test_chat_embeds_the_query_as_the_search_does(fake_chat, monkeypatch):
+    requested = []
+
+    def get_embedding_batcher(**kwargs):
+        requested.append(kwargs)
+        return FakeBatcher()
+
+    monkeypatch.setattr(chat, "get_embedding_batcher", get_embedding_batcher)
+    monkeypatch.setitem(
+        chat._collection_metadata,
+        "anyio",
+        {"model": "test", "dimensions": 256, "precision": "float32", "rescore": False},
+    )
+
+    assert await answer(query="what is anyio?", cache=QueryCache("test")) == "AnyIO"
+    # The shortened embedding the search requests, served by the same batcher.
+    assert requested == [{"model": "test", "dimensions": 256}]
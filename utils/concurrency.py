@@ -1,5 +1,5 @@
 import asyncio
-from typing import TypeVar, Iterable, Iterator, AsyncIterator
+from typing import TypeVar, Iterable, Iterator, AsyncIterable, AsyncIterator, List
 
 T = TypeVar("T")
 
@@ -26,3 +26,60 @@ async def iterate_in_threadpool(iterator: Iterable[T]) -> AsyncIterator[T]:
             yield await asyncio.to_thread(_next, as_iterator)
         except _StopIteration:
             break
+
+
+class _Failure:
+    def __init__(self, error: Exception):
+        self.error = error
+
+
+_DONE = object()
+
+
+async def buffered(source: AsyncIterable[T], maxsize: int) -> AsyncIterator[T]:
+    """
+    Consume `source` in a background task, holding at most `maxsize` items ahead of the consumer.
+
+    Chaining buffered stages makes them run concurrently, while a slow consumer applies backpressure upstream.
+    Errors raised by the source are re-raised to the consumer.
+    """
+    queue: asyncio.Queue = asyncio.Queue(maxsize=maxsize)
+
+    async def produce():
+        try:
+            async for item in source:
+                await queue.put(item)
+        except Exception as e:
+            await queue.put(_Failure(e))
+        else:
+            await queue.put(_DONE)
+
+    task = asyncio.create_task(produce())
+    try:
+        while True:
+            item = await queue.get()
+            if item is _DONE:
+                break
+            if isinstance(item, _Failure):
+                raise item.error
+            yield item
+    finally:
+        task.cancel()
+        try:
+            await task
+        except asyncio.CancelledError:
+            pass
+
+
+async def batched(source: AsyncIterable[T], size: int) -> AsyncIterator[List[T]]:
+    """
+    Group items of `source` into lists of at most `size` items.
+    """
+    batch = []
+    async for item in source:
+        batch.append(item)
+        if len(batch) >= size:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
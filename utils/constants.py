@@ -5,3 +5,7 @@ from conf import settings
 BASE_REDIS_URI = f"redis://{settings.redis.username}:{quote_plus(settings.redis.password)}@{settings.redis.host}:{settings.redis.port}"
 
 SEMAPHORE = 10
+
+# Rows buffered between ingestion stages, and rows embedded and written per batch.
+INGEST_QUEUE_SIZE = 1024
+INGEST_BATCH_SIZE = 512
@@ -0,0 +1,218 @@
+import asyncio
+import hashlib
+import logging
+import os
+import re
+import sqlite3
+import threading
+import typing as t
+import unicodedata
+from array import array
+from collections import OrderedDict
+from pathlib import Path
+
+from conf import settings
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_EMBEDDING_CACHE_PATH = "data/.cache/embeddings.sqlite3"
+DEFAULT_EMBEDDING_CACHE_MEMORY = 64 * 1024 * 1024
+
+_WHITESPACE = re.compile(r"\s+")
+
+
+def normalize_text(text: str) -> str:
+    """
+    Normalize text before hashing, so trivially different copies share one embedding.
+    """
+    return _WHITESPACE.sub(" ", unicodedata.normalize("NFC", text)).strip()
+
+
+class EmbeddingCache:
+    """
+    Content-addressed embedding cache.
+
+    Embeddings are stored as float32 blobs in sqlite and fronted by an in-process LRU bounded by bytes.
+    Keys are derived from the model name, the requested dimensions and a hash of the normalized text.
+
+    The async methods serve the LRU inline, and only go to sqlite in a worker thread, so lookups and writes
+    never block the event loop.
+    """
+
+    def __init__(
+        self,
+        path: t.Union[str, os.PathLike] = DEFAULT_EMBEDDING_CACHE_PATH,
+        max_memory_bytes: int = DEFAULT_EMBEDDING_CACHE_MEMORY,
+    ):
+        """
+        :param path: the sqlite database file, use ":memory:" for a non-persistent cache.
+        :param max_memory_bytes: the size bound of the in-process LRU.
+        """
+        if str(path) != ":memory:":
+            Path(path).parent.mkdir(parents=True, exist_ok=True)
+        self._db = sqlite3.connect(str(path), check_same_thread=False)
+        self._db.execute("PRAGMA journal_mode=WAL")
+        self._db.execute(
+            "CREATE TABLE IF NOT EXISTS embeddings (key TEXT PRIMARY KEY, vector BLOB NOT NULL)"
+        )
+        self._lock = threading.Lock()
+        self._lru: OrderedDict[str, bytes] = OrderedDict()
+        self._lru_bytes = 0
+        self.max_memory_bytes = max_memory_bytes
+        self.hits = 0
+        self.misses = 0
+        logger.debug(f"Embedding cache opened at {path}")
+
+    @staticmethod
+    def make_key(model: str, text: str, dimensions: t.Optional[int] = None) -> str:
+        digest = hashlib.sha256(normalize_text(text).encode("utf-8")).hexdigest()
+        return f"{model}:{dimensions or 'full'}:{digest}"
+
+    def _remember(self, key: str, blob: bytes):
+        if key in self._lru:
+            self._lru_bytes -= len(self._lru.pop(key))
+        self._lru[key] = blob
+        self._lru_bytes += len(blob)
+        while self._lru_bytes > self.max_memory_bytes and self._lru:
+            _, evicted = self._lru.popitem(last=False)
+            self._lru_bytes -= len(evicted)
+
+    def _get_memory(self, keys: t.Sequence[str]) -> t.Dict[str, bytes]:
+        blobs: t.Dict[str, bytes] = {}
+        with self._lock:
+            for key in keys:
+                if key in self._lru:
+                    self._lru.move_to_end(key)
+                    blobs[key] = self._lru[key]
+        return blobs
+
+    def _get_disk(self, keys: t.Sequence[str]) -> t.Dict[str, bytes]:
+        blobs: t.Dict[str, bytes] = {}
+        missing = list(set(keys))
+        with self._lock:
+            # Stay below the default sqlite limit of host parameters.
+            for start in range(0, len(missing), 500):
+                part = missing[start : start + 500]
+                rows = self._db.execute(
+                    "SELECT key, vector FROM embeddings WHERE key IN (%s)"
+                    % ",".join("?" * len(part)),
+                    part,
+                ).fetchall()
+                for key, blob in rows:
+                    blobs[key] = blob
+                    self._remember(key, blob)
+        return blobs
+
+    def _results(
+        self, keys: t.Sequence[str], blobs: t.Mapping[str, bytes]
+    ) -> t.List[t.Optional[t.List[float]]]:
+        results = []
+        with self._lock:
+            for key in keys:
+                blob = blobs.get(key)
+                if blob is None:
+                    self.misses += 1
+                    results.append(None)
+                else:
+                    self.hits += 1
+                    results.append(array("f", blob).tolist())
+        return results
+
+    def get_many(self, keys: t.Sequence[str]) -> t.List[t.Optional[t.List[float]]]:
+        """
+        Look up embeddings, memory first and sqlite second.
+
+        :param keys: keys built by `make_key`.
+        :return: embeddings in key order, None for misses.
+        """
+        blobs = self._get_memory(keys)
+        blobs.update(self._get_disk([key for key in keys if key not in blobs]))
+        return self._results(keys, blobs)
+
+    async def aget_many(
+        self, keys: t.Sequence[str]
+    ) -> t.List[t.Optional[t.List[float]]]:
+        """
+        `get_many` without blocking the event loop, sqlite is only queried for the keys missing from memory.
+        """
+        blobs = self._get_memory(keys)
+        if missing := [key for key in keys if key not in blobs]:
+            blobs.update(await asyncio.to_thread(self._get_disk, missing))
+        return self._results(keys, blobs)
+
+    def get(self, key: str) -> t.Optional[t.List[float]]:
+        return self.get_many([key])[0]
+
+    @staticmethod
+    def _encode(
+        items: t.Mapping[str, t.Sequence[float]],
+    ) -> t.List[t.Tuple[str, bytes]]:
+        return [(key, array("f", vector).tobytes()) for key, vector in items.items()]
+
+    def _put_disk(self, rows: t.List[t.Tuple[str, bytes]]):
+        with self._lock, self._db:
+            self._db.executemany(
+                "INSERT OR REPLACE INTO embeddings (key, vector) VALUES (?, ?)",
+                rows,
+            )
+
+    def put_many(self, items: t.Mapping[str, t.Sequence[float]]):
+        """
+        Store embeddings.
+
+        :param items: mapping from keys built by `make_key` to embeddings.
+        """
+        rows = self._encode(items)
+        self._put_disk(rows)
+        with self._lock:
+            for key, blob in rows:
+                self._remember(key, blob)
+
+    async def aput_many(self, items: t.Mapping[str, t.Sequence[float]]):
+        """
+        `put_many` without blocking the event loop, the entries are served from memory right away.
+        """
+        rows = self._encode(items)
+        with self._lock:
+            for key, blob in rows:
+                self._remember(key, blob)
+        await asyncio.to_thread(self._put_disk, rows)
+
+    def put(self, key: str, vector: t.Sequence[float]):
+        self.put_many({key: vector})
+
+    def stats(self) -> t.Dict[str, t.Any]:
+        total = self.hits + self.misses
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": self.hits / total if total else 0.0,
+            "memory_entries": len(self._lru),
+            "memory_bytes": self._lru_bytes,
+        }
+
+    def close(self):
+        with self._lock:
+            self._db.close()
+
+
+_default_cache: t.Optional[EmbeddingCache] = None
+
+
+def get_embedding_cache() -> t.Optional[EmbeddingCache]:
+    """
+    The process-wide embedding cache shared by the ingestion and the query paths.
+
+    Returns None when the cache is disabled in settings.
+    """
+    global _default_cache
+    if not settings.get("embedding.CACHE_ENABLED", True):
+        return None
+    if _default_cache is None:
+        _default_cache = EmbeddingCache(
+            path=settings.get("embedding.CACHE_PATH", DEFAULT_EMBEDDING_CACHE_PATH),
+            max_memory_bytes=settings.get(
+                "embedding.CACHE_MEMORY_BYTES", DEFAULT_EMBEDDING_CACHE_MEMORY
+            ),
+        )
+    return _default_cache
@@ -1,21 +1,98 @@
+import asyncio
 import json
 import re
 import logging
+import unicodedata
 from functools import cached_property
 import typing as t
 
+import openai
 from openai import AsyncOpenAI
 from json_repair import repair_json
 
 from conf import settings
+from utils.embedding_cache import EmbeddingCache, get_embedding_cache
 
 logger = logging.getLogger(__name__)
 
+# OpenAI accepts up to 2048 inputs and 300k tokens per embeddings request, we stay well below both.
+DEFAULT_EMBEDDING_BATCH_SIZE = 256
+DEFAULT_EMBEDDING_BATCH_TOKENS = 100_000
+DEFAULT_EMBEDDING_CONCURRENCY = 4
+DEFAULT_EMBEDDING_RETRIES = 3
+# Query-path micro-batching: how long the first input waits for company, and how many inputs flush at once.
+DEFAULT_EMBEDDING_BATCH_WINDOW = 0.005
+DEFAULT_EMBEDDING_BATCH_INPUTS = 64
+# A query waits on its embedding: one quick retry, rather than the seconds of backoff of ingestion.
+DEFAULT_QUERY_EMBEDDING_RETRIES = 2
+DEFAULT_QUERY_EMBEDDING_DELAY = 0.05
+# Errors of requests rejected for their inputs: retrying can't help, bisecting isolates the bad inputs.
+_REJECTED_INPUT_ERRORS = (openai.BadRequestError, openai.UnprocessableEntityError)
+
+
+def truncate_embedding(
+    embedding: t.Sequence[float], dimensions: t.Optional[int] = None
+) -> t.List[float]:
+    """
+    Shorten a Matryoshka embedding (e.g. text-embedding-3) to its first `dimensions`, L2-normalized again.
+
+    This matches requesting the embedding with `dimensions`, so one full-size request serves both sizes.
+    """
+    if not dimensions or dimensions >= len(embedding):
+        return list(embedding)
+    head = embedding[:dimensions]
+    norm = sum(value * value for value in head) ** 0.5 or 1.0
+    return [value / norm for value in head]
+
+
+def estimate_tokens(text: str) -> int:
+    """
+    Cheap token estimation without a tokenizer.
+
+    CJK characters are roughly one token each, other text is roughly four characters per token.
+
+    :param text: the text to estimate.
+    :return: the estimated number of tokens, at least 1.
+    """
+    cjk = sum(1 for char in text if unicodedata.east_asian_width(char) in ("W", "F"))
+    return max(1, cjk + (len(text) - cjk + 3) // 4)
+
+
+def pack_batches(
+    inputs: t.Sequence[str],
+    batch_size: int = DEFAULT_EMBEDDING_BATCH_SIZE,
+    max_batch_tokens: int = DEFAULT_EMBEDDING_BATCH_TOKENS,
+) -> t.List[t.List[int]]:
+    """
+    Greedily pack inputs into batches bounded by input count and estimated tokens.
+
+    :param inputs: the texts to pack.
+    :param batch_size: the maximum number of inputs per batch.
+    :param max_batch_tokens: the maximum number of estimated tokens per batch.
+    :return: batches of indices into inputs, in input order.
+    """
+    batches, current, current_tokens = [], [], 0
+    for index, text in enumerate(inputs):
+        tokens = estimate_tokens(text)
+        if current and (
+            len(current) >= batch_size or current_tokens + tokens > max_batch_tokens
+        ):
+            batches.append(current)
+            current, current_tokens = [], 0
+        current.append(index)
+        current_tokens += tokens
+    if current:
+        batches.append(current)
+    return batches
+
 
 class SimpleLLM:
     # TODO: Refactor this class to support multiple LLM providers.
-    def __int__(self):
-        pass
+    def __init__(self, embedding_cache: t.Optional[EmbeddingCache] = None):
+        """
+        :param embedding_cache: the cache consulted before requesting embeddings, defaults to the shared one.
+        """
+        self.embedding_cache = embedding_cache or get_embedding_cache()
 
     @cached_property
     def openai_client(self):
@@ -31,15 +108,334 @@ class SimpleLLM:
             base_url=settings.llm.voc.BASE_URL,
         )
 
-    async def embedding(self, model: str, inputs: str) -> t.List[float]:
+    async def generate_text(
+        self, prompt: str, model: str = "gpt-4o-mini", **kwargs
+    ) -> str:
+        """
+        Complete a prompt without blocking the event loop.
+
+        :param prompt: the user prompt.
+        :param model: the chat model.
+        :return: the completion text.
+        """
+        resp = await self.openai_client.chat.completions.create(
+            model=model, messages=[{"role": "user", "content": prompt}], **kwargs
+        )
+        return resp.choices[0].message.content
+
+    async def stream_text(
+        self, prompt: str, model: str = "gpt-4o-mini", **kwargs
+    ) -> t.AsyncIterator[str]:
+        """
+        Stream the completion of a prompt, each text delta is yielded as soon as it arrives.
+
+        :param prompt: the user prompt.
+        :param model: the chat model.
+        :return: async iterator of text deltas.
+        """
+        stream = await self.openai_client.chat.completions.create(
+            model=model,
+            messages=[{"role": "user", "content": prompt}],
+            stream=True,
+            **kwargs,
+        )
+        async for chunk in stream:
+            if chunk.choices and chunk.choices[0].delta.content:
+                yield chunk.choices[0].delta.content
+
+    def _embedding_client(self, model: str) -> t.Tuple[AsyncOpenAI, str]:
         client, model = (
             (self.voc_client, dict(settings.llm.voc)[model])
             if hasattr(settings.llm.voc, model)
             else (self.openai_client, model)
         )
         logger.debug(f"Client for {model}")
-        resp = await client.embeddings.create(input=[inputs], model=model)
-        return resp.data[0].embedding
+        return client, model
+
+    @staticmethod
+    def _dimensions_kwargs(dimensions: t.Optional[int]) -> t.Dict[str, int]:
+        # Only models supporting shortened embeddings accept `dimensions`, the others get the request unchanged.
+        return {"dimensions": dimensions} if dimensions else {}
+
+    async def embedding(
+        self, model: str, inputs: str, dimensions: t.Optional[int] = None
+    ) -> t.List[float]:
+        client, model = self._embedding_client(model)
+        key = EmbeddingCache.make_key(model=model, text=inputs, dimensions=dimensions)
+        if self.embedding_cache and (
+            cached := (await self.embedding_cache.aget_many([key]))[0]
+        ):
+            return cached
+
+        resp = await client.embeddings.create(
+            input=[inputs], model=model, **self._dimensions_kwargs(dimensions)
+        )
+        embedding = resp.data[0].embedding
+        if self.embedding_cache:
+            await self.embedding_cache.aput_many({key: embedding})
+        return embedding
+
+    async def embed_many(
+        self,
+        model: str,
+        inputs: t.Sequence[str],
+        batch_size: int = DEFAULT_EMBEDDING_BATCH_SIZE,
+        max_batch_tokens: int = DEFAULT_EMBEDDING_BATCH_TOKENS,
+        concurrency: int = DEFAULT_EMBEDDING_CONCURRENCY,
+        max_retries: int = DEFAULT_EMBEDDING_RETRIES,
+        delay: float = 1.0,
+        dimensions: t.Optional[int] = None,
+    ) -> t.List[t.Optional[t.List[float]]]:
+        """
+        Embed many texts with as few requests as possible.
+
+        Inputs found in the embedding cache, or repeated within the call, are not requested again. The remaining
+        inputs are packed into batches bounded by count and estimated tokens, and batches are sent concurrently.
+        A batch rejected for its inputs (400/422) is bisected right away, so a single bad input only loses its own
+        embedding. Other failures (rate limits, timeouts, outages) are retried with backoff, then the batch is
+        given up as a whole: bisecting would only multiply the requests.
+
+        :param model: the embedding model.
+        :param inputs: the texts to embed.
+        :param batch_size: the maximum number of inputs per request.
+        :param max_batch_tokens: the maximum number of estimated tokens per request.
+        :param concurrency: the maximum number of requests in flight.
+        :param max_retries: the number of attempts per batch before giving it up.
+        :param delay: the base delay (in seconds) of the exponential backoff between attempts.
+        :param dimensions: the size of shortened embeddings, the full size of the model by default.
+        :return: embeddings in input order, None for inputs that could not be embedded.
+        """
+        client, model = self._embedding_client(model)
+        keys = [
+            EmbeddingCache.make_key(model=model, text=text, dimensions=dimensions)
+            for text in inputs
+        ]
+        results: t.List[t.Optional[t.List[float]]] = (
+            await self.embedding_cache.aget_many(keys)
+            if self.embedding_cache
+            else [None] * len(inputs)
+        )
+
+        # Request every missing key once, using its first occurrence as the representative input.
+        pending: t.Dict[str, t.List[int]] = {}
+        for index, (key, result) in enumerate(zip(keys, results)):
+            if result is None:
+                pending.setdefault(key, []).append(index)
+        representatives = [indices[0] for indices in pending.values()]
+        semaphore = asyncio.Semaphore(concurrency)
+
+        async def request(indices: t.List[int]):
+            async with semaphore:
+                resp = await client.embeddings.create(
+                    input=[inputs[index] for index in indices],
+                    model=model,
+                    **self._dimensions_kwargs(dimensions),
+                )
+            fetched = {}
+            for item in resp.data:
+                key = keys[indices[item.index]]
+                fetched[key] = item.embedding
+                for index in pending[key]:
+                    results[index] = item.embedding
+            if self.embedding_cache:
+                await self.embedding_cache.aput_many(fetched)
+
+        async def embed_batch(indices: t.List[int]):
+            for attempt in range(max_retries):
+                try:
+                    return await request(indices)
+                except _REJECTED_INPUT_ERRORS as e:
+                    logger.warning(f"Embedding batch of {len(indices)} rejected: {e}")
+                    break
+                except Exception as e:
+                    logger.warning(
+                        f"Embedding batch of {len(indices)} failed "
+                        f"(attempt {attempt + 1}/{max_retries}): {e}"
+                    )
+                    if attempt < max_retries - 1:
+                        await asyncio.sleep(delay * 2**attempt)
+            else:
+                logger.error(f"Giving up embedding a batch of {len(indices)} inputs.")
+                return
+
+            if len(indices) == 1:
+                logger.error(f"Giving up embedding input {indices[0]}.")
+                return
+            middle = len(indices) // 2
+            await asyncio.gather(
+                embed_batch(indices[:middle]), embed_batch(indices[middle:])
+            )
+
+        batches = pack_batches(
+            [inputs[index] for index in representatives], batch_size, max_batch_tokens
+        )
+        await asyncio.gather(
+            *(
+                embed_batch([representatives[position] for position in batch])
+                for batch in batches
+            )
+        )
+        return results
+
+
+_default_llm: t.Optional[SimpleLLM] = None
+
+
+def get_llm() -> SimpleLLM:
+    """
+    The process-wide LLM client. Requests share its HTTP connection pools, so completions and streams reuse
+    kept-alive connections instead of opening new ones.
+    """
+    global _default_llm
+    if _default_llm is None:
+        _default_llm = SimpleLLM()
+    return _default_llm
+
+
+class EmbeddingBatcher:
+    """
+    Coalesce the embedding requests of concurrent callers into batched API calls.
+
+    Inputs are queued and flushed together once `max_batch_inputs` are waiting or `window` seconds after the first
+    one arrived, whichever comes first; each caller awaits its own future. Flushed batches go through
+    `SimpleLLM.embed_many`, so cached and repeated inputs are not requested and a bad input only fails its caller.
+
+    Share one batcher per process (see `get_embedding_batcher`), and so one HTTP client for the query path.
+    """
+
+    def __init__(
+        self,
+        model: str = "text-embedding-3-small",
+        llm: t.Optional[SimpleLLM] = None,
+        window: float = DEFAULT_EMBEDDING_BATCH_WINDOW,
+        max_batch_inputs: int = DEFAULT_EMBEDDING_BATCH_INPUTS,
+        max_retries: int = DEFAULT_QUERY_EMBEDDING_RETRIES,
+        delay: float = DEFAULT_QUERY_EMBEDDING_DELAY,
+        dimensions: t.Optional[int] = None,
+    ):
+        """
+        :param model: the embedding model.
+        :param llm: the client used to embed, defaults to the shared one, see `get_llm`.
+        :param window: the maximum time (in seconds) an input waits before being flushed.
+        :param max_batch_inputs: the number of queued inputs that triggers a flush right away.
+        :param max_retries: the number of attempts per batch, see `SimpleLLM.embed_many`.
+        :param delay: the base delay (in seconds) of the backoff between attempts.
+        :param dimensions: the size of shortened embeddings, the full size of the model by default.
+        """
+        self.model = model
+        self.dimensions = dimensions
+        self.llm = llm or get_llm()
+        self.window = window
+        self.max_batch_inputs = max_batch_inputs
+        self.max_retries = max_retries
+        self.delay = delay
+        self._pending: t.List[t.Tuple[str, asyncio.Future]] = []
+        self._timer: t.Optional[asyncio.TimerHandle] = None
+        # Flushed batches still in flight, referenced so they aren't garbage collected.
+        self._dispatching: t.Set[asyncio.Task] = set()
+        self.flushes = 0
+        self.inputs = 0
+
+    async def embed(self, text: str) -> t.List[float]:
+        """
+        Embed one text, batched with the texts of the other callers.
+
+        :raise ValueError: if the text could not be embedded.
+        """
+        loop = asyncio.get_running_loop()
+        future = loop.create_future()
+        self._pending.append((text, future))
+        if len(self._pending) >= self.max_batch_inputs:
+            self._flush()
+        elif self._timer is None:
+            self._timer = loop.call_later(self.window, self._flush)
+        return await future
+
+    async def embed_many(
+        self, inputs: t.Sequence[str]
+    ) -> t.List[t.Optional[t.List[float]]]:
+        """
+        Embed several texts, with the same contract as `SimpleLLM.embed_many`.
+        """
+        results = await asyncio.gather(
+            *(self.embed(text) for text in inputs), return_exceptions=True
+        )
+        return [None if isinstance(result, Exception) else result for result in results]
+
+    def _flush(self):
+        if self._timer is not None:
+            self._timer.cancel()
+            self._timer = None
+        batch, self._pending = self._pending, []
+        if batch:
+            task = asyncio.create_task(self._dispatch(batch))
+            self._dispatching.add(task)
+            task.add_done_callback(self._dispatching.discard)
+
+    async def _dispatch(self, batch: t.List[t.Tuple[str, asyncio.Future]]):
+        self.flushes += 1
+        self.inputs += len(batch)
+        try:
+            embeddings = await self.llm.embed_many(
+                model=self.model,
+                inputs=[text for text, _ in batch],
+                max_retries=self.max_retries,
+                delay=self.delay,
+                dimensions=self.dimensions,
+            )
+        except Exception as e:
+            for _, future in batch:
+                if not future.done():
+                    future.set_exception(e)
+            return
+        for (text, future), embedding in zip(batch, embeddings):
+            if future.done():
+                # The caller was cancelled.
+                continue
+            if embedding is None:
+                future.set_exception(ValueError(f"Failed to embed: {text[:64]}"))
+            else:
+                future.set_result(embedding)
+
+    def stats(self) -> t.Dict[str, t.Any]:
+        """
+        The number of flushed batches and of inputs. A flush can take fewer API calls than inputs (cached
+        inputs) or more (bisected or retried batches).
+        """
+        return {
+            "flushes": self.flushes,
+            "inputs": self.inputs,
+            "inputs_per_flush": self.inputs / self.flushes if self.flushes else 0.0,
+        }
+
+
+_default_batchers: t.Dict[t.Tuple[str, t.Optional[int]], EmbeddingBatcher] = {}
+
+
+def get_embedding_batcher(
+    model: str = "text-embedding-3-small", dimensions: t.Optional[int] = None
+) -> EmbeddingBatcher:
+    """
+    The process-wide embedding batcher of `model` and `dimensions`, shared by all concurrent queries.
+    """
+    if (model, dimensions) not in _default_batchers:
+        _default_batchers[model, dimensions] = EmbeddingBatcher(
+            model=model,
+            dimensions=dimensions,
+            window=settings.get(
+                "embedding.BATCH_WINDOW", DEFAULT_EMBEDDING_BATCH_WINDOW
+            ),
+            max_batch_inputs=settings.get(
+                "embedding.BATCH_MAX_INPUTS", DEFAULT_EMBEDDING_BATCH_INPUTS
+            ),
+            max_retries=settings.get(
+                "embedding.QUERY_RETRIES", DEFAULT_QUERY_EMBEDDING_RETRIES
+            ),
+            delay=settings.get(
+                "embedding.QUERY_RETRY_DELAY", DEFAULT_QUERY_EMBEDDING_DELAY
+            ),
+        )
+    return _default_batchers[model, dimensions]
 
 
 def try_parse_json_object(input: str) -> tuple[str, dict]: